@@ -2,11 +2,17 @@ from struct import pack
 import struct
 import pickle1
 from pickle1 import _Pickler, _Unpickler, HIGHEST_PROTOCOL, UnpicklingError
+import asyncio
 import io
+import json
+import os
+import tempfile
+import dataclasses
 import unittest
+import weakref
 from unittest.mock import patch, MagicMock
 from types import FunctionType
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict, namedtuple
 from copyreg import dispatch_table
 
 class TestClass:
@@ -854,5 +860,1843 @@ class TestEdgeCases(unittest.TestCase):
         loaded = pickle1._loads(data)
         self.assertIs(loaded[0], loaded)
 
+class TestSaveFastPath(unittest.TestCase):
+    """Test the streamlined save() used when no hooks are overridden"""
+
+    def test_streamlined_save_selected(self):
+        p = _Pickler(io.BytesIO())
+        p.dump([1, 2.5, "a"])
+        self.assertEqual(p.save, p._save_streamlined)
+        self.assertIs(p._leaf_savers[int].__func__, _Pickler._save_long_bin)
+
+    def test_hooks_keep_generic_save(self):
+        class PersistentPickler(_Pickler):
+            def persistent_id(self, obj):
+                return "pid" if obj == 42 else None
+
+        p = PersistentPickler(io.BytesIO(), protocol=2)
+        p.dump([42])
+        self.assertNotIn("save", p.__dict__)
+
+        # A hook assigned after construction is seen by the next dump
+        p = _Pickler(io.BytesIO())
+        p.dump(1)
+        p.reducer_override = lambda obj: NotImplemented
+        p.dump(1)
+        self.assertNotIn("save", p.__dict__)
+
+    def test_persistent_id_assigned_while_dumping(self):
+        # A hook set by a reducer in the middle of a dump is honored,
+        # as it is by the generic save().
+        class Hooking:
+            def __init__(self, pickler):
+                self.pickler = pickler
+
+            def __reduce__(self):
+                self.pickler.persistent_id = (
+                    lambda obj: "pid" if obj == "x" else None)
+                return (list, ())
+
+        class GenericPickler(_Pickler):
+            def reducer_override(self, obj):
+                return NotImplemented
+
+        outputs = []
+        for cls in (_Pickler, GenericPickler):
+            f = io.BytesIO()
+            p = cls(f, 2)
+            p.dump([Hooking(p), "x", "pid"])
+            outputs.append(f.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        u = _Unpickler(io.BytesIO(outputs[0]))
+        u.persistent_load = lambda pid: "loaded " + pid
+        self.assertEqual(u.load(), [[], "loaded pid", "pid"])
+
+    def test_leaf_output_unchanged(self):
+        obj = [None, True, 0, 255, 256, -1, 2**31, 2**70, 1.5, "s", b"b"]
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            plain = io.BytesIO()
+            _Pickler(plain, proto).dump(obj)
+
+            # reducer_override forces the generic save() path
+            class GenericPickler(_Pickler):
+                def reducer_override(self, obj):
+                    return NotImplemented
+            generic = io.BytesIO()
+            GenericPickler(generic, proto).dump(obj)
+            self.assertEqual(plain.getvalue(), generic.getvalue())
+
+class TestBatchedRuns(unittest.TestCase):
+    """Test bulk encoding of homogeneous runs in APPENDS/SETITEMS batches"""
+
+    class GenericPickler(_Pickler):
+        # reducer_override disables the streamlined save and bulk runs
+        def reducer_override(self, obj):
+            return NotImplemented
+
+    def assertSameOutput(self, obj, proto):
+        bulk = io.BytesIO()
+        _Pickler(bulk, proto).dump(obj)
+        generic = io.BytesIO()
+        self.GenericPickler(generic, proto).dump(obj)
+        self.assertEqual(bulk.getvalue(), generic.getvalue())
+        self.assertEqual(pickle1._loads(bulk.getvalue()), obj)
+
+    def test_list_runs(self):
+        shared = "shared"
+        test_objects = [
+            list(range(100000)),
+            [2**31 - 1, -2**31, 2**31, 0, 0xffff] * 500,
+            [i / 7 for i in range(20000)],
+            [str(i) for i in range(30000)] + [shared] * 1500,
+            ["x" * (i % 300) for i in range(3000)],
+        ]
+        for obj in test_objects:
+            for proto in range(1, HIGHEST_PROTOCOL + 1):
+                self.assertSameOutput(obj, proto)
+
+    def test_dict_runs(self):
+        test_objects = [
+            {str(i): i for i in range(50000)},
+            {i: str(i) for i in range(5000)},
+            {str(i): str(i) * 2 for i in range(5000)},
+            {(str(i) if i % 3 else i): 1.5 for i in range(3000)},
+        ]
+        for obj in test_objects:
+            for proto in range(1, HIGHEST_PROTOCOL + 1):
+                self.assertSameOutput(obj, proto)
+
+    def test_shared_strings_keep_identity(self):
+        keys = [str(i) for i in range(2000)]
+        obj = [dict.fromkeys(keys, 0), keys]
+        loaded = pickle1._loads(pickle1._dumps(obj))
+        self.assertEqual(loaded, obj)
+        self.assertIs(next(iter(loaded[0])), loaded[1][0])
+
+class TestPicklerMemo(unittest.TestCase):
+    """Test the compact memo table used by the Pickler"""
+
+    def test_mapping_behaviour(self):
+        memo = pickle1._PicklerMemo()
+        objs = [object() for _ in range(5000)]
+        for i, obj in enumerate(objs):
+            memo[id(obj)] = i, obj
+        self.assertEqual(len(memo), 5000)
+        for i, obj in enumerate(objs):
+            self.assertIn(id(obj), memo)
+            self.assertEqual(memo[id(obj)], (i, obj))
+        self.assertIsNone(memo.get(id(self)))
+        with self.assertRaises(KeyError):
+            memo[id(self)]
+
+        # Deleted entries are dropped and their slots reused
+        for obj in objs[::2]:
+            del memo[id(obj)]
+        self.assertEqual(len(memo), 2500)
+        self.assertNotIn(id(objs[0]), memo)
+        self.assertEqual(memo.pop(id(objs[1])), (1, objs[1]))
+        for i, obj in enumerate(objs[::2]):
+            memo[id(obj)] = 10000 + i, obj
+        self.assertEqual(len(memo), 4999)
+        self.assertEqual(memo[id(objs[2])], (10001, objs[2]))
+        self.assertEqual(len(memo.copy()), 4999)
+
+        memo.clear()
+        self.assertEqual(len(memo), 0)
+        self.assertNotIn(id(objs[3]), memo)
+
+    def test_pickler_uses_memo_table(self):
+        self.assertIs(type(_Pickler(io.BytesIO()).memo), dict)
+        p = _Pickler(io.BytesIO(), compact_memo=True)
+        self.assertIsInstance(p.memo, pickle1._PicklerMemo)
+        shared = ["shared"]
+        p.dump([shared, shared])
+        self.assertIn(id(shared), p.memo)
+        p.clear_memo()
+        self.assertEqual(len(p.memo), 0)
+
+    def test_same_output_either_way(self):
+        shared = ["shared"]
+        names = [str(i) for i in range(3000)]
+        obj = [shared, {"a": shared, "b": (1, "x")}, names]
+        for proto in range(HIGHEST_PROTOCOL + 1):
+            outputs = []
+            for compact_memo in (False, True):
+                buffer = io.BytesIO()
+                _Pickler(buffer, proto, compact_memo=compact_memo,
+                         specialize=True).dump([Record(1, "a", 2.0),
+                                                Record(2, "b", 3.0), obj])
+                outputs.append(buffer.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_dict_memo_still_supported(self):
+        # A plain dict assigned to memo keeps working
+        buffer = io.BytesIO()
+        p = _Pickler(buffer)
+        p.memo = {}
+        shared = ["shared"]
+        p.dump([shared, shared])
+        loaded = pickle1._loads(buffer.getvalue())
+        self.assertIs(loaded[0], loaded[1])
+
+class TestGlobalCache(unittest.TestCase):
+    """Test caching of global resolutions in save_global"""
+
+    def test_per_pickler_cache(self):
+        buffer = io.BytesIO()
+        p = _Pickler(buffer, protocol=2)
+        with patch("pickle1.whichmodule", wraps=pickle1.whichmodule) as wm:
+            p.dump(TestClass)
+            first = buffer.getvalue()
+            for _ in range(3):
+                p.clear_memo()
+                buffer.seek(0)
+                buffer.truncate()
+                p.dump(TestClass)
+                self.assertEqual(buffer.getvalue(), first)
+        self.assertEqual(wm.call_count, 1)
+        self.assertIs(pickle1._loads(first), TestClass)
+
+    def test_per_pickler_cache_invalidated_on_rebind(self):
+        module = __import__(__name__)
+        original = module.TestClass
+        p = _Pickler(io.BytesIO(), protocol=2)
+        session = pickle1.PicklerSession(2)
+        p.dump(original)
+        p.clear_memo()
+        session.dumps(original)
+        module.TestClass = type("TestClass", (), {})
+        try:
+            with self.assertRaisesRegex(pickle1.PicklingError,
+                                        "not the same object"):
+                p.dump(original)
+            with self.assertRaisesRegex(pickle1.PicklingError,
+                                        "not the same object"):
+                session.dumps(original)
+        finally:
+            module.TestClass = original
+        self.assertIs(pickle1._loads(session.dumps(original)), original)
+
+    def test_shared_cache_invalidated_on_rebind(self):
+        module = __import__(__name__)
+        original = module.TestClass
+
+        class Pickler(_Pickler):
+            shared_global_cache = True
+
+        pickle1._global_resolutions.clear()
+        Pickler(io.BytesIO()).dump(original)
+        self.assertIn(original, pickle1._global_resolutions)
+        with patch("pickle1.whichmodule", wraps=pickle1.whichmodule) as wm:
+            Pickler(io.BytesIO()).dump(original)
+            self.assertEqual(wm.call_count, 0)
+
+            # Rebinding the name makes the cached resolution stale
+            module.TestClass = type("TestClass", (), {})
+            try:
+                with self.assertRaises(pickle1.PicklingError):
+                    Pickler(io.BytesIO()).dump(original)
+            finally:
+                module.TestClass = original
+            self.assertEqual(wm.call_count, 1)
+
+class LinkedNode:
+    def __init__(self, value, next=None):
+        self.value = value
+        self.next = next
+
+class ReducedList(list):
+    # Reduces to every part of a reduce value: args, state, list items
+    # and dict items.
+    def __reduce__(self):
+        return (ReducedList, (), {"x": {3}}, iter([4, (5, "b")]),
+                iter([("k", frozenset([6]))]))
+
+    def __setitem__(self, key, value):
+        self.append((key, value))
+
+    def __setstate__(self, state):
+        self.state = state
+
+class TestIterativePickler(unittest.TestCase):
+    """Test the explicit-stack save engine"""
+
+    def dumps(self, obj, protocol=None, cls=pickle1._IterativePickler):
+        buffer = io.BytesIO()
+        cls(buffer, protocol).dump(obj)
+        return buffer.getvalue()
+
+    def test_same_bytes_as_recursive_pickler(self):
+        t = ([],)
+        t[0].append(t)
+        fs_holder = LinkedNode(None)
+        fs_holder.next = frozenset([1, 2, (3, fs_holder)])
+        shared = {"k": [1.5, "s"]}
+        test_objects = [
+            [shared, shared, (shared,), {1, 2, 3}, frozenset("ab")],
+            t,
+            (1, 2, 3, 4, t),
+            fs_holder,
+            {str(i): [i, LinkedNode(i)] for i in range(1500)},
+            OrderedDict(a=1, b=[2]),
+        ]
+        for obj in test_objects:
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                self.assertEqual(self.dumps(obj, proto),
+                                 self.dumps(obj, proto, cls=_Pickler))
+
+    def test_persistent_id_assigned_while_dumping(self):
+        # As in TestSaveFastPath: a hook set by a reducer in the middle
+        # of a dump is honored on the following steps.
+        class Hooking:
+            def __init__(self, pickler):
+                self.pickler = pickler
+
+            def __reduce__(self):
+                self.pickler.persistent_id = (
+                    lambda obj: "pid" if obj == "x" else None)
+                return (list, ())
+
+        outputs = []
+        for cls in (_Pickler, pickle1._IterativePickler):
+            f = io.BytesIO()
+            p = cls(f, 2)
+            p.dump([Hooking(p), "x", 1, "pid"])
+            outputs.append(f.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        u = _Unpickler(io.BytesIO(outputs[1]))
+        u.persistent_load = lambda pid: "loaded " + pid
+        self.assertEqual(u.load(), [[], "loaded pid", 1, "pid"])
+
+    def test_deep_nesting(self):
+        depth = 50000
+        head = None
+        nested = []
+        for i in range(depth):
+            head = LinkedNode(i, head)
+            nested = [nested]
+        loaded = pickle1._loads(self.dumps([head, nested]))
+
+        node, count = loaded[0], 0
+        while node is not None:
+            node, count = node.next, count + 1
+        self.assertEqual(count, depth)
+        lst, count = loaded[1], 0
+        while lst:
+            lst, count = lst[0], count + 1
+        self.assertEqual(count, depth)
+
+    def test_hooks_are_honoured(self):
+        class Pickler(pickle1._IterativePickler):
+            def persistent_id(self, obj):
+                return "pid" if obj == "external" else None
+
+        class Unpickler(_Unpickler):
+            def persistent_load(self, pid):
+                return "loaded " + pid
+
+        buffer = io.BytesIO()
+        Pickler(buffer, 2).dump(["external", ["external"]])
+        buffer.seek(0)
+        self.assertEqual(Unpickler(buffer).load(),
+                         ["loaded pid", ["loaded pid"]])
+
+    def test_same_bytes_with_options(self):
+        shared = ("s", 1)
+        obj = [shared, shared, {"b": 1, "a": {2, 1}}, ReducedList(),
+               Record(1, "r", 1.5), frozenset(["x", "y"]), "s" * 3, "s" * 3]
+        options = [{"dedup": 8}, {"canonical": True, "sort_keys": True},
+                   {"tree": True}, {"shared_only": True}, {"profile": True},
+                   {"compact_memo": True}]
+        for kwargs in options:
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                outputs = []
+                for cls in (pickle1._IterativePickler, _Pickler):
+                    buffer = io.BytesIO()
+                    cls(buffer, proto, **kwargs).dump(obj)
+                    outputs.append(buffer.getvalue())
+                self.assertEqual(outputs[0], outputs[1], (kwargs, proto))
+
+    def test_specialize_rejected(self):
+        with self.assertRaisesRegex(ValueError, "specialize"):
+            pickle1._IterativePickler(io.BytesIO(), specialize=True)
+
+class TestDumpIter(unittest.TestCase):
+    """Test streaming dumps of iterables"""
+
+    def dump_with(self, method, iterable, protocol, **kwargs):
+        buffer = io.BytesIO()
+        getattr(_Pickler(buffer, protocol), method)(iterable, **kwargs)
+        return buffer.getvalue()
+
+    def test_same_bytes_as_dump(self):
+        items = [[i, str(i % 7), (i,)] for i in range(2500)]
+        pairs = [(str(i), [i]) for i in range(1000)]
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            self.assertEqual(self.dump_with("dump_iter", iter(items), proto),
+                             pickle1._dumps(items, proto))
+            self.assertEqual(self.dump_with("dump_items", iter(pairs), proto),
+                             pickle1._dumps(dict(pairs), proto))
+            self.assertEqual(self.dump_with("dump_iter", iter(()), proto),
+                             pickle1._dumps([], proto))
+
+    def test_consumes_lazily(self):
+        pulled = []
+
+        def gen():
+            for i in range(3000):
+                pulled.append(i)
+                yield i
+
+        buffer = io.BytesIO()
+        pickler = _Pickler(buffer, 4)
+        original = pickler._batch_appends
+        seen = []
+
+        def batch_appends(items):
+            seen.append(len(pulled))
+            original(items)
+
+        pickler._batch_appends = batch_appends
+        pickler.dump_iter(gen())
+        self.assertEqual(seen, [1000, 2000, 3000, 3000])
+        self.assertEqual(pickle1._loads(buffer.getvalue()), list(range(3000)))
+
+    def test_forget_releases_memo(self):
+        shared = ["shared"]
+        rows = [[shared, i] for i in range(2500)]
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            buffer = io.BytesIO()
+            pickler = _Pickler(buffer, proto, compact_memo=True)
+            pickler.dump_iter(iter(rows), forget=True)
+            self.assertEqual(list(pickler.memo), [])
+            loaded = pickle1._loads(buffer.getvalue())
+            self.assertEqual(loaded, rows)
+            self.assertIs(loaded[0][0], loaded[999][0])
+            self.assertIsNot(loaded[999][0], loaded[1000][0])
+
+        with self.assertRaises(ValueError):
+            _Pickler(io.BytesIO()).dump_iter([], forget=True)
+        pickler = _Pickler(io.BytesIO(), compact_memo=True)
+        pickler.memo = {}
+        with self.assertRaises(ValueError):
+            pickler.dump_iter([], forget=True)
+
+class TestRecordStream(unittest.TestCase):
+    """Test RecordWriter and RecordReader"""
+
+    def write_records(self, records, protocol, **kwargs):
+        buffer = io.BytesIO()
+        writer = pickle1.RecordWriter(buffer, protocol, **kwargs)
+        for record in records:
+            writer.write(record)
+        buffer.seek(0)
+        return buffer
+
+    def test_round_trip(self):
+        records = [{"name": "event", "point": TestClass(i), "tags": [i]}
+                   for i in range(25)]
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            for checkpoint in (1, 7, None):
+                buffer = self.write_records(records, proto,
+                                            checkpoint=checkpoint)
+                self.assertEqual(list(pickle1.RecordReader(buffer)), records)
+
+    def test_shared_memo_shrinks_stream(self):
+        records = [{"name": "event", "point": TestClass(i)}
+                   for i in range(100)]
+        shared = self.write_records(records, 4, checkpoint=None)
+        separate = io.BytesIO()
+        for record in records:
+            pickle1._dump(record, separate, 4)
+        self.assertLess(len(shared.getvalue()), len(separate.getvalue()) // 2)
+        self.assertEqual(shared.getvalue().count(b"TestClass"), 1)
+
+    def test_checkpoint_clears_memo(self):
+        records = [["value"] for _ in range(10)]
+        buffer = self.write_records(records, 4, checkpoint=4)
+        self.assertEqual(buffer.getvalue().count(b"value"), 3)
+        self.assertEqual(list(pickle1.RecordReader(buffer)), records)
+
+    def test_mutable_objects_not_shared(self):
+        row = [1]
+        buffer = io.BytesIO()
+        writer = pickle1.RecordWriter(buffer, 4)
+        writer.write(row)
+        row.append(2)
+        writer.write(row)
+        buffer.seek(0)
+        self.assertEqual(list(pickle1.RecordReader(buffer)), [[1], [1, 2]])
+
+    def test_reader_is_lazy(self):
+        buffer = self.write_records(range(3), 4)
+        reader = pickle1.RecordReader(buffer)
+        self.assertEqual(next(reader), 0)
+        position = buffer.tell()
+        self.assertLess(position, len(buffer.getvalue()))
+        self.assertEqual(list(reader), [1, 2])
+
+    def test_truncated_record(self):
+        records = [{"name": "event", "tags": [i, i * 1.5]} for i in range(3)]
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            data = self.write_records(records, proto).getvalue()
+            end = len(data)
+            start = len(self.write_records(records[:2], proto).getvalue())
+            for cut in range(start + 1, end):
+                reader = pickle1.RecordReader(io.BytesIO(data[:cut]))
+                self.assertEqual([next(reader), next(reader)], records[:2])
+                with self.assertRaises((UnpicklingError, struct.error,
+                                        ValueError, IndexError)):
+                    next(reader)
+            reader = pickle1.RecordReader(io.BytesIO(data[:start]))
+            self.assertEqual(list(reader), records[:2])
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            pickle1.RecordWriter(io.BytesIO(), checkpoint=0)
+        with self.assertRaises(UnpicklingError):
+            pickle1.RecordReader(io.BytesIO(pickle1._dumps([1, 2])))
+
+class TestSharded(unittest.TestCase):
+    """Test dump_sharded and load_sharded"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_round_trip(self):
+        items = [[i, str(i), TestClass(i)] for i in range(1000)]
+        mapping = {str(i): (i, [i]) for i in range(1000)}
+        for obj in (items, mapping, [], {}):
+            for shards in (1, 7, 5000):
+                pickle1.dump_sharded(obj, self.path, workers=1, shards=shards)
+                loaded = pickle1.load_sharded(self.path)
+                self.assertIs(type(loaded), type(obj))
+                self.assertEqual(loaded, obj)
+                self.assertEqual(list(loaded), list(obj))
+
+    def test_process_pool(self):
+        items = [(i, "item") for i in range(500)]
+        pickle1.dump_sharded(items, self.path, workers=2, shards=4)
+        self.assertEqual(pickle1.load_sharded(self.path), items)
+
+    def test_shards_written_as_done(self):
+        mapping = {str(i): (i, "item") for i in range(2000)}
+        pickle1.dump_sharded(mapping, self.path, workers=3, shards=9)
+        self.assertIsNone(pickle1._shard_source)
+        loaded = pickle1.load_sharded(self.path)
+        self.assertEqual(list(loaded.items()), list(mapping.items()))
+
+        # Without fork the shards are sent to the workers
+        import multiprocessing
+        items = [(i, "item") for i in range(500)]
+        pickle1.dump_sharded(items, self.path, workers=2, shards=3,
+                             mp_context=multiprocessing.get_context("spawn"))
+        self.assertEqual(pickle1.load_sharded(self.path), items)
+
+    def test_default_context(self):
+        import multiprocessing
+        items = [(i, "item") for i in range(100)]
+        context = multiprocessing.get_context("spawn")
+        with patch("multiprocessing.get_context",
+                   return_value=context) as get_context:
+            pickle1.dump_sharded(items, self.path, workers=2, shards=2)
+        get_context.assert_called_once_with()
+        self.assertEqual(pickle1.load_sharded(self.path), items)
+
+    def test_shards_are_independent(self):
+        shared = ["shared"]
+        pickle1.dump_sharded([shared] * 4, self.path, workers=1, shards=2)
+        loaded = pickle1.load_sharded(self.path)
+        self.assertIs(loaded[0], loaded[1])
+        self.assertIsNot(loaded[1], loaded[2])
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            pickle1.dump_sharded((1, 2), self.path)
+        with self.assertRaises(ValueError):
+            pickle1.dump_sharded([1], self.path, workers=0)
+        with self.assertRaises(ValueError):
+            pickle1.dump_sharded([1], self.path, shards=0)
+        with open(self.path, "wb") as f:
+            f.write(pickle1._dumps([1, 2]))
+        with self.assertRaises(UnpicklingError):
+            pickle1.load_sharded(self.path)
+
+class TestFramerSinks(unittest.TestCase):
+    """Test the framer's writev and writelines paths and frame_size"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.obj = [[str(i), b"x" * (i % 3 * 40000), list(range(i % 40))]
+                    for i in range(300)]
+
+    def dump_to(self, buffering, protocol, **kwargs):
+        with open(self.path, "wb", buffering=buffering) as f:
+            _Pickler(f, protocol, **kwargs).dump(self.obj)
+            _Pickler(f, protocol, **kwargs).dump("next")
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_same_bytes_for_all_sinks(self):
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            expected = pickle1._dumps(self.obj, proto) + \
+                pickle1._dumps("next", proto)
+            self.assertEqual(self.dump_to(0, proto), expected)
+            self.assertEqual(self.dump_to(-1, proto), expected)
+
+    @unittest.skipUnless(hasattr(os, "writev"), "needs os.writev")
+    def test_partial_writev(self):
+        writev = os.writev
+
+        def short_writev(fd, buffers):
+            return writev(fd, [memoryview(buffers[0])[:7]])
+
+        with patch("os.writev", short_writev):
+            data = self.dump_to(0, 4)
+        self.assertEqual(data, pickle1._dumps(self.obj, 4) +
+                         pickle1._dumps("next", 4))
+
+    def test_file_io_subclass(self):
+        class CountingFileIO(io.FileIO):
+            written = 0
+
+            def write(self, data):
+                n = super().write(data)
+                self.written += n
+                return n
+
+        with CountingFileIO(self.path, "wb") as sink:
+            _Pickler(sink, 4).dump(self.obj)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertEqual(data, pickle1._dumps(self.obj, 4))
+        self.assertEqual(sink.written, len(data))
+
+    def test_frame_size(self):
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, frame_size=1000).dump(self.obj)
+        data = buffer.getvalue()
+        self.assertEqual(pickle1._loads(data), self.obj)
+        self.assertGreater(data.count(pickle1.FRAME),
+                           pickle1._dumps(self.obj, 4).count(pickle1.FRAME))
+        with self.assertRaises(ValueError):
+            _Pickler(io.BytesIO(), 4, frame_size=0)
+
+class TestInBandPickleBuffer(unittest.TestCase):
+    """Test in-band PickleBuffer pickling without copying the buffer"""
+
+    @unittest.skipUnless(pickle1._HAVE_PICKLE_BUFFER, "needs PickleBuffer")
+    def test_same_bytes_as_c_pickle(self):
+        import pickle
+        for data in (b"abc", b"x" * 300, bytearray(b"y" * 100000),
+                     bytearray()):
+            buf = pickle1.PickleBuffer(data)
+            for obj in (buf, [buf, buf]):
+                self.assertEqual(pickle1._dumps(obj, 5), pickle.dumps(obj, 5))
+            loaded = pickle1._loads(pickle1._dumps([buf, buf], 5))
+            self.assertEqual(loaded[0], data)
+            self.assertIs(type(loaded[0]), type(data))
+            self.assertIs(loaded[0], loaded[1])
+
+    @unittest.skipUnless(pickle1._HAVE_PICKLE_BUFFER, "needs PickleBuffer")
+    def test_peak_memory_stays_flat(self):
+        import tracemalloc
+
+        class Sink:
+            written = 0
+
+            def write(self, data):
+                self.written += len(data)
+
+        size = 32 * 1024 * 1024
+        for data in (bytearray(size), bytes(size)):
+            sink = Sink()
+            tracemalloc.start()
+            try:
+                _Pickler(sink, 5).dump(pickle1.PickleBuffer(data))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertGreater(sink.written, size)
+            self.assertLess(peak, size // 16)
+
+@unittest.skipUnless(pickle1._HAVE_PICKLE_BUFFER, "needs PickleBuffer")
+class TestBufferSidecar(unittest.TestCase):
+    """Test dump_oob and load_oob"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(self.remove_files)
+
+    def remove_files(self):
+        for path in (self.path, self.path + ".buffers"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_round_trip(self):
+        PickleBuffer = pickle1.PickleBuffer
+        big = bytearray(b"z" * 300000)
+        obj = {"big": PickleBuffer(big), "empty": PickleBuffer(b""),
+               "small": [PickleBuffer(b"readonly"), "plain", 7]}
+        pickle1.dump_oob(obj, self.path)
+        self.assertLess(os.path.getsize(self.path), 200)
+        loaded = pickle1.load_oob(self.path)
+        self.assertEqual(bytes(loaded["big"]), bytes(big))
+        self.assertFalse(loaded["big"].readonly)
+        self.assertEqual(bytes(loaded["small"][0]), b"readonly")
+        self.assertTrue(loaded["small"][0].readonly)
+        self.assertEqual(loaded["small"][1:], ["plain", 7])
+        self.assertEqual(len(loaded["empty"]), 0)
+
+    def test_buffers_are_mapped_page_aligned(self):
+        import mmap
+        pickle1.dump_oob([pickle1.PickleBuffer(b"a" * 10),
+                          pickle1.PickleBuffer(bytearray(b"b" * 10))],
+                         self.path)
+        with open(self.path + ".buffers", "rb") as f:
+            data = f.read()
+        self.assertEqual(data[mmap.PAGESIZE:mmap.PAGESIZE + 10], b"a" * 10)
+        self.assertEqual(data[2 * mmap.PAGESIZE:2 * mmap.PAGESIZE + 10],
+                         b"b" * 10)
+        loaded = pickle1.load_oob(self.path)
+        self.assertIsInstance(loaded[1].obj, mmap.mmap)
+        loaded[1][0] = ord("c")
+        with open(self.path + ".buffers", "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            pickle1.dump_oob([], self.path, protocol=4)
+        with open(self.path + ".buffers", "wb") as f:
+            f.write(b"not a sidecar" * 3)
+        with self.assertRaises(UnpicklingError):
+            pickle1.load_oob(self.path)
+
+class TestDedup(unittest.TestCase):
+    """Test value-based memoization of str, bytes and small tuples"""
+
+    def rows(self, n):
+        # Equal but distinct objects, as decoded from JSON
+        return [{"id": i, "status": "".join(["o", "k"]),
+                 "tag": ("".join(["a", "b"]), i % 2),
+                 "raw": bytes(bytearray(b"xy"))} for i in range(n)]
+
+    def test_smaller_and_shared(self):
+        rows = self.rows(2000)
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                buffer = io.BytesIO()
+                cls(buffer, proto, dedup=100).dump(rows)
+                data = buffer.getvalue()
+                self.assertLess(len(data),
+                                len(pickle1._dumps(rows, proto)) * 3 // 4)
+                loaded = pickle1._loads(data)
+                self.assertEqual(loaded, rows)
+                self.assertIs(loaded[0]["status"], loaded[-1]["status"])
+                self.assertIs(loaded[0]["raw"], loaded[-1]["raw"])
+                self.assertIs(loaded[0]["tag"], loaded[2]["tag"])
+
+    def test_keeps_types_apart(self):
+        items = [(1,), (1.0,), (True,), (0.0,), (-0.0,), "a", b"a",
+                 ("a", None), ("a", None)]
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, dedup=100).dump(items)
+        loaded = pickle1._loads(buffer.getvalue())
+        self.assertEqual(loaded, items)
+        self.assertEqual([type(t[0]) for t in loaded[:5]],
+                         [int, float, bool, float, float])
+        self.assertEqual(repr(loaded[4]), "(-0.0,)")
+        self.assertEqual(type(loaded[6]), bytes)
+        self.assertIs(loaded[7], loaded[8])
+
+    def test_eviction(self):
+        pickler = _Pickler(io.BytesIO(), 4, dedup=3)
+        pickler.dump(["".join(["k", str(i)]) for i in range(10)])
+        self.assertEqual(list(pickler._values), ["k7", "k8", "k9"])
+        items = ["".join(["k", str(i % 5)]) for i in range(20)]
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, dedup=3).dump(items)
+        loaded = pickle1._loads(buffer.getvalue())
+        self.assertEqual(loaded, items)
+        self.assertIsNot(loaded[0], loaded[5])
+        pickler.clear_memo()
+        self.assertEqual(pickler._values, {})
+        with self.assertRaises(ValueError):
+            _Pickler(io.BytesIO(), 4, dedup=0)
+
+class TestCompressedFraming(unittest.TestCase):
+    """Test compressed framing"""
+
+    def setUp(self):
+        self.obj = [{"id": i, "name": "user%d" % i, "blob": b"ab" * (i % 50)}
+                    for i in range(3000)]
+        self.obj.append(b"z" * 200000)
+
+    def test_round_trip(self):
+        for compression in ("zlib", "lzma"):
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                buffer = io.BytesIO()
+                pickler = _Pickler(buffer, proto, compression=compression,
+                                   frame_size=16384)
+                pickler.dump(self.obj)
+                pickler.dump("next")
+                data = buffer.getvalue()
+                self.assertLess(len(data),
+                                len(pickle1._dumps(self.obj, proto)) // 4)
+                buffer.seek(0)
+                unpickler = _Unpickler(buffer)
+                self.assertEqual(unpickler.load(), self.obj)
+                self.assertEqual(unpickler.load(), "next")
+                self.assertEqual(buffer.read(), b"")
+
+    def test_plain_readers_reject_it(self):
+        import pickle
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, compression="zlib").dump([1, 2])
+        data = buffer.getvalue()
+        self.assertTrue(data.startswith(pickle1._COMPRESSED_MAGIC + b"z"))
+        with self.assertRaisesRegex(pickle.UnpicklingError, "load key"):
+            pickle.loads(data)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            _Pickler(io.BytesIO(), 4, compression="bz9")
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, compression="zlib").dump(self.obj)
+        data = buffer.getvalue()
+        with self.assertRaises(UnpicklingError):
+            pickle1._loads(data[:len(data) // 2])
+        with self.assertRaises(UnpicklingError):
+            pickle1._loads(data[:4] + b"?" + data[5:])
+        with self.assertRaises(UnpicklingError):
+            pickle1._loads(b"(" + data)
+
+class TestCanonical(unittest.TestCase):
+    """Test canonical pickling"""
+
+    def build(self, order):
+        # Equal values built in different orders and from distinct
+        # but equal str objects
+        nums = sorted(range(-300, 300), key=lambda i: (i * order) % 601)
+        keys = ["k%d" % i for i in sorted(range(50),
+                                          key=lambda i: (i * order) % 53)]
+        mixed = [1, "a", b"b", 2.5, None, (1, "x"), 1 + 2j,
+                 frozenset({3, 4}), -0.5, float("inf")]
+        mixed.sort(key=lambda x: hash(repr(x)) * order)
+        return {"set": set(nums), "mixed": set(mixed),
+                "strs": frozenset("".join(["s", k]) for k in keys),
+                "dict": {"".join(k): ("".join(["v", k]), 1) for k in keys},
+                "list": ["".join("ab") for _ in range(3)]}
+
+    def canonical(self, obj, proto, cls=_Pickler, **kwargs):
+        buffer = io.BytesIO()
+        cls(buffer, proto, canonical=True, **kwargs).dump(obj)
+        return buffer.getvalue()
+
+    def test_equal_values_identical_bytes(self):
+        one, two = self.build(1), self.build(7)
+        self.assertEqual(one, two)
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                data = self.canonical(one, proto, cls, sort_keys=True)
+                self.assertEqual(
+                    data, self.canonical(two, proto, cls, sort_keys=True))
+                self.assertEqual(pickle1._loads(data), one)
+                # dicts keep insertion order unless sort_keys is given
+                self.assertNotEqual(self.canonical(one, proto, cls),
+                                    self.canonical(two, proto, cls))
+
+    def test_shared_and_distinct_copies(self):
+        # Equal immutable values give the same bytes whether they are
+        # one object or distinct copies
+        built = tuple([1.5])
+        nested = (1, (2,))
+        members = frozenset([1.5, (1, "x")])
+        shared = [built, built, nested, nested, (2,), members, members]
+        distinct = [(1.5,), tuple([1.5]), (1, (2,)), (1, tuple([2])),
+                    tuple([2]), frozenset([1.5, (1, "x")]),
+                    frozenset([(1, "x"), 1.5])]
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                data = self.canonical(shared, proto, cls)
+                self.assertEqual(data, self.canonical(distinct, proto, cls))
+                self.assertEqual(pickle1._loads(data), shared)
+        # Types are part of the value; sharing of mutable objects too
+        self.assertNotEqual(self.canonical([(1,), (1.0,)], 4),
+                            self.canonical([(1,), (1,)], 4))
+        row = [1]
+        self.assertNotEqual(self.canonical([(row,), (row,)], 4),
+                            self.canonical([([1],), ([1],)], 4))
+
+    def test_sort_keys_reduced_dicts(self):
+        one = defaultdict(list, [("b", [1]), ("a", [2])])
+        two = defaultdict(list, [("a", [2]), ("b", [1])])
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                data = self.canonical(one, proto, cls, sort_keys=True)
+                self.assertEqual(
+                    data, self.canonical(two, proto, cls, sort_keys=True))
+                self.assertEqual(pickle1._loads(data), one)
+                # The order of an OrderedDict is part of its value
+                ordered = OrderedDict(b=1, a=2)
+                data = self.canonical(ordered, proto, cls, sort_keys=True)
+                self.assertEqual(list(pickle1._loads(data)), ["b", "a"])
+
+    def test_cyclic_set(self):
+        first, second = LinkedNode(1), LinkedNode(2)
+        members = {first, second}
+        first.next = second.next = members
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            loaded = pickle1._loads(self.canonical(members, proto,
+                                                   sort_keys=True))
+            self.assertEqual(sorted(node.value for node in loaded), [1, 2])
+            for node in loaded:
+                self.assertIs(node.next, loaded)
+
+    def test_independent_of_hash_seed(self):
+        import subprocess
+        import sys
+        code = ("import sys, pickle1, io; b = io.BytesIO(); "
+                "pickle1._Pickler(b, 4, canonical=True, sort_keys=True)"
+                ".dump([{'a', 'b', 'c', 'd'}, {'x': 1, 'y': {2.5, 'z'}}]); "
+                "sys.stdout.write(b.getvalue().hex())")
+        outputs = set()
+        for seed in ("1", "2", "3"):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.run(
+                [sys.executable, "-c", code], env=env, check=True,
+                capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(pickle1.__file__))
+            ).stdout)
+        self.assertEqual(len(outputs), 1)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            _Pickler(io.BytesIO(), 4, canonical=True, dedup=10)
+
+class TestSinks(unittest.TestCase):
+    """Test the sink classes and pickle_digest"""
+
+    def setUp(self):
+        self.obj = [{"i": i, "s": str(i) * (i % 300)} for i in range(3000)]
+        self.data = pickle1._dumps(self.obj, 4)
+
+    def test_pickle_digest(self):
+        import hashlib
+        self.assertEqual(pickle1.pickle_digest(self.obj, 4),
+                         hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(pickle1.pickle_digest(self.obj, 4,
+                                               algorithm="blake2b"),
+                         hashlib.blake2b(self.data).hexdigest())
+        self.assertEqual(
+            pickle1.pickle_digest({"b", "a"}, 4, canonical=True),
+            pickle1.pickle_digest({"a", "b"}, 4, canonical=True))
+
+    def test_tee(self):
+        import hashlib
+        import zlib
+        file = io.BytesIO()
+        compressed = io.BytesIO()
+        hasher = pickle1.HashSink("sha256")
+        counter = pickle1.CountingSink()
+        compressor = pickle1.CompressingSink(compressed, "zlib")
+        _Pickler(pickle1.TeeSink(hasher, counter, compressor, file),
+                 4).dump(self.obj)
+        compressor.close()
+        self.assertEqual(file.getvalue(), self.data)
+        self.assertEqual(counter.count, len(self.data))
+        self.assertEqual(hasher.digest(), hashlib.sha256(self.data).digest())
+        self.assertEqual(zlib.decompress(compressed.getvalue()), self.data)
+        with self.assertRaises(ValueError):
+            pickle1.CompressingSink(file, "bz9")
+
+    def test_digest_memory(self):
+        import tracemalloc
+        obj = [str(i) * 2000 for i in range(1000)]
+        size = len(pickle1._dumps(obj, 4))
+        tracemalloc.start()
+        try:
+            pickle1.pickle_digest(obj, 4)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, size // 4)
+
+class TestEstimateSize(unittest.TestCase):
+    """Test estimate_size"""
+
+    def test_matches_dumps(self):
+        ints = [0, 255, 256, 2**31 - 1, 2**31, -2**31 - 1, 2**63, -2**63,
+                -2**63 - 1, -2**2047, -2**2047 - 1, 2**2048, 10**700]
+        objects = [
+            ints,
+            ["a" * n for n in (0, 255, 256, 65535, 65536, 200000)],
+            [b"b" * n for n in (0, 255, 256, 65536)],
+            [bytearray(10), bytearray(70000)],
+            {"x": "h\xe9llo" * 20000, "y": [1.5, None, True, (1, 2, 3, 4)],
+             "z": {frozenset({1, 2})}},
+            [{"i": i, "s": "v%d" % i, "b": bytes(i % 300)}
+             for i in range(2000)],
+        ]
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            for obj in objects:
+                for kwargs in ({}, {"frame_size": 1000}, {"dedup": 10},
+                               {"canonical": True}):
+                    buffer = io.BytesIO()
+                    _Pickler(buffer, proto, **kwargs).dump(obj)
+                    self.assertEqual(
+                        pickle1.estimate_size(obj, proto, **kwargs),
+                        len(buffer.getvalue()))
+
+    def test_long_size(self):
+        for x in range(-70000, 70000, 7):
+            self.assertEqual(pickle1._long_size(x),
+                             len(pickle1.encode_long(x)))
+        for bits in range(1, 600):
+            for x in (2**bits, 2**bits - 1, -2**bits, -2**bits - 1):
+                self.assertEqual(pickle1._long_size(x),
+                                 len(pickle1.encode_long(x)))
+
+    def test_payloads_not_built(self):
+        import tracemalloc
+        obj = [bytes(1000000), "x" * 1000000, bytearray(1000000)]
+        tracemalloc.start()
+        try:
+            size = pickle1.estimate_size(obj, 5)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(size, len(pickle1._dumps(obj, 5)))
+        self.assertLess(peak, 100000)
+        with self.assertRaises(ValueError):
+            pickle1.estimate_size(obj, 4, compression="zlib")
+
+class TestSessions(unittest.TestCase):
+    """Test PicklerSession, UnpicklerSession and the pooled shorthands"""
+
+    objects = [
+        None, 1, "s", b"b", (1, 2), [1, [2, [3]]],
+        {"id": 7, "args": [7, "x" * 20, (1.5, None)], "kw": {"a": b"zz"}},
+        list(range(100000)), "y" * 200000, pickle1.PickleError,
+    ]
+
+    def reference(self, obj, proto):
+        buffer = io.BytesIO()
+        _Pickler(buffer, proto).dump(obj)
+        return buffer.getvalue()
+
+    def test_session_matches_pickler(self):
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            session = pickle1.PicklerSession(proto)
+            # Later small objects must not see a longer earlier pickle.
+            for obj in self.objects + self.objects[::-1]:
+                self.assertEqual(session.dumps(obj),
+                                 self.reference(obj, proto))
+
+    def test_shorthands(self):
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            for obj in self.objects:
+                data = pickle1._dumps(obj, proto)
+                self.assertEqual(data, self.reference(obj, proto))
+                self.assertEqual(pickle1._loads(data), obj)
+
+    def test_unpickler_session(self):
+        session = pickle1.UnpicklerSession()
+        for obj in self.objects:
+            self.assertEqual(session.loads(pickle1._dumps(obj)), obj)
+        with self.assertRaises(TypeError):
+            session.loads("abc")
+        with self.assertRaises(EOFError):
+            session.loads(b"")
+        self.assertEqual(session.loads(pickle1._dumps(5)), 5)
+
+    def test_memo_cleared(self):
+        obj = [1]
+        session = pickle1.PicklerSession()
+        session.dumps([obj, obj])
+        self.assertEqual(session.dumps([obj]), self.reference([obj], None))
+        victim = TestClass(1)
+        ref = weakref.ref(victim)
+        session.dumps(victim)
+        del victim
+        self.assertIsNone(ref())
+
+    def test_error_then_reuse(self):
+        session = pickle1.PicklerSession()
+        with self.assertRaises(pickle1.PicklingError):
+            session.dumps([1, lambda: 0])
+        self.assertEqual(session.dumps([2]), self.reference([2], None))
+
+    def test_output_released(self):
+        import gc
+        import tracemalloc
+        obj = [b"x" * 2000000 for _ in range(10)]
+        tracemalloc.start()
+        try:
+            data = pickle1._dumps(obj)
+            self.assertEqual(len(pickle1._loads(data)), 10)
+            del data
+            gc.collect()
+            self.assertLess(tracemalloc.get_traced_memory()[0], 1000000)
+        finally:
+            tracemalloc.stop()
+
+    def test_reentrant(self):
+        class Nested:
+            def __reduce__(self):
+                return (pickle1._loads, (pickle1._dumps([1, "a"]),))
+        data = pickle1._dumps([Nested(), "a"])
+        self.assertEqual(pickle1._loads(data), [[1, "a"], "a"])
+
+
+class PlainSlots:
+    __slots__ = ("x", "y")
+    def __init__(self, x):
+        self.x = x
+
+class PlainMixed(PlainSlots):
+    def __init__(self, x):
+        self.x = x
+        self.z = x
+
+class WithGetState:
+    def __getstate__(self):
+        return {"fixed": 1}
+
+class TestReducerCache(unittest.TestCase):
+    """Test the per-type shortcut for plain classes in the save slow path"""
+
+    def unlearned(self, cls, obj, proto):
+        # Pickle with the shortcut never taken.
+        buffer = io.BytesIO()
+        pickler = cls(buffer, proto)
+        pickler._learn_reducer = lambda *args: None
+        pickler.dump(obj)
+        return buffer.getvalue()
+
+    def test_same_output(self):
+        overridden = TestClass(3)
+        overridden.__reduce_ex__ = lambda proto: (TestClass, (4,))
+        objects = [
+            [TestClass(i) for i in range(5)],
+            [PlainSlots(1), PlainSlots.__new__(PlainSlots), PlainSlots(2)],
+            [PlainMixed(i) for i in range(3)],
+            [TestClass(1), overridden, TestClass(2)],
+            [WithGetState(), WithGetState()],
+            [OrderedDict(a=1), OrderedDict()],
+        ]
+        shared = TestClass("s")
+        objects.append([shared, TestClass(shared), shared])
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(2, HIGHEST_PROTOCOL + 1):
+                for obj in objects:
+                    buffer = io.BytesIO()
+                    cls(buffer, proto).dump(obj)
+                    self.assertEqual(buffer.getvalue(),
+                                     self.unlearned(cls, obj, proto))
+
+    def test_plain_types_learned(self):
+        pickler = _Pickler(io.BytesIO(), 4)
+        pickler.dump([TestClass(1), PlainSlots(2), WithGetState()])
+        self.assertEqual(pickler._plain_types[TestClass], (True, ()))
+        self.assertEqual(pickler._plain_types[PlainSlots],
+                         (False, ("x", "y")))
+        self.assertIsNone(pickler._plain_types[WithGetState])
+        pickler = _Pickler(io.BytesIO(), 1)
+        pickler.dump([TestClass(1), TestClass(2)])
+        self.assertIsNone(pickler._plain_types[TestClass])
+
+    def test_dispatch_table_registration(self):
+        class Register:
+            def __reduce__(self):
+                dispatch_table[TestClass] = lambda obj: (dict, ())
+                return (list, ())
+        try:
+            data = pickle1._dumps([TestClass(1), Register(), TestClass(2)])
+        finally:
+            del dispatch_table[TestClass]
+        first, _, last = pickle1._loads(data)
+        self.assertEqual(first, TestClass(1))
+        self.assertEqual(last, {})
+        pickler = _Pickler(io.BytesIO(), 4)
+        pickler.dispatch_table = {TestClass: lambda obj: (dict, ())}
+        pickler.dump([TestClass(1), TestClass(2)])
+
+    def test_class_changed_between_dumps(self):
+        pickler = _Pickler(io.BytesIO(), 4)
+        pickler.dump([TestClass(1), TestClass(2)])
+        TestClass.__getstate__ = lambda self: {"value": 0}
+        try:
+            buffer = io.BytesIO()
+            pickler = _Pickler(buffer, 4)
+            pickler.dump([TestClass(1), TestClass(2)])
+        finally:
+            del TestClass.__getstate__
+        self.assertEqual(pickle1._loads(buffer.getvalue()),
+                         [TestClass(0), TestClass(0)])
+
+
+@dataclasses.dataclass
+class Record:
+    id: int
+    name: str
+    score: float
+    extra: object = None
+
+@dataclasses.dataclass(slots=True)
+class SlotRecord:
+    id: int
+    extra: object
+
+Row = namedtuple("Row", "a b")
+WideRow = namedtuple("WideRow", "a b c d e")
+
+class EmptySlots:
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (EmptySlots, (), {})
+
+class TestSpecialize(unittest.TestCase):
+    """Test the per-class savers of Pickler(specialize=True)"""
+
+    def make(self, n):
+        values = [0, 300, 70000, -5, 2**40, 1.5, "s", "t" * 300, None,
+                  True, [1], (2,), b"b"]
+        objects = []
+        for i in range(n):
+            v = values[i % len(values)]
+            w = values[(i * 7) % len(values)]
+            objects.append(Record(i, "n%d" % (i % 5), 0.5, v))
+            objects.append(SlotRecord(v, w))
+            objects.append(Row(v, w))
+            objects.append(WideRow(i, v, w, v, w))
+            objects.append(TestClass(v))
+        inner = []
+        row = Row(inner, 1)
+        inner.append(row)
+        record = Record(1, "r", 1.0)
+        record.extra = record
+        objects += [row, record, Record(2, "x", 2.0, objects[-1])]
+        return objects
+
+    def dumps(self, obj, proto, **kwargs):
+        buffer = io.BytesIO()
+        pickler = _Pickler(buffer, proto, **kwargs)
+        pickler.dump(obj)
+        return buffer.getvalue(), pickler
+
+    def test_same_output(self):
+        obj = self.make(60)
+        for proto in range(2, HIGHEST_PROTOCOL + 1):
+            for frame_size in (None, 64):
+                expected, _ = self.dumps(obj, proto, frame_size=frame_size)
+                data, pickler = self.dumps(obj, proto, frame_size=frame_size,
+                                           specialize=True)
+                self.assertEqual(data, expected)
+                for cls in (Record, SlotRecord, Row, WideRow, TestClass):
+                    self.assertIsNotNone(pickler._class_savers[cls])
+                loaded = pickle1._loads(data)
+                self.assertEqual(loaded[:5], obj[:5])
+                self.assertIs(loaded[-3].a[0], loaded[-3])
+                self.assertIs(loaded[-2].extra, loaded[-2])
+
+    def test_not_specialized(self):
+        obj = [Record(1, "a", 1.0), Record(2, "b", 2.0)]
+        for proto, kwargs in ((1, {}), (4, {"dedup": 10}),
+                              (4, {"canonical": True, "sort_keys": True})):
+            data, pickler = self.dumps(obj, proto, specialize=True, **kwargs)
+            self.assertIsNone(pickler._class_savers)
+            self.assertEqual(data, self.dumps(obj, proto, **kwargs)[0])
+
+    def test_memo_released(self):
+        records = [Record(i, "n", 1.0) for i in range(2500)]
+        expected = io.BytesIO()
+        _Pickler(expected, 4, compact_memo=True).dump_iter(records,
+                                                           forget=True)
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, specialize=True,
+                 compact_memo=True).dump_iter(records, forget=True)
+        self.assertEqual(buffer.getvalue(), expected.getvalue())
+        self.assertEqual(pickle1._loads(buffer.getvalue()), records)
+
+    def test_dispatch_table_registration(self):
+        class Register:
+            def __reduce__(self):
+                dispatch_table[Record] = lambda obj: (dict, ())
+                return (list, ())
+        try:
+            data, _ = self.dumps([Record(1, "a", 1.0), Record(2, "b", 2.0),
+                                  Register(), Record(3, "c", 3.0)],
+                                 4, specialize=True)
+        finally:
+            del dispatch_table[Record]
+        self.assertEqual(pickle1._loads(data),
+                         [Record(1, "a", 1.0), Record(2, "b", 2.0), [], {}])
+
+    def test_build_with_setstate_in_dict(self):
+        class Setter:
+            def __new__(cls):
+                self = object.__new__(cls)
+                self.__setstate__ = lambda state: setattr(self, "got", state)
+                return self
+        unpickler = _Unpickler(io.BytesIO(b""))
+        unpickler._default_builds = {}
+        inst = Setter()
+        unpickler.stack = [inst, {"a": 1}]
+        unpickler.load_build()
+        self.assertEqual(inst.got, {"a": 1})
+        inst = TestClass(0)
+        unpickler.stack = [inst, {"value": 2, 3: 4}]
+        unpickler.load_build()
+        self.assertEqual(vars(inst), {"value": 2, 3: 4})
+
+
+    def test_build_empty_state_without_dict(self):
+        for proto in range(2, HIGHEST_PROTOCOL + 1):
+            for specialize in (False, True):
+                data, _ = self.dumps([EmptySlots(), EmptySlots()], proto,
+                                     specialize=specialize)
+                loaded = pickle1._loads(data)
+                self.assertIs(type(loaded[1]), EmptySlots)
+        unpickler = _Unpickler(io.BytesIO(b""))
+        unpickler._default_builds = {}
+        inst = SlotRecord(1, None)
+        unpickler.stack = [inst, (None, {"id": 2})]
+        unpickler.load_build()
+        self.assertEqual(inst.id, 2)
+
+class TestAsyncStreams(unittest.TestCase):
+    """Test dump_async and load_async"""
+
+    objects = [None, "s", list(range(50000)), "x" * 100000,
+               {"a": [1, (2, 3)], "b": b"y" * 300000, "c": "\xe9" * 70000},
+               [bytearray(200000), 2**100, -3.5, {1, 2}], OrderedDict(a=1)]
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    async def pipe(self):
+        import socket
+        a, b = socket.socketpair()
+        reader, writer_a = await asyncio.open_connection(sock=a)
+        reader_b, writer = await asyncio.open_connection(sock=b)
+        return reader, writer, writer_a
+
+    def test_round_trip(self):
+        async def main():
+            reader, writer, writer_a = await self.pipe()
+            for proto in range(0, HIGHEST_PROTOCOL + 1):
+                for obj in self.objects:
+                    async def send():
+                        await pickle1.dump_async(obj, writer, proto)
+                        await pickle1.dump_async("next", writer, proto)
+                    task = asyncio.create_task(send())
+                    self.assertEqual(await pickle1.load_async(reader), obj)
+                    self.assertEqual(await pickle1.load_async(reader), "next")
+                    await task
+            writer.close()
+            await writer.wait_closed()
+            with self.assertRaises(EOFError):
+                await pickle1.load_async(reader)
+            writer_a.close()
+            await writer_a.wait_closed()
+        self.run_async(main())
+
+    def test_same_bytes(self):
+        class Writer:
+            def __init__(self):
+                self.buffer = io.BytesIO()
+            def write(self, data):
+                self.buffer.write(data)
+            async def drain(self):
+                pass
+        for proto in range(0, HIGHEST_PROTOCOL + 1):
+            for obj in self.objects:
+                writer = Writer()
+                self.run_async(pickle1.dump_async(obj, writer, proto))
+                self.assertEqual(writer.buffer.getvalue(),
+                                 pickle1._dumps(obj, proto))
+
+    def test_compression_rejected(self):
+        async def main():
+            with self.assertRaises(ValueError):
+                await pickle1.dump_async(1, None, compression="zlib")
+            reader = asyncio.StreamReader()
+            buffer = io.BytesIO()
+            _Pickler(buffer, 4, compression="zlib").dump(1)
+            reader.feed_data(buffer.getvalue())
+            with self.assertRaises(UnpicklingError):
+                await pickle1.load_async(reader)
+        self.run_async(main())
+
+
+class TestTreeMode(unittest.TestCase):
+    """Test Pickler(tree=True), which memoizes nothing"""
+
+    memo_ops = {"PUT", "BINPUT", "LONG_BINPUT", "MEMOIZE",
+                "GET", "BINGET", "LONG_BINGET"}
+
+    def dumps(self, cls, obj, proto, **kwargs):
+        buffer = io.BytesIO()
+        cls(buffer, proto, tree=True, **kwargs).dump(obj)
+        return buffer.getvalue()
+
+    def test_no_memo(self):
+        import pickletools
+        shared = [1, "two"]
+        obj = {"a": [shared, shared], "b": (3.5, "x" * 300),
+               "c": [Record(1, "r", 1.0), TestClass(2)], "d": pickle1.PickleError}
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(HIGHEST_PROTOCOL + 1):
+                data = self.dumps(cls, obj, proto)
+                ops = {op.name for op, _, _ in pickletools.genops(data)}
+                self.assertFalse(ops & self.memo_ops)
+                unpickler = pickle1._Unpickler(io.BytesIO(data))
+                loaded = unpickler.load()
+                self.assertEqual(loaded["a"], [shared, shared])
+                self.assertIsNot(loaded["a"][0], loaded["a"][1])
+                self.assertEqual(loaded["c"][0], Record(1, "r", 1.0))
+                self.assertEqual(loaded["c"][1].value, 2)
+                self.assertEqual(unpickler.memo, {})
+
+    def test_cycles(self):
+        l = [1]
+        l.append([l])
+        record = TestClass(1)
+        record.value = {"self": record}
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(HIGHEST_PROTOCOL + 1):
+                for obj in (l, record):
+                    with self.assertRaisesRegex(pickle1.PicklingError,
+                                                "contains itself"):
+                        self.dumps(cls, obj, proto)
+
+    def test_deep_tree(self):
+        deep = inner = []
+        for _ in range(150):
+            inner.append([])
+            inner = inner[0]
+        for cls in (_Pickler, pickle1._IterativePickler):
+            buffer = io.BytesIO()
+            pickler = cls(buffer, tree=True)
+            pickler.dump(deep)
+            deep.append(deep)
+            with self.assertRaises(pickle1.PicklingError):
+                pickler.dump(deep)
+            deep.pop()
+            pickler.dump(deep)
+            self.assertEqual(pickler._fast_path, set())
+            self.assertEqual(pickle1._loads(buffer.getvalue()), deep)
+
+    def test_fast_attribute(self):
+        buffer = io.BytesIO()
+        pickler = _Pickler(buffer, 4)
+        pickler.fast = True
+        pickler.dump(["a", "a"])
+        self.assertNotIn(pickle1.MEMOIZE, buffer.getvalue())
+        pickler.fast = False
+        pickler.dump(["a", "a"])
+        self.assertIn(pickle1.MEMOIZE, buffer.getvalue())
+        with self.assertRaises(ValueError):
+            _Pickler(buffer, tree=True, dedup=10)
+
+
+class FreshPair:
+    # Reduces to a pair of one list made anew on each call.
+    def __reduce__(self):
+        x = []
+        return (tuple, ((x, x),))
+
+class FreshCycle:
+    # Reduces to a list made anew on each call, which contains itself.
+    def __reduce__(self):
+        x = []
+        x.append(x)
+        return (list, (x,))
+
+class TestSharedOnly(unittest.TestCase):
+    """Test Pickler(shared_only=True), which memoizes only shared objects"""
+
+    def make(self):
+        shared = [1, "s"]
+        inner = []
+        recursive = (inner,)
+        inner.append(recursive)
+        record = TestClass(None)
+        record.value = {"self": record}
+        return {"a": [shared, shared, "x" * 300, "x" * 300],
+                "b": [TestClass(1), TestClass(shared), Record(1, "r", 1.0)],
+                "c": recursive, "d": record, "e": OrderedDict(a=shared),
+                "f": (1, 2, shared), "g": frozenset([3]), "h": bytearray(3)}
+
+    def check(self, loaded):
+        self.assertIs(loaded["a"][0], loaded["a"][1])
+        self.assertIs(loaded["b"][1].value, loaded["a"][0])
+        self.assertIs(loaded["e"]["a"], loaded["a"][0])
+        self.assertIs(loaded["f"][2], loaded["a"][0])
+        self.assertIs(loaded["c"][0][0], loaded["c"])
+        self.assertIs(loaded["d"].value["self"], loaded["d"])
+        self.assertEqual(loaded["b"][2], Record(1, "r", 1.0))
+
+    def test_round_trip(self):
+        obj = self.make()
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(HIGHEST_PROTOCOL + 1):
+                buffer = io.BytesIO()
+                full_pickler = cls(buffer, proto)
+                full_pickler.dump(obj)
+                full = buffer.getvalue()
+                buffer = io.BytesIO()
+                pickler = cls(buffer, proto, shared_only=True)
+                pickler.dump(obj)
+                data = buffer.getvalue()
+                self.assertLess(len(data), len(full))
+                unpickler = _Unpickler(io.BytesIO(data))
+                self.check(unpickler.load())
+                self.assertEqual(len(unpickler.memo), len(pickler.memo))
+                # the shared list, its class, "s" and the two recursive
+                # objects at least, and what reducers make anew, but not
+                # the unshared containers
+                self.assertLess(len(unpickler.memo),
+                                len(full_pickler.memo) // 2)
+
+    def test_session_and_buffers(self):
+        session = pickle1.PicklerSession(4, shared_only=True)
+        for _ in range(2):
+            self.check(pickle1._loads(session.dumps(self.make())))
+        buffers = []
+        buffer = io.BytesIO()
+        obj = [pickle1.PickleBuffer(b"abc"), "t", "t"]
+        _Pickler(buffer, 5, shared_only=True,
+                 buffer_callback=buffers.append).dump(obj)
+        self.assertEqual(len(buffers), 1)
+        loaded = pickle1._loads(buffer.getvalue(), buffers=buffers)
+        self.assertEqual(bytes(loaded[0]), b"abc")
+
+    def test_invalid(self):
+        buffer = io.BytesIO()
+        with self.assertRaises(ValueError):
+            _Pickler(buffer, shared_only=True, tree=True)
+        with self.assertRaises(ValueError):
+            _Pickler(buffer, shared_only=True, dedup=10)
+        with self.assertRaises(ValueError):
+            _Pickler(buffer, shared_only=True).dump_iter([1])
+
+    def test_objects_made_by_reduce(self):
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(HIGHEST_PROTOCOL + 1):
+                buffer = io.BytesIO()
+                cls(buffer, proto, shared_only=True).dump(
+                    [FreshPair(), FreshCycle()])
+                pair, cycle = pickle1._loads(buffer.getvalue())
+                self.assertIs(pair[0], pair[1])
+                self.assertIs(cycle[0][0], cycle[0])
+
+    def test_size(self):
+        obj = self.make()
+        for proto in range(HIGHEST_PROTOCOL + 1):
+            buffer = io.BytesIO()
+            _Pickler(buffer, proto, shared_only=True).dump(obj)
+            size = len(buffer.getvalue())
+            self.assertEqual(
+                pickle1.estimate_size(obj, proto, shared_only=True), size)
+            report = pickle1.size_report(obj, proto, shared_only=True)
+            self.assertEqual(report.total, size)
+        for obj in ([str(i) for i in range(3000)], {"a": ["x", "y"] * 600}):
+            for proto in range(HIGHEST_PROTOCOL + 1):
+                buffer = io.BytesIO()
+                _Pickler(buffer, proto, shared_only=True).dump(obj)
+                self.assertEqual(
+                    pickle1.estimate_size(obj, proto, shared_only=True),
+                    len(buffer.getvalue()))
+
+
+class TestProfile(unittest.TestCase):
+    """Test the profile=True counters of Pickler and Unpickler"""
+
+    obj = [{"id": i, "tags": ["a", b"x" * 10], "o": OrderedDict(a=i)}
+           for i in range(50)]
+
+    def test_pickler(self):
+        for cls in (_Pickler, pickle1._IterativePickler):
+            for proto in range(HIGHEST_PROTOCOL + 1):
+                buffer = io.BytesIO()
+                pickler = cls(buffer, proto, profile=True)
+                pickler.dump(self.obj)
+                data = buffer.getvalue()
+                expected = io.BytesIO()
+                cls(expected, proto).dump(self.obj)
+                self.assertEqual(data, expected.getvalue())
+                types = pickler.profile.types
+                self.assertEqual(types["builtins.dict"]["calls"], 50)
+                self.assertEqual(types["builtins.list"]["calls"], 51)
+                self.assertEqual(types["collections.OrderedDict"]["calls"],
+                                 50)
+                # Everything but PROTO, STOP and frame headers is owned
+                # by some type, and the root list holds all of it.
+                own = sum(c["own_bytes"] for c in types.values())
+                self.assertLessEqual(len(data) - own, 30)
+                self.assertGreaterEqual(len(data) - own, 1)
+                self.assertGreaterEqual(types["builtins.list"]["bytes"], own)
+                for counters in types.values():
+                    self.assertGreaterEqual(counters["time"],
+                                            counters["own_time"])
+
+    def test_failed_dump(self):
+        class Failing:
+            # Fails in its own save, after the saves of some items.
+            def __reduce__(self):
+                def items():
+                    yield from range(1000)
+                    raise ValueError("no more items")
+                return (list, (), None, items())
+
+        for cls in (_Pickler, pickle1._IterativePickler):
+            pickler = cls(io.BytesIO(), 4, profile=True)
+            with self.assertRaises(ValueError):
+                pickler.dump([1, [Failing()]])
+            pickler.dump(self.obj)
+            # The root save reports to a fresh top level, not to the
+            # list that was being saved when the first dump failed.
+            fresh = cls(io.BytesIO(), 4, profile=True)
+            fresh.dump(self.obj)
+            self.assertEqual(pickler.profile._children[0],
+                             fresh.profile._children[0])
+
+    def test_unpickler(self):
+        data = pickle1._dumps(self.obj, 4)
+        unpickler = _Unpickler(io.BytesIO(data), profile=True)
+        self.assertEqual(unpickler.load(), self.obj)
+        profile = unpickler.profile
+        opcodes = profile.opcodes
+        self.assertEqual(opcodes["STOP"]["count"], 1)
+        self.assertEqual(opcodes["EMPTY_DICT"]["count"], 50)
+        self.assertEqual(profile.memo_peak, len(unpickler.memo))
+        self.assertGreaterEqual(profile.stack_peak, 1)
+        self.assertGreaterEqual(profile.mark_peak, 2)
+        self.assertEqual(profile.types, {})
+        loaded = json.loads(profile.to_json())
+        self.assertEqual(loaded["opcodes"]["STOP"]["count"], 1)
+        self.assertEqual(loaded["memo_peak"], profile.memo_peak)
+        self.assertIsNone(_Unpickler(io.BytesIO(data)).profile)
+        self.assertNotIn("dispatch", vars(_Unpickler(io.BytesIO(data))))
+
+    def test_shared_only_not_counted_twice(self):
+        pickler = _Pickler(io.BytesIO(), 4, profile=True, shared_only=True)
+        pickler.dump(self.obj)
+        self.assertEqual(pickler.profile.types["builtins.dict"]["calls"], 50)
+
+
+class TestSizeReport(unittest.TestCase):
+    """Test size_report and SizeReport"""
+
+    def make(self):
+        return {"small": [Record(i, "s", 0.5) for i in range(30)],
+                "big": [Record(i, "b", 1.5, bytes([i]) * 3000) for i in range(5)],
+                "rows": [Row(i, [str(i)] * 10) for i in range(20)]}
+
+    def test_totals(self):
+        obj = self.make()
+        for proto in range(3, HIGHEST_PROTOCOL + 1):
+            report = pickle1.size_report(obj, proto)
+            self.assertEqual(report.total, len(pickle1._dumps(obj, proto)))
+            attributed = sum(report.paths.values())
+            self.assertEqual(sum(report.types.values()), attributed)
+            self.assertLess(report.total - attributed, 20)
+            path = ("builtins.dict;builtins.list;%s.Record;builtins.dict;"
+                    "builtins.bytes" % Record.__module__)
+            self.assertGreater(report.paths[path], 15000)
+            self.assertEqual(max(report.types, key=report.types.get),
+                             "builtins.bytes")
+
+    def test_bounded(self):
+        obj = self.make()
+        full = pickle1.size_report(obj, 4)
+        for max_paths in (1, 3, 8):
+            report = pickle1.size_report(obj, 4, max_paths=max_paths)
+            # The root path is never folded.
+            self.assertLessEqual(len(report.paths), max_paths + 1)
+            self.assertEqual(sum(report.paths.values()),
+                             sum(full.paths.values()))
+            self.assertEqual(report.types, full.types)
+        with self.assertRaises(ValueError):
+            pickle1.size_report(obj, max_paths=0)
+
+    def test_write_collapsed(self):
+        report = pickle1.size_report(self.make(), 4)
+        out = io.StringIO()
+        report.write_collapsed(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), len(report.paths))
+        sizes = []
+        for line in lines:
+            path, size = line.rsplit(" ", 1)
+            self.assertEqual(report.paths[path], int(size))
+            sizes.append(int(size))
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+
+
+class SafeUnpickler(_Unpickler):
+    # Finds only the globals of the pickles that are fuzzed below.
+    allowed = {("collections", "OrderedDict"), ("builtins", "set"),
+               ("__builtin__", "set"), ("builtins", "frozenset"),
+               ("__builtin__", "frozenset"), ("builtins", "object"),
+               ("__builtin__", "object"), ("copyreg", "_reconstructor"),
+               ("copy_reg", "_reconstructor"), ("_codecs", "encode")}
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle1.UnpicklingError("%s.%s is not allowed"
+                                          % (module, name))
+        return super().find_class(module, name)
+
+class TestBufferLoads(unittest.TestCase):
+    """Test the in-memory path of loads"""
+
+    def objects(self):
+        shared = [1]
+        recursive = []
+        recursive.append(recursive)
+        return [None, True, False, 255, 65535, -2**31, 2**70, 1.5, "",
+                "\xe9" * 100, "y" * 300, "\ud800", b"z" * 300, bytearray(3),
+                (), (1,), (1, 2), (1, 2, 3), (1, 2, 3, 4), {"a": [2, (3,)]},
+                {1, 2}, frozenset([3]), OrderedDict(a=1), TestClass(2),
+                [Record(i, "s%d" % (i % 3), 0.5) for i in range(300)],
+                list(range(1000)), {str(i): i for i in range(300)},
+                [shared, shared, (shared,)], recursive, pickle1.PickleError]
+
+    def file_load(self, data):
+        return _Unpickler(io.BytesIO(data)).load()
+
+    def test_same_objects(self):
+        import array
+        for proto in range(HIGHEST_PROTOCOL + 1):
+            for obj in self.objects():
+                data = pickle1._dumps(obj, proto)
+                expected = pickle1._dumps(self.file_load(data), proto)
+                for convert in (bytes, bytearray, memoryview,
+                                lambda b: array.array('B', b)):
+                    result = pickle1._loads(convert(data))
+                    self.assertEqual(pickle1._dumps(result, proto), expected)
+
+    def test_mmap(self):
+        import mmap
+        data = pickle1._dumps(self.objects(), 4)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                self.assertEqual(pickle1._dumps(pickle1._loads(m), 4),
+                                 pickle1._dumps(self.file_load(data), 4))
+
+    def outcome(self, load, data):
+        # The repr of what load(data) returns, or the type of what it
+        # raises.
+        try:
+            return repr(load(data))
+        except Exception as e:
+            return type(e)
+
+    def check_same_outcome(self, data):
+        import array
+        expected = self.outcome(
+            lambda data: SafeUnpickler(io.BytesIO(data)).load(), data)
+        for convert in (bytes, bytearray, memoryview,
+                        lambda b: array.array('B', b)):
+            result = self.outcome(
+                lambda data: SafeUnpickler(io.BytesIO())._load_buffer(
+                    convert(data)), data)
+            self.assertEqual(result, expected, data)
+
+    def test_errors(self):
+        for proto in range(HIGHEST_PROTOCOL + 1):
+            data = pickle1._dumps({"a": [1, 2.5, "b" * 300]}, proto)
+            for cut in range(len(data)):
+                self.check_same_outcome(data[:cut])
+        with self.assertRaisesRegex(pickle1.UnpicklingError,
+                                    "Memo value not found"):
+            pickle1._loads(b"\x80\x04h\x05.")
+        with self.assertRaises(IndexError):
+            pickle1._loads(b"\x80\x04e.")
+
+    def test_same_errors_as_file_load(self):
+        frame = b"N\x95" + pack("<Q", 1) + b"N"
+        for data in (b"\x80\x04}(K\x01u.", b"\x80\x04}(K\x01K\x02K\x03u.",
+                     b"\x80\x04\x95" + pack("<Q", len(frame)) + frame + b"."):
+            with self.assertRaises(Exception) as file_error:
+                self.file_load(data)
+            with self.assertRaises(type(file_error.exception)) as error:
+                pickle1._loads(data)
+            self.assertEqual(str(error.exception),
+                             str(file_error.exception))
+
+    def test_fuzzed(self):
+        import random
+        rng = random.Random(1234)
+        obj = [None, True, 1, 300, -70000, 2**70, 1.5, "", "s", "\xe9" * 3,
+               "t" * 300, b"b", b"c" * 300, (), (1,), (1, 2), (1, 2, 3),
+               (1, 2, 3, 4), {"k": [1, "v"]}, {1, 2}, frozenset([3]),
+               OrderedDict(a=1), [[]] * 3, list(range(30))]
+        pickles = [pickle1._dumps(obj, proto)
+                   for proto in range(HIGHEST_PROTOCOL + 1)]
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, frame_size=40).dump(obj)
+        pickles.append(buffer.getvalue())
+        for _ in range(3000):
+            data = bytearray(rng.choice(pickles))
+            for _ in range(rng.randint(1, 3)):
+                i = rng.randrange(len(data))
+                kind = rng.randrange(5)
+                if kind == 0:
+                    data[i] = rng.randrange(256)
+                elif kind == 1:
+                    del data[i]
+                elif kind == 2:
+                    data.insert(i, rng.randrange(256))
+                elif kind == 3:
+                    del data[i:]
+                else:
+                    # Change the size of a frame.
+                    i = data.find(pickle1.FRAME, i)
+                    if 0 <= i <= len(data) - 9:
+                        size = int.from_bytes(data[i + 1:i + 9], "little")
+                        size = max(size + rng.randint(-12, 12), 0)
+                        data[i + 1:i + 9] = size.to_bytes(8, "little")
+                if not data:
+                    data.append(0x2e)
+            self.check_same_outcome(bytes(data))
+
+    def test_bytearray_truncated(self):
+        # The first array is in a frame, the second is too big for one.
+        small = pickle1._dumps(bytearray(b"abc" * 100), 5)
+        big = pickle1._dumps(bytearray(b"abc" * 100000), 5)
+        for loaded in (small[:-5], big[:-5]):
+            for load in (pickle1._loads,
+                         lambda d: _Unpickler(io.BytesIO(d)).load()):
+                with self.assertRaises(pickle1.UnpicklingError):
+                    load(loaded)
+
+    def test_buffer_released(self):
+        data = bytearray(pickle1._dumps([1, "a"], 5))
+        self.assertEqual(pickle1._loads(data), [1, "a"])
+        data.extend(b"more")
+
+    def test_file_path_cases(self):
+        obj = {"a": list(range(100))}
+        buffer = io.BytesIO()
+        _Pickler(buffer, 4, compression="zlib").dump(obj)
+        self.assertEqual(pickle1._loads(buffer.getvalue()), obj)
+        session = pickle1.UnpicklerSession(profile=True)
+        self.assertEqual(session.loads(pickle1._dumps(obj, 4)), obj)
+        profile = session._unpickler.profile
+        self.assertEqual(profile.opcodes["STOP"]["count"], 1)
+
+
 if __name__ == "__main__":
     unittest.main()
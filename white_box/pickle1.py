@@ -23,21 +23,35 @@ Misc variables:
 
 """
 
-from types import FunctionType
-from copyreg import dispatch_table
+from types import FunctionType, GetSetDescriptorType
+from copyreg import dispatch_table, __newobj__, _slotnames
 from copyreg import _extension_registry, _inverted_registry, _extension_cache
-from itertools import islice
+from itertools import islice, accumulate, chain, repeat
+from operator import attrgetter, is_
+from bisect import bisect_left
 from functools import partial
+from array import array
+import os
+import mmap
 import sys
 from sys import maxsize
-from struct import pack, unpack
+from struct import Struct, calcsize, pack, unpack
 import re
 import io
 import codecs
+import weakref
+import threading
+from time import perf_counter
 import _compat_pickle
 
 __all__ = ["PickleError", "PicklingError", "UnpicklingError", "Pickler",
-           "Unpickler", "dump", "dumps", "load", "loads"]
+           "Unpickler", "dump", "dumps", "load", "loads",
+           "RecordWriter", "RecordReader", "dump_sharded", "load_sharded",
+           "dump_oob", "load_oob", "TeeSink", "HashSink", "CountingSink",
+           "CompressingSink", "pickle_digest", "estimate_size",
+           "PicklerSession", "UnpicklerSession",
+           "dump_async", "load_async", "PickleProfile", "size_report",
+           "SizeReport"]
 
 try:
     from _pickle import PickleBuffer
@@ -190,41 +204,97 @@ READONLY_BUFFER  = b'\x98'  # make top of stack readonly
 
 __all__.extend([x for x in dir() if re.match("[A-Z][A-Z0-9_]+$", x)])
 
+# Preencoded BININT1 opcodes and precompiled struct formats used by the
+# pickler's fast paths.
+_BININT1_OPS = [BININT1 + bytes((i,)) for i in range(256)]
+_SHORT_BINUNICODE_OPS = [SHORT_BINUNICODE + bytes((i,)) for i in range(256)]
+_pack_double = Struct('>d').pack
+_pack_binint = Struct('<ci').pack
+_pack_binint2 = Struct('<cH').pack
+_pack_binfloat = Struct('>cd').pack
+
+# Argument decoders of the unpickler's in-memory fast path.
+_unpack_int4 = Struct('<i').unpack_from
+_unpack_uint2 = Struct('<H').unpack_from
+_unpack_uint8 = Struct('<Q').unpack_from
+_unpack_float8 = Struct('>d').unpack_from
+
 
 class _Framer:
 
     _FRAME_SIZE_MIN = 4
     _FRAME_SIZE_TARGET = 64 * 1024
 
-    def __init__(self, file_write):
+    def __init__(self, file_write, file=None, frame_size=None):
         self.file_write = file_write
         self.current_frame = None
+        if frame_size is not None:
+            self._FRAME_SIZE_TARGET = frame_size
+        # A raw file is written with os.writev(), which copies the data
+        # before returning, and an io.BytesIO copies what it is given
+        # too, so for these a single frame buffer can be reused for every
+        # frame and every dump.  Subclasses of io.FileIO may override
+        # write(), so they go through writelines(), which calls it, as
+        # other files that have writelines() do, getting the frame
+        # opcode and contents in one call.
+        self._fd = None
+        self._writelines = None
+        if type(file) is io.FileIO and hasattr(os, 'writev'):
+            self._fd = file.fileno()
+        elif isinstance(file, io.IOBase):
+            self._writelines = file.writelines
+        self._reuse = self._fd is not None or type(file) is io.BytesIO
+        self._spare_frame = None
 
     def start_framing(self):
-        self.current_frame = io.BytesIO()
+        f = self._spare_frame
+        if f is None:
+            f = io.BytesIO()
+        self._spare_frame = None
+        self.current_frame = f
 
     def end_framing(self):
         if self.current_frame and self.current_frame.tell() > 0:
             self.commit_frame(force=True)
+            if self._reuse:
+                self._spare_frame = self.current_frame
             self.current_frame = None
 
     def commit_frame(self, force=False):
         if self.current_frame:
             f = self.current_frame
-            if f.tell() >= self._FRAME_SIZE_TARGET or force:
+            size = f.tell()
+            if size >= self._FRAME_SIZE_TARGET or force:
+                if self._reuse:
+                    # The reused buffer may hold a longer earlier frame
+                    # past the current position.
+                    with f.getbuffer() as data:
+                        if self._fd is not None:
+                            self._writev(self._frame_header(size),
+                                         data[:size])
+                        else:
+                            self._writelines([self._frame_header(size),
+                                              data[:size]])
+                    f.seek(0)
+                    return
                 data = f.getbuffer()
-                write = self.file_write
-                if len(data) >= self._FRAME_SIZE_MIN:
-                    # Issue a single call to the write method of the underlying
-                    # file object for the frame opcode with the size of the
-                    # frame. The concatenation is expected to be less expensive
-                    # than issuing an additional call to write.
-                    write(FRAME + pack("<Q", len(data)))
-
-                # Issue a separate call to write to append the frame
-                # contents without concatenation to the above to avoid a
-                # memory copy.
-                write(data)
+                if self._writelines is not None:
+                    self._writelines([self._frame_header(size), data])
+                else:
+                    write = self.file_write
+                    # Issue a single call to the write method of the
+                    # underlying file object for the frame opcode with the
+                    # size of the frame. The concatenation is expected to be
+                    # less expensive than issuing an additional call to
+                    # write.
+                    header = self._frame_header(size)
+                    if header:
+                        write(header)
+
+                    # Issue a separate call to write to append the frame
+                    # contents without concatenation to the above to avoid
+                    # a memory copy.
+                    write(data)
 
                 # Start the new frame with a new io.BytesIO instance so that
                 # the file object can have delayed access to the previous frame
@@ -232,6 +302,29 @@ class _Framer:
                 # io.BytesIO instance.
                 self.current_frame = io.BytesIO()
 
+    def _frame_header(self, size):
+        if size >= self._FRAME_SIZE_MIN:
+            return FRAME + pack("<Q", size)
+        return b''
+
+    def _writev(self, *buffers):
+        # os.writev() may write less than it is given; write the rest.
+        fd = self._fd
+        left = sum(map(len, buffers))
+        while left:
+            n = os.writev(fd, buffers)
+            left -= n
+            if not left:
+                break
+            views = []
+            for buf in buffers:
+                if n >= len(buf):
+                    n -= len(buf)
+                else:
+                    views.append(memoryview(buf)[n:])
+                    n = 0
+            buffers = views
+
     def write(self, data):
         if self.current_frame:
             return self.current_frame.write(data)
@@ -250,8 +343,11 @@ class _Framer:
         # temporary bytes object.
         # We intentionally do not insert a protocol 4 frame opcode to make
         # it possible to optimize file.read calls in the loader.
-        write(header)
-        write(payload)
+        if self._fd is not None:
+            self._writev(header, payload)
+        else:
+            write(header)
+            write(payload)
 
 
 class _Unframer:
@@ -266,17 +362,21 @@ class _Unframer:
             n = self.current_frame.readinto(buf)
             if n == 0 and len(buf) != 0:
                 self.current_frame = None
-                n = len(buf)
-                buf[:] = self.file_read(n)
-                return n
+                return self._readinto_file(buf)
             if n < len(buf):
                 raise UnpicklingError(
                     "pickle exhausted before end of frame")
             return n
         else:
-            n = len(buf)
-            buf[:] = self.file_read(n)
-            return n
+            return self._readinto_file(buf)
+
+    def _readinto_file(self, buf):
+        n = len(buf)
+        data = self.file_read(n)
+        if len(data) < n:
+            raise UnpicklingError("pickle data was truncated")
+        buf[:] = data
+        return n
 
     def read(self, n):
         if self.current_frame:
@@ -311,6 +411,160 @@ class _Unframer:
         self.current_frame = io.BytesIO(self.file_read(frame_size))
 
 
+# Compressed framing.  A compressed pickle starts with _COMPRESSED_MAGIC,
+# whose first byte is not an opcode, so that readers that don't support
+# compression reject it at once, and a byte naming the codec.  Then come
+# blocks of compressed pickle data, each preceded by its size as a 4-byte
+# little-endian integer, and a size of 0 after the last block.
+
+_COMPRESSED_MAGIC = b'\xffpk1'
+
+def _compression_codec(name):
+    # Return (codec byte, compress, decompress, compressor) for name,
+    # where compressor makes a streaming compressor object.
+    if name == "zlib":
+        import zlib
+        return b'z', zlib.compress, zlib.decompress, zlib.compressobj
+    if name == "lzma":
+        import lzma
+        return b'x', lzma.compress, lzma.decompress, lzma.LZMACompressor
+    raise ValueError("unknown compression: %r" % (name,))
+
+_COMPRESSION_NAMES = {b'z': "zlib", b'x': "lzma"}
+
+_compression_pool = None
+
+def _get_compression_pool():
+    # zlib and lzma release the GIL, so a thread pool runs them in
+    # parallel with the pickler or unpickler.
+    global _compression_pool
+    if _compression_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _compression_pool = ThreadPoolExecutor(
+            os.cpu_count() or 1, thread_name_prefix="pickle1-compress")
+    return _compression_pool
+
+class _FrameCompressor:
+
+    def __init__(self, file_write, compression, block_size):
+        self.file_write = file_write
+        self.codec, self.compress, _, _ = _compression_codec(compression)
+        self.block_size = block_size
+        self.ahead = 2 * (os.cpu_count() or 1)
+        self.chunks = []
+        self.size = 0
+        self.pending = []
+
+    def begin(self):
+        self.file_write(_COMPRESSED_MAGIC + self.codec)
+
+    def write(self, data):
+        # The framer writes each frame in one or two calls; small writes
+        # outside of frames are gathered into blocks of a useful size.
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        block = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        pending = self.pending
+        pending.append(_get_compression_pool().submit(self.compress, block))
+        if len(pending) > self.ahead:
+            self._write_block(pending.pop(0).result())
+
+    def _write_block(self, data):
+        self.file_write(pack("<I", len(data)))
+        self.file_write(data)
+
+    def end(self):
+        if self.chunks:
+            self._submit()
+        pending = self.pending
+        self.pending = []
+        for future in pending:
+            self._write_block(future.result())
+        self.file_write(pack("<I", 0))
+
+
+class _FrameDecompressor:
+
+    def __init__(self, file_read, codec):
+        try:
+            _, _, self.decompress, _ = _compression_codec(
+                _COMPRESSION_NAMES.get(codec))
+        except ValueError:
+            raise UnpicklingError("unknown pickle compression %r" % codec)
+        self.file_read = file_read
+        self.ahead = 2 * (os.cpu_count() or 1)
+        self.pending = []
+        self.at_end = False
+        self.block = b''
+        self.pos = 0
+
+    def _fill(self):
+        # Keep up to self.ahead blocks being decompressed ahead of reads.
+        pending = self.pending
+        while not self.at_end and len(pending) < self.ahead:
+            header = self.file_read(4)
+            if len(header) < 4:
+                raise UnpicklingError("compressed pickle data was truncated")
+            size, = unpack("<I", header)
+            if not size:
+                self.at_end = True
+                break
+            data = self.file_read(size)
+            if len(data) < size:
+                raise UnpicklingError("compressed pickle data was truncated")
+            pending.append(_get_compression_pool().submit(self.decompress,
+                                                          data))
+
+    def _next_block(self):
+        self._fill()
+        if not self.pending:
+            return False
+        self.block = self.pending.pop(0).result()
+        self.pos = 0
+        return True
+
+    def read(self, n):
+        pos = self.pos
+        end = pos + n
+        if end <= len(self.block):
+            self.pos = end
+            return self.block[pos:end]
+        chunks = [self.block[pos:]]
+        n -= len(chunks[0])
+        while n and self._next_block():
+            chunk = self.block[:n]
+            self.pos = len(chunk)
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    def readline(self):
+        chunks = []
+        while True:
+            i = self.block.find(b'\n', self.pos)
+            if i >= 0:
+                chunks.append(self.block[self.pos:i + 1])
+                self.pos = i + 1
+                break
+            chunks.append(self.block[self.pos:])
+            self.pos = len(self.block)
+            if not self._next_block():
+                break
+        return b''.join(chunks)
+
+    def finish(self):
+        # Consume the rest of the compressed data, up to its end marker.
+        while self._next_block():
+            pass
+
+
 # Tools used for pickling.
 
 def _getattribute(obj, name):
@@ -399,12 +653,348 @@ def decode_long(data):
 
 _NoValue = object()
 
+# Instance attributes that would change how object.__reduce_ex__()
+# reduces an instance of an otherwise plain class.
+_REDUCE_HOOKS = frozenset({"__reduce_ex__", "__reduce__", "__getstate__"})
+
+def _default_build(cls):
+    # True if BUILD can only find a __setstate__() method for an instance
+    # of cls in the instance's own dict.
+    return (getattr(cls, "__setstate__", None) is None
+            and cls.__getattribute__ is object.__getattribute__
+            and not hasattr(cls, "__getattr__"))
+
+def _same_state(a, b):
+    # True if two default states hold the same objects.
+    if type(a) is tuple:
+        return (type(b) is tuple and len(b) == 2 and a[0] is b[0]
+                and a[1].keys() == b[1].keys()
+                and all(v is b[1][k] for k, v in a[1].items()))
+    return a is b
+
+def _discard(data):
+    # A file write() and buffer_callback that keeps nothing.
+    return None
+
+def _cycle_error(obj):
+    # The error for an object met again inside itself in fast mode.
+    return PicklingError("can't pickle %s object at %#x in tree mode: it "
+                         "contains itself" % (type(obj).__name__, id(obj)))
+
+# Process-wide cache of global resolutions shared by picklers that set
+# shared_global_cache: obj -> (qualname, module_name, module, name).
+_global_resolutions = weakref.WeakKeyDictionary()
+
+def _still_bound(obj, module_name, module, qualname):
+    # True if a cached resolution of obj to module.qualname still holds:
+    # the module was not replaced nor the name rebound since.
+    if sys.modules.get(module_name) is not module:
+        return False
+    try:
+        return _getattribute(module, qualname)[0] is obj
+    except AttributeError:
+        return False
+
+# Canonical ordering of set members and dict keys.  Any deterministic
+# total order will do; it need not agree with < where that is defined.
+
+_NATURALLY_ORDERED = frozenset([int, str, bytes])
+
+def _canonical_key(obj, active=frozenset()):
+    # active holds the ids of the objects whose keys are being made by
+    # the callers, which obj may contain.
+    t = type(obj)
+    if t in _NATURALLY_ORDERED or t is bool:
+        return (t.__name__, obj)
+    if t is float:
+        return ('float', _pack_double(obj))
+    if obj is None:
+        return ('None', 0)
+    if t is tuple:
+        return ('tuple', tuple([_canonical_key(x, active) for x in obj]))
+    # Other types are named with a dot, so never equal the names above.
+    name = t.__module__ + '.' + t.__qualname__
+    if id(obj) in active:
+        # Met again inside itself: the cycle is ordered by type alone.
+        return (name, b'')
+    f = io.BytesIO()
+    pickler = _Pickler(f, 4, canonical=True, sort_keys=True)
+    pickler._keying = active | {id(obj)}
+    pickler.dump(obj)
+    return (name, f.getvalue())
+
+# Canonical mode memoizes tuples and frozensets by value.  The key of a
+# value holds the types of its parts, since (1,) == (1.0,) == (True,),
+# and tells apart other objects by identity, as their sharing is part of
+# the value.
+
+_VALUE_KEYED = frozenset([int, str, bytes, bool, type(None)])
+
+def _value_key(obj):
+    t = type(obj)
+    if t in _VALUE_KEYED:
+        return (t, obj)
+    if t is float:
+        return (t, _pack_double(obj))
+    if t is tuple:
+        return (t, tuple(map(_value_key, obj)))
+    if t is frozenset:
+        return (t, frozenset(map(_value_key, obj)))
+    return (None, id(obj))
+
 # Pickling machinery
 
+class _PicklerMemo:
+    """Compact memo table for the Pickler.
+
+    Maps id(obj) to a (memo index, obj) 2-tuple like the dict it stands
+    in for, but stores the ids, indices and objects in flat columns that
+    are addressed through an open-addressing table of positions, so a
+    memoized object costs a few machine words rather than a dict entry,
+    a boxed id, a boxed index and a tuple.  The tuples handed out by
+    get() and [] are built on demand.
+
+    Slots are probed in the same perturbed order as CPython's dicts
+    use, since ids of objects of the same type are evenly spaced and
+    would otherwise pile up in long runs of slots.
+
+    release() drops every entry while len() keeps counting them, so a
+    pickler that forgets what it has written still hands out fresh memo
+    indices.
+    """
+
+    __slots__ = ('_slots', '_ids', '_idxs', '_objs', '_used', '_fill',
+                 '_released')
+
+    _MINSIZE = 8
+    _KEEPSIZE = 1 << 10
+    _DUMMY = -1     # marks a slot whose entry was deleted
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self, keep_size=False):
+        # _slots holds 0 for a free slot, _DUMMY for a deleted one, and
+        # otherwise the position + 1 of an entry in the columns.  With
+        # keep_size a table of up to _KEEPSIZE slots stays at its size,
+        # for a pickler about to save another object like the last.
+        size = self._MINSIZE
+        if keep_size:
+            size = max(size, min(len(self._slots), self._KEEPSIZE))
+        self._slots = array('q', bytes(8 * size))
+        self._ids = array('q')
+        self._idxs = array('q')
+        self._objs = []
+        self._used = 0      # live entries
+        self._fill = 0      # live entries + dummy slots
+        self._released = 0  # entries dropped by release()
+
+    def release(self, keep=None):
+        # Drop every entry, or every entry whose object keep() rejects.
+        total = len(self)
+        if keep is None:
+            self.clear()
+        else:
+            kept = [(key, idx, obj) for key, idx, obj
+                    in zip(self._ids, self._idxs, self._objs)
+                    if key and keep(obj)]
+            self.clear()
+            for key, idx, obj in kept:
+                self[key] = idx, obj
+        self._released = total - self._used
+
+    def __len__(self):
+        return self._used + self._released
+
+    def _find(self, key):
+        # Return the slot holding key, or -1.
+        slots = self._slots
+        ids = self._ids
+        mask = len(slots) - 1
+        i = perturb = key >> 4
+        i &= mask
+        pos = slots[i]
+        while pos:
+            if pos > 0 and ids[pos - 1] == key:
+                return i
+            perturb >>= 5
+            i = (5 * i + perturb + 1) & mask
+            pos = slots[i]
+        return -1
+
+    def get(self, key, default=None):
+        slots = self._slots
+        ids = self._ids
+        mask = len(slots) - 1
+        i = perturb = key >> 4
+        i &= mask
+        pos = slots[i]
+        while pos:
+            if pos > 0 and ids[pos - 1] == key:
+                pos -= 1
+                return self._idxs[pos], self._objs[pos]
+            perturb >>= 5
+            i = (5 * i + perturb + 1) & mask
+            pos = slots[i]
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        slots = self._slots
+        ids = self._ids
+        mask = len(slots) - 1
+        i = perturb = key >> 4
+        i &= mask
+        pos = slots[i]
+        while pos:
+            if pos > 0 and ids[pos - 1] == key:
+                return True
+            perturb >>= 5
+            i = (5 * i + perturb + 1) & mask
+            pos = slots[i]
+        return False
+
+    def __setitem__(self, key, value):
+        idx, obj = value
+        slots = self._slots
+        ids = self._ids
+        mask = len(slots) - 1
+        i = perturb = key >> 4
+        i &= mask
+        free = -1
+        pos = slots[i]
+        while pos:
+            if pos > 0:
+                if ids[pos - 1] == key:
+                    self._idxs[pos - 1] = idx
+                    self._objs[pos - 1] = obj
+                    return
+            elif free < 0:
+                free = i
+            perturb >>= 5
+            i = (5 * i + perturb + 1) & mask
+            pos = slots[i]
+        ids.append(key)
+        self._idxs.append(idx)
+        self._objs.append(obj)
+        self._used += 1
+        if free < 0:
+            slots[i] = len(ids)
+            self._fill = fill = self._fill + 1
+            if fill + fill > mask:
+                self._resize()
+        else:
+            slots[free] = len(ids)
+
+    def __delitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        pos = self._slots[i] - 1
+        self._slots[i] = self._DUMMY
+        self._ids[pos] = 0      # never a valid id
+        self._objs[pos] = None
+        self._used -= 1
+
+    def pop(self, key, *default):
+        value = self.get(key)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self[key]
+        return value
+
+    def _resize(self):
+        # Rebuild the table at a size that keeps it at most 1/4 full,
+        # dropping deleted entries from the columns.
+        if self._used < len(self._ids):
+            live = [p for p, key in enumerate(self._ids) if key]
+            self._ids = array('q', [self._ids[p] for p in live])
+            self._idxs = array('q', [self._idxs[p] for p in live])
+            self._objs = [self._objs[p] for p in live]
+        size = self._MINSIZE
+        while size < 4 * self._used:
+            size <<= 1
+        slots = array('q', bytes(8 * size))
+        mask = size - 1
+        for pos, key in enumerate(self._ids, 1):
+            i = perturb = key >> 4
+            i &= mask
+            while slots[i]:
+                perturb >>= 5
+                i = (5 * i + perturb + 1) & mask
+            slots[i] = pos
+        self._slots = slots
+        self._fill = self._used
+
+    def __iter__(self):
+        return (key for key in self._ids if key)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [(idx, obj) for key, idx, obj
+                in zip(self._ids, self._idxs, self._objs) if key]
+
+    def items(self):
+        return [(key, (idx, obj)) for key, idx, obj
+                in zip(self._ids, self._idxs, self._objs) if key]
+
+    def copy(self):
+        return dict(self.items())
+
+
+class _SharingMemo(_PicklerMemo):
+    """_PicklerMemo that notes the objects it is asked for again.
+
+    Used by the first pass of shared_only mode: an object found by get()
+    or in is one that is saved by reference, so it is added to the
+    shared dict, which maps its id to it.  The memo is kept through the
+    second pass, so that the ids it holds stay those of its objects.
+    """
+
+    __slots__ = ('shared',)
+
+    def __init__(self):
+        super().__init__()
+        self.shared = {}
+
+    def get(self, key, default=None):
+        value = _PicklerMemo.get(self, key)
+        if value is None:
+            return default
+        self.shared[key] = value[1]
+        return value
+
+    def __contains__(self, key):
+        value = _PicklerMemo.get(self, key)
+        if value is None:
+            return False
+        self.shared[key] = value[1]
+        return True
+
+    def seen_once(self, key):
+        # True if the object with id key was memoized and not found
+        # again.  Any other object, such as one made anew by __reduce__()
+        # in the second pass, may be referred to again, and is memoized.
+        return (key not in self.shared
+                and _PicklerMemo.get(self, key) is not None)
+
+
 class _Pickler:
 
     def __init__(self, file, protocol=None, *, fix_imports=True,
-                 buffer_callback=None):
+                 buffer_callback=None, frame_size=None, dedup=None,
+                 compression=None, canonical=False, sort_keys=False,
+                 specialize=False, tree=False, shared_only=False,
+                 profile=False, compact_memo=False):
         """This takes a binary file for writing a pickle data stream.
 
         The optional *protocol* argument tells the pickler to use the
@@ -437,6 +1027,59 @@ class _Pickler:
 
         It is an error if *buffer_callback* is not None and *protocol*
         is None or smaller than 5.
+
+        The optional *frame_size* argument sets the size, in bytes, at
+        which a protocol 4 frame is written out; it defaults to 64 KiB.
+
+        If *dedup* is a positive integer, str and bytes objects and small
+        tuples of str, bytes, int, bool and None are also memoized by
+        value: an object equal to one already written is written as a
+        reference to it, so equal values come back as a single object.
+        Up to *dedup* distinct values are remembered, the least recently
+        used being forgotten first.
+
+        If *compression* is "zlib" or "lzma", each dump is written in
+        compressed blocks of about a frame each, which are compressed on
+        a pool of threads while pickling goes on.  Only this module's
+        Unpickler can read the result.
+
+        If *canonical* is true, equal objects are pickled to identical
+        bytes: set and frozenset members are written in a fixed order,
+        and equal str, bytes, tuple and frozenset values are shared
+        however many objects hold them.  Sharing of other objects is
+        kept, as it is part of the value.  If *sort_keys* is also true,
+        the items of dicts, and of dict subclasses whose equality ignores
+        order, are written in key order too rather than in insertion
+        order.
+
+        If *specialize* is true, a save function is made for each plain
+        class, slotted class or named tuple after its first instance in
+        a dump, for the fields that instance had.  Later instances with
+        the same fields are saved by it much faster, to the same bytes.
+
+        If *tree* is true, nothing is memoized: no PUT or MEMOIZE opcode
+        is written, and an object reached twice is written twice and
+        loaded as two objects.  This suits data shaped as a tree, which
+        then needs no memo to pickle or to load.  An object that
+        contains itself raises PicklingError.  Setting the *fast*
+        attribute to true turns on the same mode.
+
+        If *shared_only* is true, each dump first pickles the object to
+        nowhere to find the objects that are reached more than once, and
+        then memoizes only those, and the objects that reduce methods
+        make anew in the second pass, so the pickle is smaller and the
+        Unpickler's memo only grows with the number of shared objects.
+        persistent_id(), reducer_override() and the reduce methods of
+        the objects are called in both passes.
+
+        If *profile* is true, every dump adds the calls, bytes written and
+        time spent saving objects of each type to the PickleProfile in
+        the pickler's *profile* attribute, which is otherwise None.
+
+        If *compact_memo* is true, the memo is kept in a table that takes
+        about a third of the memory of the dict used otherwise, for
+        pickles of many objects, but is slower to use.  It is needed by
+        dump_iter() and dump_items() with *forget*.
         """
         if protocol is None:
             protocol = DEFAULT_PROTOCOL
@@ -446,19 +1089,69 @@ class _Pickler:
             raise ValueError("pickle protocol must be <= %d" % HIGHEST_PROTOCOL)
         if buffer_callback is not None and protocol < 5:
             raise ValueError("buffer_callback needs protocol >= 5")
+        if frame_size is not None and frame_size < 1:
+            raise ValueError("frame_size must be a positive integer")
+        if dedup is not None and dedup < 1:
+            raise ValueError("dedup must be a positive integer")
+        if canonical and dedup is not None:
+            raise ValueError("dedup can't be combined with canonical, "
+                             "which shares every equal value")
+        if tree and (dedup is not None or canonical):
+            raise ValueError("tree can't be combined with dedup or "
+                             "canonical, which share objects")
+        if shared_only and (tree or dedup is not None or canonical):
+            raise ValueError("shared_only can't be combined with tree, "
+                             "dedup or canonical")
         self._buffer_callback = buffer_callback
         try:
             self._file_write = file.write
         except AttributeError:
             raise TypeError("file must have a 'write' attribute")
-        self.framer = _Framer(self._file_write)
+        if compression is not None:
+            self._compressor = _FrameCompressor(
+                self._file_write, compression,
+                frame_size or _Framer._FRAME_SIZE_TARGET)
+            self.framer = _Framer(self._compressor.write, None, frame_size)
+        else:
+            self._compressor = None
+            self.framer = _Framer(self._file_write, file, frame_size)
         self.write = self.framer.write
         self._write_large_bytes = self.framer.write_large_bytes
-        self.memo = {}
+        self.profile = None
+        if profile:
+            self.profile = PickleProfile()
+            self.write = self._write_counted
+            self._write_large_bytes = self._write_large_bytes_counted
+        self.memo = _PicklerMemo() if compact_memo else {}
+        # Counts the clearings of the memo, which invalidate the memo
+        # references held by specialized savers.
+        self._memo_epoch = 0
         self.proto = int(protocol)
         self.bin = protocol >= 1
-        self.fast = 0
+        self.fast = 1 if tree else 0
+        # Nesting depth and the ids of the objects being saved past
+        # _FAST_NESTING_LIMIT, for the cycle check of fast mode.
+        self._fast_nesting = 0
+        self._fast_path = set()
+        self._shared_only = bool(shared_only)
+        # The _SharingMemo of the first pass, in shared_only mode.
+        self._shared = None
         self.fix_imports = fix_imports and protocol < 3
+        self._leaf_savers = None
+        self._run_types = frozenset()
+        self._stock_tuple = False
+        self._global_cache = {}
+        self._plain_types = {}
+        self._specialize = specialize
+        self._class_savers = None
+        # Value -> the first object with that value, for dedup mode.
+        self._values = {} if dedup is not None or canonical else None
+        self._values_max = dedup or maxsize
+        self._canonical = bool(canonical)
+        self._sort_keys = bool(canonical and sort_keys)
+        # The ids of the objects whose _canonical_key() this pickler is
+        # making, if any.
+        self._keying = frozenset()
 
     def clear_memo(self):
         """Clears the pickler's "memo".
@@ -469,26 +1162,179 @@ class _Pickler:
         useful when re-using picklers.
         """
         self.memo.clear()
+        self._memo_epoch += 1
+        if self._values is not None:
+            self._values.clear()
 
     def dump(self, obj):
         """Write a pickled representation of obj to the open file."""
+        # Check whether Pickler was initialized correctly. This is
+        # only needed to mimic the behavior of _pickle.Pickler.dump().
+        self._begin_dump()
+        self._save_root(obj)
+        self._end_dump()
+
+    def dump_iter(self, iterable, *, forget=False):
+        """Write a pickled list of the items produced by iterable.
+
+        The items are pulled from the iterable one batch at a time and
+        written as they come, so the list is never built in memory.  The
+        output is the same as that of dump(list(iterable)).
+
+        If *forget* is true, the memo is released after every batch so
+        that memory use stays bounded however many items are written;
+        an object shared by items of different batches is then written
+        once per batch and is no longer shared when loaded.  This needs
+        a Pickler made with *compact_memo*.
+        """
+        self._dump_stream(EMPTY_LIST, LIST, [], self._batch_appends,
+                          iterable, forget)
+
+    def dump_items(self, iterable, *, forget=False):
+        """Write a pickled dict of the (key, value) pairs from iterable.
+
+        This is dump_iter() for dicts: the output is the same as that of
+        dump(dict(iterable)) as long as the keys are unique.
+        """
+        self._dump_stream(EMPTY_DICT, DICT, {}, self._batch_setitems,
+                          iterable, forget)
+
+    def _begin_dump(self, select=True):
         # Check whether Pickler was initialized correctly. This is
         # only needed to mimic the behavior of _pickle.Pickler.dump().
         if not hasattr(self, "_file_write"):
             raise PicklingError("Pickler.__init__() was not called by "
                                 "%s.__init__()" % (self.__class__.__name__,))
+        if self._compressor is not None:
+            self._compressor.begin()
         if self.proto >= 2:
             self.write(PROTO + pack("<B", self.proto))
         if self.proto >= 4:
             self.framer.start_framing()
-        self.save(obj)
+        if select:
+            self._select_save()
+        # Classes may have been changed since the last dump.
+        self._plain_types.clear()
+        if self._class_savers is not None:
+            self._class_savers.clear()
+        # Left over if the last dump failed.
+        self._fast_nesting = 0
+        self._fast_path.clear()
+        self._shared = None
+        if self.profile is not None:
+            self.profile._children = [0, 0.0]
+
+    def _end_dump(self):
+        self._shared = None
         self.write(STOP)
         self.framer.end_framing()
+        if self._compressor is not None:
+            self._compressor.end()
+
+    def _save_root(self, obj):
+        # save() the object being dumped, after finding the objects to
+        # memoize in shared_only mode.
+        if self._shared_only:
+            self._shared = self._find_shared(obj)
+        self.save(obj)
+
+    def _find_shared(self, obj):
+        # Save obj with a memo that notes the objects found in it again,
+        # writing nothing, and return that memo.  Both passes memoize an
+        # object at the same point, so a later reference to it in the
+        # first pass is one the second pass must write as a GET.
+        saved = (self.memo, self.framer, self.write,
+                 self._write_large_bytes, self._buffer_callback,
+                 self.profile)
+        # Nor is it profiled.
+        self.profile = None
+        self.memo = memo = _SharingMemo()
+        self.framer = self._discarding_framer()
+        self.write = self.framer.write
+        self._write_large_bytes = self.framer.write_large_bytes
+        if self._buffer_callback is not None:
+            self._buffer_callback = _discard
+        try:
+            self.save(obj)
+        finally:
+            (self.memo, self.framer, self.write,
+             self._write_large_bytes, self._buffer_callback,
+             self.profile) = saved
+        return memo
+
+    def _discarding_framer(self):
+        # A framer for _find_shared() that writes nothing.
+        return _Framer(_discard)
+
+    def _dump_stream(self, empty, opcode, container, batch, iterable,
+                     forget):
+        if self._shared_only:
+            raise ValueError("shared_only needs the whole object to dump")
+        if forget and not isinstance(self.memo, _PicklerMemo):
+            raise ValueError("forget needs a Pickler made with "
+                             "compact_memo=True")
+        it = iter(iterable)
+        self._begin_dump()
+        # container stands in for the one that dump() would memoize.
+        self._open_container(container, empty, opcode)
+        while True:
+            items = list(islice(it, self._BATCHSIZE))
+            batch(items)
+            if forget:
+                self.memo.release()
+                self._memo_epoch += 1
+            if len(items) < self._BATCHSIZE:
+                break
+        self._end_dump()
+
+    def _memo_by_value(self, obj, key):
+        # Return the memo entry of an earlier object equal to obj, or
+        # None after recording obj as the object to refer to for its
+        # value.  The table is kept in least recently used order.
+        values = self._values
+        prev = values.pop(key, None)
+        if prev is not None:
+            x = self.memo.get(id(prev))
+            if x is not None:
+                values[key] = prev
+                return x
+        values[key] = obj
+        if len(values) > self._values_max:
+            del values[next(iter(values))]
+        return None
+
+    # Tuples memoized by value in dedup mode hold at most this many
+    # elements, all of these types.  The element types are part of the
+    # key, since (1,) == (1.0,) == (True,).
+    _DEDUP_TUPLE_MAX = 8
+    _DEDUP_TUPLE_ITEMS = frozenset([str, bytes, int, bool, type(None)])
+
+    def _save_tuple_by_value(self, obj):
+        # The dedup and canonical mode check of save_tuple(); True if obj
+        # was written.
+        if self._canonical:
+            return self._save_by_value(obj, _value_key(obj))
+        if len(obj) > self._DEDUP_TUPLE_MAX:
+            return False
+        types = tuple(map(type, obj))
+        if not self._DEDUP_TUPLE_ITEMS.issuperset(types):
+            return False
+        return self._save_by_value(obj, (obj, types))
+
+    def _save_by_value(self, obj, key):
+        # Write a reference to an earlier object with obj's value and
+        # return True, or return False.
+        x = self._memo_by_value(obj, key)
+        if x is None:
+            return False
+        self.write(self.get(x[0]))
+        return True
 
     def memoize(self, obj):
         """Store an object in the memo."""
 
-        # The Pickler memo is a dictionary mapping object ids to 2-tuples
+        # The Pickler memo is a dictionary (or a _PicklerMemo with
+        # compact_memo) mapping object ids to 2-tuples
         # that contain the Unpickler memo key and the object being memoized.
         # The memo key is written to the pickle and will become
         # the key in the Unpickler's memo.  The object is stored in the
@@ -502,6 +1348,8 @@ class _Pickler:
         # growable) array, indexed by memo key.
         if self.fast:
             return
+        if self._shared is not None and self._shared.seen_once(id(obj)):
+            return
         assert id(obj) not in self.memo
         idx = len(self.memo)
         self.write(self.put(idx))
@@ -557,36 +1405,293 @@ class _Pickler:
             if f is not None:
                 f(self, obj)  # Call unbound method with explicit self
                 return
+            self._save_by_reduce(obj, t)
+            return
+
+        self._save_reduce_value(obj, rv, reduce)
+
+    def _save_streamlined(self, obj, save_persistent_id=True):
+        # Installed as self.save by _select_save() when neither
+        # persistent_id() nor reducer_override() is overridden, so the
+        # reducer_override() lookup can be skipped.  Builtin leaves that
+        # are never memoized are looked up first and encoded without
+        # touching the memo.
+        self.framer.commit_frame()
+
+        if save_persistent_id:
+            pid = self.persistent_id(obj)
+            if pid is not None:
+                self.save_pers(pid)
+                return
+
+        t = type(obj)
+        f = self._leaf_savers.get(t)
+        if f is not None:
+            f(obj)
+            return
+
+        x = self.memo.get(id(obj))
+        if x is not None:
+            self.write(self.get(x[0]))
+            return
+
+        f = self.dispatch.get(t)
+        if f is not None:
+            f(self, obj)
+            return
+        self._save_by_reduce(obj, t)
+
+    def _select_save(self):
+        # Decide which save() implementation to use for the next dump.
+        # This is done when dumping rather than in __init__() so that
+        # hooks assigned to the instance after construction are seen.
+        if self.__dict__.get("save") in (self._save_streamlined,
+                                          self._save_tree,
+                                          self._save_profiled):
+            del self.save
+        if type(self).save is not _Pickler.save or not self._plain_hooks():
+            self._leaf_savers = None
+            self._run_types = frozenset()
+            self._class_savers = None
+        else:
+            self._leaf_savers = self._make_leaf_savers()
+            self._run_types = self._make_run_types()
+            self._stock_tuple = self.dispatch.get(tuple) is _Pickler.save_tuple
+            self._class_savers = {} if self._can_specialize() else None
+            self.save = self._save_streamlined
+        if self.fast:
+            self._save_in_tree = self.save
+            self.save = self._save_tree
+        if self.profile is not None:
+            self._save_in_profile = self.save
+            self.save = self._save_profiled
+
+    def _save_profiled(self, obj, save_persistent_id=True):
+        # Installed as self.save by _select_save() for a profiling
+        # Pickler, outermost.  The saves made inside this one add their
+        # bytes and time to children, which makes the own counts.
+        profile = self.profile
+        if profile is None:
+            return self._save_in_profile(obj, save_persistent_id)
+        outer = profile._children
+        profile._children = children = [0, 0.0]
+        start = profile._written
+        t0 = perf_counter()
+        self._save_in_profile(obj, save_persistent_id)
+        profile._add_save(type(obj), outer, children, start, t0)
+
+    def _write_counted(self, data):
+        self.profile._written += len(data)
+        return self.framer.write(data)
+
+    def _write_large_bytes_counted(self, header, payload):
+        self.profile._written += len(header) + len(payload)
+        self.framer.write_large_bytes(header, payload)
+
+    # In fast mode a cycle would be saved over and over until the
+    # recursion limit is hit.  Rather than tracking every object, the
+    # ids of the objects being saved are only kept past this depth,
+    # which any cycle soon reaches.
+    _FAST_NESTING_LIMIT = 50
+
+    def _save_tree(self, obj, save_persistent_id=True):
+        # Installed as self.save by _select_save() in fast mode, around
+        # the save() it would have used otherwise.  The counters are
+        # reset by _begin_dump(), so they need no cleanup on errors.
+        if self._fast_nesting < self._FAST_NESTING_LIMIT:
+            self._fast_nesting += 1
+            self._save_in_tree(obj, save_persistent_id)
+            self._fast_nesting -= 1
+            return
+        i = id(obj)
+        path = self._fast_path
+        if i in path:
+            raise _cycle_error(obj)
+        path.add(i)
+        self._save_in_tree(obj, save_persistent_id)
+        path.discard(i)
+
+    def _plain_hooks(self):
+        # True if neither persistent_id() nor reducer_override() is
+        # overridden, on the class or on the instance.
+        return (getattr(self.persistent_id, "__func__", None)
+                    is _Pickler.persistent_id
+                and getattr(self, "reducer_override", None) is None)
+
+    def _make_leaf_savers(self):
+        # Map builtin leaf types that are never memoized to bound
+        # encoders.  Entries replaced in a subclass's dispatch table are
+        # left to that table.
+        dispatch = self.dispatch
+        stock = _Pickler.dispatch
+        savers = {}
+        for t in (type(None), bool, int, float):
+            f = dispatch.get(t)
+            if f is not None and f is stock[t]:
+                savers[t] = f.__get__(self)
+        if self.bin:
+            if int in savers:
+                savers[int] = self._save_long_bin
+            if float in savers:
+                savers[float] = self._save_float_bin
+        return savers
+
+    def _make_run_types(self):
+        # Types whose homogeneous runs _encode_run() may encode in bulk
+        # inside _batch_appends() and _batch_setitems().
+        if not self.bin:
+            return frozenset()
+        dispatch = self.dispatch
+        stock = _Pickler.dispatch
+        types = {t for t in (int, float) if t in self._leaf_savers}
+        cls = type(self)
+        if (self.proto >= 4 and dispatch.get(str) is stock[str]
+                and not self._shared_only
+                and cls.memoize is _Pickler.memoize
+                and cls.put is _Pickler.put and cls.get is _Pickler.get):
+            types.add(str)
+        return frozenset(types)
+
+    def _save_by_reduce(self, obj, t):
+        savers = self._class_savers
+        if savers is not None:
+            saver = savers.get(t)
+            if saver is not None and saver(obj):
+                return
+        state = self._plain_state(obj, t)
+        if state is not _NoValue:
+            self._save_plain(obj, t, state)
+        else:
+            r = self._reduce(obj, t)
+            if r is None:
+                return
+            self._save_reduce_value(obj, *r)
+        if savers is not None and t not in savers:
+            savers[t] = self._make_class_saver(obj, t)
 
-            # Check private dispatch table if any, or else
-            # copyreg.dispatch_table
-            reduce = getattr(self, 'dispatch_table', dispatch_table).get(t, _NoValue)
+    def _save_plain(self, obj, t, state):
+        # What save_reduce(__newobj__, (t,), state, obj=obj) does, less
+        # the checks of reduce() output that _learn_reducer() made once.
+        save = self.save
+        write = self.write
+        save(t)
+        if self._leaf_savers is not None and self._stock_tuple:
+            # save(()) with neither hook overridden
+            self.framer.commit_frame()
+            write(EMPTY_TUPLE + NEWOBJ)
+        else:
+            save(())
+            write(NEWOBJ)
+        self._memoize_built(obj)
+        if state is not None:
+            save(state)
+            write(BUILD)
+
+    def _plain_state(self, obj, t):
+        # Return the state object.__reduce_ex__() would give obj if t is
+        # a plain class whose instances _save_plain() can save, or else
+        # _NoValue.  The dispatch table is checked every time, so that a
+        # reducer registered with copyreg after t was seen is used.
+        entry = self._plain_types.get(t)
+        if (entry is None
+                or t in getattr(self, 'dispatch_table', dispatch_table)):
+            return _NoValue
+        has_dict, slotnames = entry
+        state = None
+        if has_dict:
+            d = obj.__dict__
+            if d:
+                if not d.keys().isdisjoint(_REDUCE_HOOKS):
+                    return _NoValue
+                state = d
+        if slotnames:
+            slots = {}
+            for name in slotnames:
+                try:
+                    slots[name] = getattr(obj, name)
+                except AttributeError:
+                    pass
+            if slots:
+                state = (state, slots)
+        return state
+
+    def _learn_reducer(self, obj, t, reduce, rv):
+        # Called with what obj.__reduce_ex__() returned for the first
+        # instance of t in a dump.  Record whether t is a plain class,
+        # reduced by object.__reduce_ex__() to __newobj__ with no
+        # arguments and the default state, and check that _plain_state()
+        # gives the same state.
+        if t in self._plain_types:
+            return
+        self._plain_types[t] = None
+        if (self.proto < 2
+                or type(self).save_reduce is not _Pickler.save_reduce
+                or t.__reduce_ex__ is not object.__reduce_ex__
+                or t.__reduce__ is not object.__reduce__
+                or t.__getattribute__ is not object.__getattribute__
+                or getattr(t, "__getstate__", None)
+                    is not getattr(object, "__getstate__", None)
+                or hasattr(t, "__getnewargs_ex__")
+                or hasattr(t, "__getnewargs__")
+                or getattr(reduce, "__self__", None) is not obj
+                or not isinstance(rv, tuple) or len(rv) != 5
+                or rv[0] is not __newobj__ or rv[1] != (t,)
+                or rv[3] is not None or rv[4] is not None):
+            return
+        for c in t.__mro__[:-1]:
+            d = vars(c)
+            descr = d.get("__dict__")
+            if "__class__" in d or (descr is not None and
+                                    type(descr) is not GetSetDescriptorType):
+                return
+        self._plain_types[t] = (t.__dictoffset__ != 0, tuple(_slotnames(t)))
+        state = self._plain_state(obj, t)
+        if not _same_state(state, rv[2]):
+            self._plain_types[t] = None
+
+    def _reduce(self, obj, t):
+        # Return the (rv, reduce) pair for an object of a type that is
+        # not in the dispatch table, or None if it was saved as a global.
+
+        # Check private dispatch table if any, or else
+        # copyreg.dispatch_table
+        reduce = getattr(self, 'dispatch_table',
+                         dispatch_table).get(t, _NoValue)
+        if reduce is not _NoValue:
+            rv = reduce(obj)
+        else:
+            # Check for a class with a custom metaclass; treat as regular
+            # class
+            if issubclass(t, type):
+                self.save_global(obj)
+                return None
+
+            # Check for a __reduce_ex__ method, fall back to __reduce__
+            reduce = getattr(obj, "__reduce_ex__", _NoValue)
             if reduce is not _NoValue:
-                rv = reduce(obj)
+                rv = reduce(self.proto)
+                if t not in self._plain_types:
+                    self._learn_reducer(obj, t, reduce, rv)
             else:
-                # Check for a class with a custom metaclass; treat as regular
-                # class
-                if issubclass(t, type):
-                    self.save_global(obj)
-                    return
-
-                # Check for a __reduce_ex__ method, fall back to __reduce__
-                reduce = getattr(obj, "__reduce_ex__", _NoValue)
+                reduce = getattr(obj, "__reduce__", _NoValue)
                 if reduce is not _NoValue:
-                    rv = reduce(self.proto)
+                    rv = reduce()
                 else:
-                    reduce = getattr(obj, "__reduce__", _NoValue)
-                    if reduce is not _NoValue:
-                        rv = reduce()
-                    else:
-                        raise PicklingError("Can't pickle %r object: %r" %
-                                            (t.__name__, obj))
+                    raise PicklingError("Can't pickle %r object: %r" %
+                                        (t.__name__, obj))
+        return rv, reduce
 
+    def _save_reduce_value(self, obj, rv, reduce):
         # Check for string returned by reduce(), meaning "save as global"
         if isinstance(rv, str):
             self.save_global(obj, rv)
             return
+        self._check_reduce_tuple(rv, reduce)
+
+        # Save the reduce() output and finally memoize the object
+        self.save_reduce(obj=obj, *rv)
 
+    def _check_reduce_tuple(self, rv, reduce):
         # Assert that reduce() returned a tuple
         if not isinstance(rv, tuple):
             raise PicklingError("%s must return string or tuple" % reduce)
@@ -597,8 +1702,256 @@ class _Pickler:
             raise PicklingError("Tuple returned by %s must have "
                                 "two to six elements" % reduce)
 
-        # Save the reduce() output and finally memoize the object
-        self.save_reduce(obj=obj, *rv)
+    # Specialized savers.  Once an instance of a plain class or named
+    # tuple has been saved, its class and field names are in the memo,
+    # and an instance with the same fields is written as the reference
+    # to its class, the opcodes around its fields, the references to
+    # the field names and the values.  Values of the leaf types save()
+    # writes without a dispatch are encoded inline; others are saved.
+    # The chunks go through _write_run(), so frames end where save()
+    # would have ended them.
+
+    def _can_specialize(self):
+        cls = type(self)
+        return (self._specialize and self.proto >= 2 and not self.fast
+                and not self._shared_only
+                and self._values is None and not self._sort_keys
+                and self._stock_tuple
+                and isinstance(self.memo, (dict, _PicklerMemo))
+                and self.dispatch.get(dict) is _Pickler.save_dict
+                and cls._batch_setitems is _Pickler._batch_setitems
+                and cls.save_reduce is _Pickler.save_reduce
+                and cls.memoize is _Pickler.memoize
+                and cls.put is _Pickler.put and cls.get is _Pickler.get)
+
+    def _make_class_saver(self, obj, t):
+        # Return a function that saves an instance of t laid out like
+        # obj and returns True, or returns False for another layout, or
+        # return None if t can't be specialized.
+        if self.fast or t in getattr(self, 'dispatch_table', dispatch_table):
+            return None
+        memo = self.memo
+        x = memo.get(id(t))
+        if x is None:
+            return None
+        prefix = self.get(x[0])
+        entry = self._plain_types.get(t)
+        if entry is not None:
+            has_dict, slotnames = entry
+            if has_dict and not slotnames:
+                return self._make_dict_saver(t, prefix, tuple(obj.__dict__))
+            if slotnames and not has_dict:
+                return self._make_slots_saver(t, prefix, slotnames)
+            return None
+        if self._is_plain_namedtuple(obj, t):
+            return self._make_namedtuple_saver(t, prefix, len(obj))
+        return None
+
+    def _is_plain_namedtuple(self, obj, t):
+        # True if obj is a named tuple that object.__reduce_ex__() reduces
+        # to __newobj__ with its fields as arguments and no state.
+        if not (issubclass(t, tuple) and hasattr(t, "_fields")
+                and t.__dictoffset__ == 0
+                and t.__reduce_ex__ is object.__reduce_ex__
+                and t.__reduce__ is object.__reduce__
+                and getattr(t, "__getstate__", None)
+                    is getattr(object, "__getstate__", None)
+                and not hasattr(t, "__getnewargs_ex__")):
+            return False
+        for c in t.__mro__[:-2]:
+            d = vars(c)
+            if "__class__" in d or "__getattribute__" in d:
+                return False
+        rv = obj.__reduce_ex__(self.proto)
+        return rv == (__newobj__, (t,) + tuple(obj), None, None, None)
+
+    def _field_encoder(self):
+        # Return a function that encodes a leaf value as save() would
+        # have written it, or returns None for any other value.
+        inline = set(self._leaf_savers)
+        if str in self._run_types:
+            inline.add(str)
+        memo = self.memo
+        get = self.get
+
+        def encode(v):
+            t = type(v)
+            if t not in inline:
+                return None
+            if t is int:
+                if 0 <= v <= 0xff:
+                    return _BININT1_OPS[v]
+                if 0 <= v <= 0xffff:
+                    return _pack_binint2(BININT2, v)
+                if -0x80000000 <= v <= 0x7fffffff:
+                    return _pack_binint(BININT, v)
+                return None
+            if t is str:
+                x = memo.get(id(v))
+                if x is not None:
+                    return get(x[0])
+                if len(v) > 0xff:
+                    return None
+                data = v.encode('utf-8', 'surrogatepass')
+                if len(data) > 0xff:
+                    return None
+                memo[id(v)] = len(memo), v
+                return _SHORT_BINUNICODE_OPS[len(data)] + data + MEMOIZE
+            if t is float:
+                return _pack_binfloat(BINFLOAT, v)
+            if t is bool:
+                return NEWTRUE if v else NEWFALSE
+            return NONE
+        return encode
+
+    def _name_refs(self, names):
+        # The memo references to the field names, if all are memoized.
+        refs = []
+        for name in names:
+            x = self.memo.get(id(name))
+            if x is None:
+                return None
+            refs.append(self.get(x[0]))
+        return refs
+
+    def _write_fields(self, chunks, refs, values, encode):
+        # Write the chunks followed by each field's name reference, if
+        # refs isn't None, and value.  Return the chunks not yet written.
+        save = self.save
+        if refs is None:
+            refs = repeat(None)
+        for ref, v in zip(refs, values):
+            if ref is not None:
+                chunks.append(ref)
+            data = encode(v)
+            if data is None:
+                if chunks:
+                    self._write_run(chunks)
+                    chunks = []
+                save(v)
+            else:
+                chunks.append(data)
+        return chunks
+
+    def _memoize_data(self, obj):
+        # memoize(), returning what it would have written.
+        memo = self.memo
+        idx = len(memo)
+        memo[id(obj)] = idx, obj
+        return self.put(idx)
+
+    def _end_fields(self, chunks, tail):
+        if chunks:
+            chunks[-1] += tail
+            self._write_run(chunks)
+        else:
+            self.write(tail)
+
+    def _make_dict_saver(self, t, prefix, names):
+        # The state is the instance dict: EMPTY_DICT and then the fields,
+        # as _batch_setitems() writes a single batch.
+        n = len(names)
+        if not 0 < n <= self._BATCHSIZE or not _REDUCE_HOOKS.isdisjoint(names):
+            return None
+        refs = self._name_refs(names)
+        if refs is None:
+            return None
+        return self._make_instance_saver(t, prefix, names, refs, False)
+
+    def _make_slots_saver(self, t, prefix, names):
+        # The state is (None, slots): NONE, EMPTY_DICT and the fields.
+        n = len(names)
+        if not 0 < n <= self._BATCHSIZE:
+            return None
+        refs = self._name_refs(names)
+        if refs is None:
+            return None
+        return self._make_instance_saver(t, prefix, names, refs, True)
+
+    def _make_instance_saver(self, t, prefix, names, refs, slots):
+        memo = self.memo
+        epoch = self._memo_epoch
+        table = getattr(self, 'dispatch_table', dispatch_table)
+        savers = self._class_savers
+        encode = self._field_encoder()
+        memoize = self._memoize_data
+        n = len(names)
+        if n > 1:
+            open_fields = MARK
+            tail = SETITEMS
+        else:
+            open_fields = b''
+            tail = SETITEM
+        get_values = attrgetter(*names)
+
+        def save_instance(obj):
+            if self._memo_epoch != epoch:
+                del savers[t]
+                return False
+            if t in table:
+                return False
+            if slots:
+                try:
+                    values = get_values(obj)
+                except AttributeError:
+                    return False
+                if n == 1:
+                    values = (values,)
+                state = dict(zip(names, values))
+            else:
+                state = obj.__dict__
+                if len(state) != n or not all(map(is_, state, names)):
+                    return False
+                if id(state) in memo:
+                    return False
+                values = state.values()
+            chunks = [prefix, EMPTY_TUPLE + NEWOBJ + memoize(obj)]
+            if slots:
+                chunks.append(NONE)
+            chunks.append(EMPTY_DICT + memoize(state) + open_fields)
+            chunks = self._write_fields(chunks, refs, values, encode)
+            if slots:
+                state = (None, state)
+                self._end_fields(chunks,
+                                 tail + TUPLE2 + memoize(state) + BUILD)
+            else:
+                self._end_fields(chunks, tail + BUILD)
+            return True
+        return save_instance
+
+    def _make_namedtuple_saver(self, t, prefix, n):
+        # The fields are the arguments of NEWOBJ, written as save_tuple()
+        # writes a tuple of them.
+        memo = self.memo
+        epoch = self._memo_epoch
+        table = getattr(self, 'dispatch_table', dispatch_table)
+        savers = self._class_savers
+        encode = self._field_encoder()
+        memoize = self._memoize_data
+        get = self.get
+
+        def save_instance(obj):
+            if self._memo_epoch != epoch:
+                del savers[t]
+                return False
+            if len(obj) != n or t in table:
+                return False
+            if n == 0:
+                self._write_run([prefix, EMPTY_TUPLE + NEWOBJ + memoize(obj)])
+                return True
+            args = tuple(obj)
+            chunks = [prefix] if n <= 3 else [prefix, MARK]
+            chunks = self._write_fields(chunks, None, args, encode)
+            tail = (_tuplesize2code[n] if n <= 3 else TUPLE) + memoize(args)
+            x = memo.get(id(obj))
+            if x is not None:
+                # obj was saved while saving its fields.
+                tail += NEWOBJ + POP + get(x[0])
+            else:
+                tail += NEWOBJ + memoize(obj)
+            self._end_fields(chunks, tail)
+            return True
+        return save_instance
 
     def persistent_id(self, obj):
         # This exists so a subclass can override it
@@ -620,14 +1973,48 @@ class _Pickler:
                     dictitems=None, state_setter=None, *, obj=None):
         # This API is called by some subclasses
 
+        save = self.save
+        write = self.write
+
+        objs, opcode = self._reduce_call(func, args, obj)
+        for x in objs:
+            save(x)
+        write(opcode)
+
+        if obj is not None:
+            self._memoize_built(obj)
+
+        # More new special cases (that work with older protocols as
+        # well): when __reduce__ returns a tuple with 4 or 5 items,
+        # the 4th and 5th item should be iterators that provide list
+        # items and dict items (as (key, value) tuples), or None.
+
+        if listitems is not None:
+            self._batch_appends(listitems)
+
+        if dictitems is not None:
+            self._batch_setitems(self._reduce_dictitems(obj, dictitems))
+
+        if state is not None:
+            objs, opcodes = self._state_call(obj, state, state_setter)
+            for x in objs:
+                save(x)
+            write(opcodes)
+
+    # The opcode logic of save_reduce() and of the container savers is
+    # kept in the helpers below, which _IterativePickler calls too: its
+    # generators differ from these methods only in yielding the objects
+    # to save rather than saving them.
+
+    def _reduce_call(self, func, args, obj):
+        # Check the callable and arguments given to save_reduce(), and
+        # return the objects to save and the opcode that calls the one
+        # with the others to build obj.
         if not isinstance(args, tuple):
             raise PicklingError("args from save_reduce() must be a tuple")
         if not callable(func):
             raise PicklingError("func from save_reduce() must be callable")
 
-        save = self.save
-        write = self.write
-
         func_name = getattr(func, "__name__", "")
         if self.proto >= 2 and func_name == "__newobj_ex__":
             cls, args, kwargs = args
@@ -638,15 +2025,9 @@ class _Pickler:
                 raise PicklingError("args[0] from {} args has the wrong class"
                                     .format(func_name))
             if self.proto >= 4:
-                save(cls)
-                save(args)
-                save(kwargs)
-                write(NEWOBJ_EX)
-            else:
-                func = partial(cls.__new__, cls, *args, **kwargs)
-                save(func)
-                save(())
-                write(REDUCE)
+                return (cls, args, kwargs), NEWOBJ_EX
+            func = partial(cls.__new__, cls, *args, **kwargs)
+            return (func, ()), REDUCE
         elif self.proto >= 2 and func_name == "__newobj__":
             # A __reduce__ implementation can direct protocol 2 or newer to
             # use the more efficient NEWOBJ opcode, while still
@@ -681,55 +2062,33 @@ class _Pickler:
             if obj is not None and cls is not obj.__class__:
                 raise PicklingError(
                     "args[0] from __newobj__ args has the wrong class")
-            args = args[1:]
-            save(cls)
-            save(args)
-            write(NEWOBJ)
+            return (cls, args[1:]), NEWOBJ
+        return (func, args), REDUCE
+
+    def _memoize_built(self, obj):
+        # Memoize obj once the opcodes that build it are written.  If the
+        # object is already in the memo, this means it is recursive. In
+        # this case, throw away everything we put on the stack, and
+        # fetch the object back from the memo.
+        x = self.memo.get(id(obj))
+        if x is not None:
+            self.write(POP + self.get(x[0]))
         else:
-            save(func)
-            save(args)
-            write(REDUCE)
-
-        if obj is not None:
-            # If the object is already in the memo, this means it is
-            # recursive. In this case, throw away everything we put on the
-            # stack, and fetch the object back from the memo.
-            if id(obj) in self.memo:
-                write(POP + self.get(self.memo[id(obj)][0]))
-            else:
-                self.memoize(obj)
-
-        # More new special cases (that work with older protocols as
-        # well): when __reduce__ returns a tuple with 4 or 5 items,
-        # the 4th and 5th item should be iterators that provide list
-        # items and dict items (as (key, value) tuples), or None.
-
-        if listitems is not None:
-            self._batch_appends(listitems)
-
-        if dictitems is not None:
-            self._batch_setitems(dictitems)
-
-        if state is not None:
-            if state_setter is None:
-                save(state)
-                write(BUILD)
-            else:
-                # If a state_setter is specified, call it instead of load_build
-                # to update obj's with its previous state.
-                # First, push state_setter and its tuple of expected arguments
-                # (obj, state) onto the stack.
-                save(state_setter)
-                save(obj)  # simple BINGET opcode as obj is already memoized.
-                save(state)
-                write(TUPLE2)
-                # Trigger a state_setter(obj, state) function call.
-                write(REDUCE)
-                # The purpose of state_setter is to carry-out an
-                # inplace modification of obj. We do not care about what the
-                # method might return, so its output is eventually removed from
-                # the stack.
-                write(POP)
+            self.memoize(obj)
+
+    def _state_call(self, obj, state, state_setter):
+        # Return the objects to save and the opcodes to write after them
+        # to give the memoized obj its state.
+        if state_setter is None:
+            return (state,), BUILD
+        # If a state_setter is specified, call it instead of load_build
+        # to update obj's with its previous state.  The tuple of its
+        # arguments holds obj as a simple BINGET opcode, as obj is
+        # already memoized.  The purpose of state_setter is to carry-out
+        # an inplace modification of obj. We do not care about what the
+        # method might return, so its output is eventually removed from
+        # the stack.
+        return (state_setter, obj, state), TUPLE2 + REDUCE + POP
 
     # Methods below this point are dispatched through the dispatch table
 
@@ -777,6 +2136,14 @@ class _Pickler:
             self.write(LONG + repr(obj).encode("ascii") + b'L\n')
     dispatch[int] = save_long
 
+    def _save_long_bin(self, obj):
+        # save_long() for binary protocols, with the common one-byte case
+        # served from a table of preencoded opcodes.
+        if 0 <= obj <= 0xff:
+            self.write(_BININT1_OPS[obj])
+        else:
+            self.save_long(obj)
+
     def save_float(self, obj):
         if self.bin:
             self.write(BINFLOAT + pack('>d', obj))
@@ -784,6 +2151,9 @@ class _Pickler:
             self.write(FLOAT + repr(obj).encode("ascii") + b'\n')
     dispatch[float] = save_float
 
+    def _save_float_bin(self, obj):
+        self.write(BINFLOAT + _pack_double(obj))
+
     def _save_bytes_no_memo(self, obj):
         # helper for writing bytes objects for protocol >= 3
         # without memoizing them
@@ -799,6 +2169,11 @@ class _Pickler:
             self.write(BINBYTES + pack("<I", n) + obj)
 
     def save_bytes(self, obj):
+        if self._values is not None:
+            x = self._memo_by_value(obj, obj)
+            if x is not None:
+                self.write(self.get(x[0]))
+                return
         if self.proto < 3:
             if not obj: # bytes object is empty
                 self.save_reduce(bytes, (), obj=obj)
@@ -844,20 +2219,15 @@ class _Pickler:
                 if self._buffer_callback is not None:
                     in_band = bool(self._buffer_callback(obj))
                 if in_band:
-                    # Write data in-band
-                    # XXX The C implementation avoids a copy here
-                    buf = m.tobytes()
-                    in_memo = id(buf) in self.memo
+                    # Write data in-band straight from the buffer, which
+                    # obj.raw() presents as a flat view of unsigned bytes,
+                    # and memoize the PickleBuffer itself as the C
+                    # implementation does.
                     if m.readonly:
-                        if in_memo:
-                            self._save_bytes_no_memo(buf)
-                        else:
-                            self.save_bytes(buf)
+                        self._save_bytes_no_memo(m)
                     else:
-                        if in_memo:
-                            self._save_bytearray_no_memo(buf)
-                        else:
-                            self.save_bytearray(buf)
+                        self._save_bytearray_no_memo(m)
+                    self.memoize(obj)
                 else:
                     # Write data out-of-band
                     self.write(NEXT_BUFFER)
@@ -867,6 +2237,11 @@ class _Pickler:
         dispatch[PickleBuffer] = save_picklebuffer
 
     def save_str(self, obj):
+        if self._values is not None:
+            x = self._memo_by_value(obj, obj)
+            if x is not None:
+                self.write(self.get(x[0]))
+                return
         if self.bin:
             encoded = obj.encode('utf-8', 'surrogatepass')
             n = len(encoded)
@@ -890,36 +2265,44 @@ class _Pickler:
     dispatch[str] = save_str
 
     def save_tuple(self, obj):
+        if self._begin_tuple(obj):
+            save = self.save
+            for element in obj:
+                save(element)
+            self._end_tuple(obj)
+
+    def _begin_tuple(self, obj):
+        # Write what comes before the elements of a tuple, and return
+        # False if that was the whole tuple.
         if not obj: # tuple is empty
             if self.bin:
                 self.write(EMPTY_TUPLE)
             else:
                 self.write(MARK + TUPLE)
-            return
+            return False
+        if self._values is not None and self._save_tuple_by_value(obj):
+            return False
+        # proto 0 or proto 1 and tuple isn't empty, or proto > 1 and tuple
+        # has more than 3 elements.
+        if len(obj) > 3 or self.proto < 2:
+            self.write(MARK)
+        return True
 
+    def _end_tuple(self, obj):
+        # Write what comes after the elements of a tuple.
         n = len(obj)
-        save = self.save
-        memo = self.memo
+        write = self.write
+        x = self.memo.get(id(obj))
         if n <= 3 and self.proto >= 2:
-            for element in obj:
-                save(element)
             # Subtle.  Same as in the big comment below.
-            if id(obj) in memo:
-                get = self.get(memo[id(obj)][0])
-                self.write(POP * n + get)
+            if x is not None:
+                write(POP * n + self.get(x[0]))
             else:
-                self.write(_tuplesize2code[n])
+                write(_tuplesize2code[n])
                 self.memoize(obj)
             return
 
-        # proto 0 or proto 1 and tuple isn't empty, or proto > 1 and tuple
-        # has more than 3 elements.
-        write = self.write
-        write(MARK)
-        for element in obj:
-            save(element)
-
-        if id(obj) in memo:
+        if x is not None:
             # Subtle.  d was not in memo when we entered save_tuple(), so
             # the process of saving the tuple's elements must have saved
             # the tuple itself:  the tuple is recursive.  The proper action
@@ -927,7 +2310,7 @@ class _Pickler:
             # simply GET the tuple (it's already constructed).  This check
             # could have been done in the "for element" loop instead, but
             # recursive tuples are a rare thing.
-            get = self.get(memo[id(obj)][0])
+            get = self.get(x[0])
             if self.bin:
                 write(POP_MARK + get)
             else:   # proto 0 -- POP_MARK not available
@@ -941,26 +2324,38 @@ class _Pickler:
     dispatch[tuple] = save_tuple
 
     def save_list(self, obj):
-        if self.bin:
-            self.write(EMPTY_LIST)
-        else:   # proto 0 -- can't use EMPTY_LIST
-            self.write(MARK + LIST)
-
-        self.memoize(obj)
+        self._open_container(obj, EMPTY_LIST, LIST)
         self._batch_appends(obj)
 
     dispatch[list] = save_list
 
+    def _open_container(self, obj, empty, opcode):
+        # Write an empty list or dict, to be filled by appends or
+        # setitems, and memoize it.
+        if self.bin:
+            self.write(empty)
+        else:   # proto 0 -- can't use EMPTY_LIST or EMPTY_DICT
+            self.write(MARK + opcode)
+        self.memoize(obj)
+
     _BATCHSIZE = 1000
 
     def _batch_appends(self, items):
         # Helper to batch up APPENDS sequences
         save = self.save
+        for batch in self._append_batches(items):
+            for x in batch:
+                save(x)
+
+    def _append_batches(self, items):
+        # Yield the batches of items to save, writing the opcodes that
+        # append them around each batch.  Runs that _save_run() encodes
+        # are written without being yielded.
         write = self.write
 
         if not self.bin:
             for x in items:
-                save(x)
+                yield (x,)
                 write(APPEND)
             return
 
@@ -970,36 +2365,176 @@ class _Pickler:
             n = len(tmp)
             if n > 1:
                 write(MARK)
-                for x in tmp:
-                    save(x)
+                if not (self._run_types and self._save_run(tmp)):
+                    yield tmp
                 write(APPENDS)
             elif n:
-                save(tmp[0])
+                yield tmp
                 write(APPEND)
             # else tmp is empty, and we're done
             if n < self._BATCHSIZE:
                 return
 
-    def save_dict(self, obj):
-        if self.bin:
-            self.write(EMPTY_DICT)
-        else:   # proto 0 -- can't use EMPTY_DICT
-            self.write(MARK + DICT)
+    # Bulk encoding of homogeneous runs.  A run of ints, floats or short
+    # strs is encoded into one chunk per item, exactly as save() would
+    # have written it, and the chunks are written with a few joins.
+
+    def _save_run(self, items):
+        chunks = self._encode_run(items)
+        if chunks is None:
+            return False
+        self._write_run(chunks)
+        return True
+
+    def _save_pairs_run(self, pairs):
+        if set(map(type, pairs)) != {tuple} or set(map(len, pairs)) != {2}:
+            return False
+        flat = list(chain.from_iterable(pairs))
+        chunks = self._encode_run(flat)
+        if chunks is None:
+            # Keys and values are encoded separately.  The str side, if
+            # any, goes last because encoding it updates the memo.
+            keys = flat[0::2]
+            values = flat[1::2]
+            ktypes = set(map(type, keys))
+            vtypes = set(map(type, values))
+            if (len(ktypes) != 1 or len(vtypes) != 1
+                    or ktypes == vtypes == {str}):
+                return False
+            if ktypes == {str}:
+                vchunks = self._encode_run(values)
+                kchunks = vchunks and self._encode_run(keys)
+            else:
+                kchunks = self._encode_run(keys)
+                vchunks = kchunks and self._encode_run(values)
+            if not (kchunks and vchunks):
+                return False
+            chunks = flat
+            chunks[0::2] = kchunks
+            chunks[1::2] = vchunks
+        self._write_run(chunks)
+        return True
+
+    def _encode_run(self, items):
+        # Return the list of encoded items, or None if the items are not
+        # a run of a single eligible type.  Nothing is memoized unless
+        # the whole run can be encoded.
+        types = set(map(type, items))
+        if len(types) != 1:
+            return None
+        t = types.pop()
+        if t not in self._run_types:
+            return None
+        if t is int:
+            lo = min(items)
+            hi = max(items)
+            if lo >= 0 and hi <= 0xff:
+                return [_BININT1_OPS[x] for x in items]
+            if lo < -0x80000000 or hi > 0x7fffffff:
+                return None
+            return [_BININT1_OPS[x] if 0 <= x <= 0xff else
+                    _pack_binint2(BININT2, x) if 0 <= x <= 0xffff else
+                    _pack_binint(BININT, x)
+                    for x in items]
+        if t is float:
+            return [_pack_binfloat(BINFLOAT, x) for x in items]
+        if self.fast:
+            return None
+        # str, protocol >= 4.  A str never encodes to fewer bytes than
+        # it has characters, so long ones are ruled out before encoding.
+        if max(map(len, items)) > 0xff:
+            return None
+        encoded = [x.encode('utf-8', 'surrogatepass') for x in items]
+        if max(map(len, encoded)) > 0xff:
+            return None
+        memo = self.memo
+        by_value = self._memo_by_value if self._values is not None else None
+        chunks = []
+        append = chunks.append
+        for x, data in zip(items, encoded):
+            m = memo.get(id(x))
+            if m is None and by_value is not None:
+                m = by_value(x, x)
+            if m is not None:
+                append(self.get(m[0]))
+            else:
+                append(_SHORT_BINUNICODE_OPS[len(data)] + data + MEMOIZE)
+                memo[id(x)] = len(memo), x
+        return chunks
+
+    def _write_run(self, chunks):
+        # Write encoded items, committing frames at the same places the
+        # per-item save() calls would have: before any item that finds
+        # the current frame at or above the target size.
+        framer = self.framer
+        frame = framer.current_frame
+        if frame is None:
+            self.write(b''.join(chunks))
+            return
+        target = framer._FRAME_SIZE_TARGET
+        # sizes[i] is the frame size seen when saving chunks[i]
+        sizes = list(accumulate(map(len, chunks), initial=frame.tell()))
+        n = len(chunks)
+        start = 0
+        limit = target
+        while True:
+            i = bisect_left(sizes, limit, start, n)
+            if i == n:
+                break
+            if i > start:
+                self.write(b''.join(chunks[start:i]))
+            framer.commit_frame()
+            start = i
+            limit = sizes[i] + target
+        self.write(b''.join(chunks[start:]))
 
-        self.memoize(obj)
-        self._batch_setitems(obj.items())
+    def save_dict(self, obj):
+        self._open_container(obj, EMPTY_DICT, DICT)
+        self._batch_setitems(self._dict_items(obj))
 
     dispatch[dict] = save_dict
 
+    # Canonical order.  Sets of ints, strs or bytes are sorted as they
+    # are; anything else is sorted by _canonical_key().
+
+    def _set_members(self, obj):
+        if not self._canonical:
+            return obj
+        types = set(map(type, obj))
+        if len(types) == 1 and types <= _NATURALLY_ORDERED:
+            return sorted(obj)
+        return sorted(obj, key=partial(_canonical_key, active=self._keying))
+
+    def _dict_items(self, obj):
+        if not self._sort_keys:
+            return obj.items()
+        return [(k, obj[k]) for k in self._set_members(obj)]
+
+    def _reduce_dictitems(self, obj, dictitems):
+        # The dict items of a reduce value, in key order with sort_keys
+        # if obj is a dict whose equality ignores order (a defaultdict,
+        # say, but not an OrderedDict).
+        if (not self._sort_keys or not isinstance(obj, dict)
+                or type(obj).__eq__ is not dict.__eq__):
+            return dictitems
+        items = dict(dictitems)
+        return [(k, items[k]) for k in self._set_members(items)]
+
     def _batch_setitems(self, items):
         # Helper to batch up SETITEMS sequences; proto >= 1 only
         save = self.save
+        for batch in self._setitem_batches(items):
+            for k, v in batch:
+                save(k)
+                save(v)
+
+    def _setitem_batches(self, items):
+        # _append_batches() for (key, value) pairs.
         write = self.write
 
         if not self.bin:
-            for k, v in items:
-                save(k)
-                save(v)
+            for item in items:
+                yield (item,)
                 write(SETITEM)
             return
 
@@ -1009,14 +2544,11 @@ class _Pickler:
             n = len(tmp)
             if n > 1:
                 write(MARK)
-                for k, v in tmp:
-                    save(k)
-                    save(v)
+                if not (self._run_types and self._save_pairs_run(tmp)):
+                    yield tmp
                 write(SETITEMS)
             elif n:
-                k, v = tmp[0]
-                save(k)
-                save(v)
+                yield tmp
                 write(SETITEM)
             # else tmp is empty, and we're done
             if n < self._BATCHSIZE:
@@ -1024,77 +2556,91 @@ class _Pickler:
 
     def save_set(self, obj):
         save = self.save
-        write = self.write
 
         if self.proto < 4:
-            self.save_reduce(set, (list(obj),), obj=obj)
+            self.save_reduce(set, (list(self._set_members(obj)),), obj=obj)
             return
 
-        write(EMPTY_SET)
+        self.write(EMPTY_SET)
         self.memoize(obj)
+        for batch in self._additem_batches(self._set_members(obj)):
+            for item in batch:
+                save(item)
+    dispatch[set] = save_set
 
-        it = iter(obj)
+    def _additem_batches(self, items):
+        # _append_batches() for the members of a set; protocol 4 only.
+        write = self.write
+        it = iter(items)
         while True:
             batch = list(islice(it, self._BATCHSIZE))
             n = len(batch)
             if n > 0:
                 write(MARK)
-                for item in batch:
-                    save(item)
+                yield batch
                 write(ADDITEMS)
             if n < self._BATCHSIZE:
                 return
-    dispatch[set] = save_set
 
     def save_frozenset(self, obj):
         save = self.save
-        write = self.write
 
+        if self._canonical and self._save_by_value(obj, _value_key(obj)):
+            return
         if self.proto < 4:
-            self.save_reduce(frozenset, (list(obj),), obj=obj)
+            self.save_reduce(frozenset, (list(self._set_members(obj)),),
+                             obj=obj)
             return
 
-        write(MARK)
-        for item in obj:
+        self.write(MARK)
+        for item in self._set_members(obj):
             save(item)
+        self._end_frozenset(obj)
+    dispatch[frozenset] = save_frozenset
 
-        if id(obj) in self.memo:
+    def _end_frozenset(self, obj):
+        # Write what comes after the members of a frozenset.
+        x = self.memo.get(id(obj))
+        if x is not None:
             # If the object is already in the memo, this means it is
             # recursive. In this case, throw away everything we put on the
             # stack, and fetch the object back from the memo.
-            write(POP_MARK + self.get(self.memo[id(obj)][0]))
+            self.write(POP_MARK + self.get(x[0]))
             return
 
-        write(FROZENSET)
+        self.write(FROZENSET)
         self.memoize(obj)
-    dispatch[frozenset] = save_frozenset
+
+    # Set to true to share global resolutions between picklers through
+    # a process-wide cache (see _resolve_global()).
+    shared_global_cache = False
 
     def save_global(self, obj, name=None):
         write = self.write
-        memo = self.memo
 
-        if name is None:
-            name = getattr(obj, '__qualname__', None)
-        if name is None:
-            name = obj.__name__
-
-        module_name = whichmodule(obj, name)
-        try:
-            __import__(module_name, level=0)
-            module = sys.modules[module_name]
-            obj2, parent = _getattribute(module, name)
-        except (ImportError, KeyError, AttributeError):
-            raise PicklingError(
-                "Can't pickle %r: it's not found as %s.%s" %
-                (obj, module_name, name)) from None
-        else:
-            if obj2 is not obj:
-                raise PicklingError(
-                    "Can't pickle %r: it's not the same object as %s.%s" %
-                    (obj, module_name, name))
+        # Resolving a global is costly (whichmodule() may scan every
+        # module and __import__() takes the import lock), so the
+        # resolution is cached per pickler together with the GLOBAL
+        # opcode when that does not depend on the memo.  A cached
+        # resolution is checked against the module, as it may have
+        # been rebound since.
+        key = (id(obj), name)
+        cached = self._global_cache.get(key)
+        if cached is not None and not _still_bound(obj, cached[1],
+                                                   cached[5], cached[3]):
+            cached = None
+        if cached is None:
+            module_name, emitted, qualname, module = self._resolve_global(
+                obj, name)
+            data = None
+            if self.proto < 4 and '.' not in emitted:
+                data = self._toplevel_by_name(module_name, emitted)
+            cached = (obj, module_name, emitted, qualname, data, module)
+            self._global_cache[key] = cached
+        _, module_name, name, qualname, data, _ = cached
 
         if self.proto >= 2:
-            code = _extension_registry.get((module_name, name), _NoValue)
+            code = _extension_registry.get((module_name, qualname), _NoValue)
             if code is not _NoValue:
                 if code <= 0xff:
                     data = pack("<B", code)
@@ -1109,15 +2655,14 @@ class _Pickler:
                 else:
                     write(EXT4 + pack("<i", code))
                 return
-        lastname = name.rpartition('.')[2]
-        if parent is module:
-            name = lastname
         # Non-ASCII identifiers are supported only with protocols >= 3.
         if self.proto >= 4:
             self.save(module_name)
             self.save(name)
             write(STACK_GLOBAL)
-        elif '.' in name:
+        elif data is not None:
+            write(data)
+        else:
             # In protocol < 4, objects with multi-part __qualname__
             # are represented as
             # getattr(getattr(..., attrname1), attrname2).
@@ -1136,16 +2681,61 @@ class _Pickler:
                 else:
                     write(TUPLE2)
                 write(REDUCE)
-        else:
-            self._save_toplevel_by_name(module_name, name)
 
         self.memoize(obj)
 
+    def _resolve_global(self, obj, name):
+        # Return (module_name, name, qualname, module) where name is the
+        # name to emit (the last component of qualname for module
+        # attributes) and qualname the full name looked up in module.
+        if name is None:
+            name = getattr(obj, '__qualname__', None)
+        if name is None:
+            name = obj.__name__
+
+        if self.shared_global_cache:
+            try:
+                entry = _global_resolutions.get(obj)
+            except TypeError:   # unhashable or not weakly referenceable
+                entry = None
+            if entry is not None and entry[0] == name:
+                _, module_name, module, emitted = entry
+                if _still_bound(obj, module_name, module, name):
+                    return module_name, emitted, name, module
+
+        module_name = whichmodule(obj, name)
+        try:
+            __import__(module_name, level=0)
+            module = sys.modules[module_name]
+            obj2, parent = _getattribute(module, name)
+        except (ImportError, KeyError, AttributeError):
+            raise PicklingError(
+                "Can't pickle %r: it's not found as %s.%s" %
+                (obj, module_name, name)) from None
+        else:
+            if obj2 is not obj:
+                raise PicklingError(
+                    "Can't pickle %r: it's not the same object as %s.%s" %
+                    (obj, module_name, name))
+
+        emitted = name
+        if parent is module:
+            emitted = name.rpartition('.')[2]
+        if self.shared_global_cache:
+            try:
+                _global_resolutions[obj] = (name, module_name, module, emitted)
+            except TypeError:
+                pass
+        return module_name, emitted, name, module
+
     def _save_toplevel_by_name(self, module_name, name):
+        self.write(self._toplevel_by_name(module_name, name))
+
+    def _toplevel_by_name(self, module_name, name):
         if self.proto >= 3:
             # Non-ASCII identifiers are supported only with protocols >= 3.
-            self.write(GLOBAL + bytes(module_name, "utf-8") + b'\n' +
-                       bytes(name, "utf-8") + b'\n')
+            return (GLOBAL + bytes(module_name, "utf-8") + b'\n' +
+                    bytes(name, "utf-8") + b'\n')
         else:
             if self.fix_imports:
                 r_name_mapping = _compat_pickle.REVERSE_NAME_MAPPING
@@ -1155,8 +2745,8 @@ class _Pickler:
                 elif module_name in r_import_mapping:
                     module_name = r_import_mapping[module_name]
             try:
-                self.write(GLOBAL + bytes(module_name, "ascii") + b'\n' +
-                           bytes(name, "ascii") + b'\n')
+                return (GLOBAL + bytes(module_name, "ascii") + b'\n' +
+                        bytes(name, "ascii") + b'\n')
             except UnicodeEncodeError:
                 raise PicklingError(
                     "can't pickle global identifier '%s.%s' using "
@@ -1175,12 +2765,253 @@ class _Pickler:
     dispatch[type] = save_type
 
 
+class _IterativePickler(_Pickler):
+    """Pickler that walks the object graph with an explicit work stack.
+
+    Lists, dicts, tuples, sets, frozensets and objects saved through
+    __reduce_ex__() are not saved recursively.  Each of them is handled
+    by a generator that yields the objects it needs saved before it can
+    continue, and save() drives a stack of these generators, so nesting
+    depth is not limited by the recursion limit and costs no Python
+    frames.  The output is byte-identical to that of _Pickler.
+
+    Objects whose dispatch entry was replaced in a subclass, and the
+    few objects that _Pickler itself saves from helper methods (such as
+    persistent ids and the names of globals), are saved recursively.
+    The *specialize* option is not supported: a specialized saver saves
+    the fields of an instance recursively.
+    """
+
+    def __init__(self, file, protocol=None, *, specialize=False, **kwargs):
+        if specialize:
+            raise ValueError("specialize is not supported by the "
+                             "iterative pickler")
+        super().__init__(file, protocol, **kwargs)
+
+    def _select_save(self):
+        if self._plain_hooks():
+            self._leaf_savers = self._make_leaf_savers()
+            self._run_types = self._make_run_types()
+        else:
+            self._leaf_savers = None
+            self._run_types = frozenset()
+        self.__dict__.pop("_save_step", None)
+        if self.fast:
+            self._save_step = self._save_tree_step
+        if self.profile is not None:
+            self._step_in_profile = self._save_step
+            self._save_step = self._save_profiled_step
+
+    def save(self, obj, save_persistent_id=True):
+        step = self._save_step
+        gen = step(obj, save_persistent_id)
+        if gen is None:
+            return
+        stack = [gen]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            child = next(stack[-1], _NoValue)
+            if child is _NoValue:
+                pop()
+            else:
+                gen = step(child)
+                if gen is not None:
+                    push(gen)
+
+    def _save_step(self, obj, save_persistent_id=True):
+        # Save obj, or return a generator that saves it, the same way
+        # _Pickler.save() would.
+        self.framer.commit_frame()
+
+        if save_persistent_id:
+            pid = self.persistent_id(obj)
+            if pid is not None:
+                self.save_pers(pid)
+                return None
+
+        t = type(obj)
+        leaf_savers = self._leaf_savers
+        if leaf_savers is not None:
+            f = leaf_savers.get(t)
+            if f is not None:
+                f(obj)
+                return None
+
+        x = self.memo.get(id(obj))
+        if x is not None:
+            self.write(self.get(x[0]))
+            return None
+
+        rv = NotImplemented
+        reduce = _NoValue
+        if leaf_savers is None:
+            reduce = getattr(self, "reducer_override", _NoValue)
+            if reduce is not _NoValue:
+                rv = reduce(obj)
+
+        if rv is NotImplemented:
+            f = self.dispatch.get(t)
+            if f is not None:
+                g = self._iter_dispatch.get(f)
+                if g is not None:
+                    return g(self, obj)
+                f(self, obj)
+                return None
+            state = self._plain_state(obj, t)
+            if state is not _NoValue:
+                return self._iter_save_plain(obj, t, state)
+            r = self._reduce(obj, t)
+            if r is None:
+                return None
+            rv, reduce = r
+
+        if isinstance(rv, str):
+            self.save_global(obj, rv)
+            return None
+        self._check_reduce_tuple(rv, reduce)
+        return self._iter_save_reduce(obj=obj, *rv)
+
+    def _save_tree_step(self, obj, save_persistent_id=True):
+        # Installed as self._save_step by _select_save() in fast mode.
+        gen = type(self)._save_step(self, obj, save_persistent_id)
+        if gen is None:
+            return None
+        return self._iter_tree(obj, gen)
+
+    def _save_profiled_step(self, obj, save_persistent_id=True):
+        # Installed as self._save_step by _select_save() for a profiling
+        # Pickler.  The steps that save what a generator yields are taken
+        # before it is exhausted, so its counts are added then.
+        profile = self.profile
+        if profile is None:
+            return self._step_in_profile(obj, save_persistent_id)
+        outer = profile._children
+        profile._children = children = [0, 0.0]
+        start = profile._written
+        t0 = perf_counter()
+        gen = self._step_in_profile(obj, save_persistent_id)
+        if gen is None:
+            profile._add_save(type(obj), outer, children, start, t0)
+            return None
+        return self._iter_profiled(obj, gen, outer, children, start, t0)
+
+    def _iter_profiled(self, obj, gen, outer, children, start, t0):
+        yield from gen
+        self.profile._add_save(type(obj), outer, children, start, t0)
+
+    def _iter_tree(self, obj, gen):
+        # gen, counted in the nesting depth while it runs, the way
+        # _Pickler._save_tree() counts a recursive save.
+        if self._fast_nesting < self._FAST_NESTING_LIMIT:
+            self._fast_nesting += 1
+            yield from gen
+            self._fast_nesting -= 1
+            return
+        i = id(obj)
+        path = self._fast_path
+        if i in path:
+            raise _cycle_error(obj)
+        path.add(i)
+        yield from gen
+        path.discard(i)
+
+    # Generator counterparts of the _Pickler methods of the same names.
+    # "yield x" stands for "self.save(x)"; the opcodes are written by the
+    # helpers the _Pickler methods use.
+
+    def _iter_save_plain(self, obj, t, state):
+        yield t
+        yield ()
+        self.write(NEWOBJ)
+        self._memoize_built(obj)
+        if state is not None:
+            yield state
+            self.write(BUILD)
+
+    def _iter_save_reduce(self, func, args, state=None, listitems=None,
+                          dictitems=None, state_setter=None, *, obj=None):
+        objs, opcode = self._reduce_call(func, args, obj)
+        yield from objs
+        self.write(opcode)
+
+        if obj is not None:
+            self._memoize_built(obj)
+
+        if listitems is not None:
+            yield from self._iter_batch_appends(listitems)
+
+        if dictitems is not None:
+            yield from self._iter_batch_setitems(
+                self._reduce_dictitems(obj, dictitems))
+
+        if state is not None:
+            objs, opcodes = self._state_call(obj, state, state_setter)
+            yield from objs
+            self.write(opcodes)
+
+    def _iter_save_tuple(self, obj):
+        if self._begin_tuple(obj):
+            yield from obj
+            self._end_tuple(obj)
+
+    def _iter_save_list(self, obj):
+        self._open_container(obj, EMPTY_LIST, LIST)
+        yield from self._iter_batch_appends(obj)
+
+    def _iter_batch_appends(self, items):
+        for batch in self._append_batches(items):
+            yield from batch
+
+    def _iter_save_dict(self, obj):
+        self._open_container(obj, EMPTY_DICT, DICT)
+        yield from self._iter_batch_setitems(self._dict_items(obj))
+
+    def _iter_batch_setitems(self, items):
+        for batch in self._setitem_batches(items):
+            for k, v in batch:
+                yield k
+                yield v
+
+    def _iter_save_set(self, obj):
+        if self.proto < 4:
+            yield from self._iter_save_reduce(
+                set, (list(self._set_members(obj)),), obj=obj)
+            return
+
+        self.write(EMPTY_SET)
+        self.memoize(obj)
+        for batch in self._additem_batches(self._set_members(obj)):
+            yield from batch
+
+    def _iter_save_frozenset(self, obj):
+        if self._canonical and self._save_by_value(obj, _value_key(obj)):
+            return
+        if self.proto < 4:
+            yield from self._iter_save_reduce(
+                frozenset, (list(self._set_members(obj)),), obj=obj)
+            return
+
+        self.write(MARK)
+        yield from self._set_members(obj)
+        self._end_frozenset(obj)
+
+    _iter_dispatch = {
+        _Pickler.save_tuple: _iter_save_tuple,
+        _Pickler.save_list: _iter_save_list,
+        _Pickler.save_dict: _iter_save_dict,
+        _Pickler.save_set: _iter_save_set,
+        _Pickler.save_frozenset: _iter_save_frozenset,
+    }
+
+
 # Unpickling machinery
 
 class _Unpickler:
 
     def __init__(self, file, *, fix_imports=True,
-                 encoding="ASCII", errors="strict", buffers=None):
+                 encoding="ASCII", errors="strict", buffers=None,
+                 profile=False):
         """This takes a binary file for reading a pickle data stream.
 
         The protocol version of the pickle is detected automatically, so
@@ -1217,6 +3048,11 @@ class _Unpickler:
         to decode 8-bit string instances pickled by Python 2; these
         default to 'ASCII' and 'strict', respectively. *encoding* can be
         'bytes' to read these 8-bit string instances as bytes objects.
+
+        If *profile* is true, every load adds the count and time of each
+        opcode run, and the largest memo and stack seen, to the
+        PickleProfile in the unpickler's *profile* attribute, which is
+        otherwise None.
         """
         self._buffers = iter(buffers) if buffers is not None else None
         self._file_readline = file.readline
@@ -1226,18 +3062,43 @@ class _Unpickler:
         self.errors = errors
         self.proto = 0
         self.fix_imports = fix_imports
+        self.profile = None
+        if profile:
+            self.profile = PickleProfile()
+            self.dispatch = self._profiled_dispatch()
 
     def load(self):
         """Read a pickled object representation from the open file.
 
         Return the reconstituted object hierarchy specified in the file.
         """
+        self._begin_load()
+        return self._run_file()
+
+    def _run_file(self):
+        # The loop of load(), from where self.read() is.
+        read = self.read
+        dispatch = self.dispatch
+        try:
+            while True:
+                key = read(1)
+                if not key:
+                    raise EOFError
+                assert isinstance(key, bytes_types)
+                dispatch[key[0]](self)
+        except _Stop as stopinst:
+            if self._decompressor is not None:
+                self._decompressor.finish()
+            return stopinst.value
+
+    def _begin_load(self):
         # Check whether Unpickler was initialized correctly. This is
         # only needed to mimic the behavior of _pickle.Unpickler.dump().
         if not hasattr(self, "_file_read"):
             raise UnpicklingError("Unpickler.__init__() was not called by "
                                   "%s.__init__()" % (self.__class__.__name__,))
         self._unframer = _Unframer(self._file_read, self._file_readline)
+        self._decompressor = None
         self.read = self._unframer.read
         self.readinto = self._unframer.readinto
         self.readline = self._unframer.readline
@@ -1245,17 +3106,35 @@ class _Unpickler:
         self.stack = []
         self.append = self.stack.append
         self.proto = 0
-        read = self.read
-        dispatch = self.dispatch
-        try:
-            while True:
-                key = read(1)
-                if not key:
-                    raise EOFError
-                assert isinstance(key, bytes_types)
-                dispatch[key[0]](self)
-        except _Stop as stopinst:
-            return stopinst.value
+        self._default_builds = {}
+
+    def _profiled_dispatch(self):
+        # A copy of the dispatch table whose functions also count into
+        # self.profile, to be used in its place.
+        profile = self.profile
+        opcodes = profile._opcodes
+
+        def counted(f, counters):
+            def load_counted(self):
+                t0 = perf_counter()
+                try:
+                    f(self)
+                finally:
+                    counters[0] += 1
+                    counters[1] += perf_counter() - t0
+                    n = len(self.memo)
+                    if n > profile.memo_peak:
+                        profile.memo_peak = n
+                    n = len(self.stack)
+                    if n > profile.stack_peak:
+                        profile.stack_peak = n
+                    n = len(self.metastack)
+                    if n > profile.mark_peak:
+                        profile.mark_peak = n
+            return load_counted
+
+        return {code: counted(f, opcodes.setdefault(code, [0, 0.0]))
+                for code, f in self.dispatch.items()}
 
     # Return a list of items pushed in the stack after last MARK instruction.
     def pop_mark(self):
@@ -1269,6 +3148,20 @@ class _Unpickler:
 
     dispatch = {}
 
+    def load_compressed(self):
+        if self.read(3) != _COMPRESSED_MAGIC[1:]:
+            raise UnpicklingError("invalid load key, %r." %
+                                  _COMPRESSED_MAGIC[:1])
+        if self._decompressor is not None or self.stack or self.metastack:
+            raise UnpicklingError("compressed data inside a pickle")
+        # Everything from here on is read from the decompressed blocks.
+        unframer = self._unframer
+        self._decompressor = d = _FrameDecompressor(unframer.file_read,
+                                                    self.read(1))
+        unframer.file_read = d.read
+        unframer.file_readline = d.readline
+    dispatch[_COMPRESSED_MAGIC[0]] = load_compressed
+
     def load_proto(self):
         proto = self.read(1)[0]
         if not 0 <= proto <= HIGHEST_PROTOCOL:
@@ -1755,6 +3648,23 @@ class _Unpickler:
         stack = self.stack
         state = stack.pop()
         inst = stack[-1]
+        if type(state) is dict and state:
+            # The state of a plain class instance, as _Pickler's
+            # specialized savers write it.
+            t = type(inst)
+            default = self._default_builds.get(t)
+            if default is None:
+                default = self._default_builds[t] = _default_build(t)
+            inst_dict = getattr(inst, "__dict__", None)
+            if default and inst_dict is not None:
+                if "__setstate__" not in inst_dict:
+                    try:
+                        inst_dict.update(zip(map(sys.intern, state),
+                                             state.values()))
+                        return
+                    except TypeError:
+                        # Not all keys are str; the loop below redoes it.
+                        pass
         setstate = getattr(inst, "__setstate__", _NoValue)
         if setstate is not _NoValue:
             setstate(state)
@@ -1786,6 +3696,398 @@ class _Unpickler:
         raise _Stop(value)
     dispatch[STOP[0]] = load_stop
 
+    # Loading from memory.  _load_buffer() is load() for a pickle that is
+    # already in memory: it walks the buffer with an integer cursor and
+    # reads each opcode as an int, with the commonest opcodes decoded in
+    # the loop itself, their arguments read in place, and the stack, memo
+    # and append() held in locals.  Other opcodes go to their load_*
+    # method as usual, reading through slices of the buffer.
+
+    def _load_buffer(self, data):
+        # load() from bytes, an mmap or any other buffer.
+        if (self.dispatch is not _Unpickler.dispatch
+                or data[:1] == _COMPRESSED_MAGIC[:1]):
+            # Profiling, a subclass's own opcodes, or compressed blocks,
+            # which need the file path.
+            file = io.BytesIO(data)
+            self._file_read = file.read
+            self._file_readline = file.readline
+            return self.load()
+        self._begin_load()
+        view = None
+        if type(data) is bytes or isinstance(data, mmap.mmap):
+            self.read = self._read_cursor
+            self.readline = self._readline_cursor
+        else:
+            view = memoryview(data)
+            data = view.cast('B')
+            self.read = self._read_view
+            self.readline = self._readline_view
+        self.readinto = self._readinto_cursor
+        self._data = data
+        try:
+            return self._run_buffer(data)
+        except _Stop as stopinst:
+            return stopinst.value
+        finally:
+            # Let go of the buffer, so that a bytearray can be resized.
+            self._data = None
+            if view is not None:
+                data.release()
+                view.release()
+
+    def _run_buffer(self, data):
+        end = len(data)
+        dispatch = self.dispatch
+        memo = self.memo
+        metastack = self.metastack
+        stack = self.stack
+        append = self.append
+        pos = 0
+        # Reads stay within self._frame_end, the end of the frame being
+        # read, as _Unframer's do.  Opcodes are decoded in the loop
+        # while the longest fixed-size one would fit before limit;
+        # nearer the end of a frame, or of the data, _step_cursor() runs
+        # them through the reads.
+        self._frame_end = None
+        limit = end
+        if end >= 2 and data[0] == 0x80:
+            # PROTO, at the start, is kept out of the loop.
+            self._pos = 1
+            self.load_proto()
+            pos = 2
+        while True:
+            # Where an opcode must start for any fixed-size one to fit.
+            last = limit - 9
+            while pos <= last:
+                key = data[pos]
+                pos += 1
+                # Roughly in order of frequency.  Keys are written as
+                # numbers, which compare faster than module constants.
+                if key == 0x94:         # MEMOIZE
+                    memo[len(memo)] = stack[-1]
+                elif key == 0x8c:       # SHORT_BINUNICODE
+                    start = pos + 1
+                    stop = start + data[pos]
+                    if stop > limit:
+                        pos -= 1
+                        break
+                    append(str(data[start:stop], 'utf-8', 'surrogatepass'))
+                    pos = stop
+                elif key == 0x4b:       # BININT1
+                    append(data[pos])
+                    pos += 1
+                elif key == 0x68:       # BINGET
+                    i = data[pos]
+                    pos += 1
+                    try:
+                        append(memo[i])
+                    except KeyError:
+                        msg = f'Memo value not found at index {i}'
+                        raise UnpicklingError(msg) from None
+                elif key == 0x28:       # MARK
+                    metastack.append(stack)
+                    self.stack = stack = []
+                    self.append = append = stack.append
+                elif key == 0x5d:       # EMPTY_LIST
+                    append([])
+                elif key == 0x7d:       # EMPTY_DICT
+                    append({})
+                elif key == 0x75:       # SETITEMS
+                    items = stack
+                    self.stack = stack = metastack.pop()
+                    self.append = append = stack.append
+                    d = stack[-1]
+                    if type(d) is dict and not len(items) & 1:
+                        d.update(zip(items[::2], items[1::2]))
+                    else:
+                        for i in range(0, len(items), 2):
+                            d[items[i]] = items[i + 1]
+                elif key == 0x65 and type(metastack[-1][-1]) is list:
+                    # APPENDS to a list
+                    metastack[-1][-1].extend(stack)
+                    self.stack = stack = metastack.pop()
+                    self.append = append = stack.append
+                elif key == 0x47:       # BINFLOAT
+                    append(_unpack_float8(data, pos)[0])
+                    pos += 8
+                elif key == 0x4d:       # BININT2
+                    append(_unpack_uint2(data, pos)[0])
+                    pos += 2
+                elif key == 0x4a:       # BININT
+                    append(_unpack_int4(data, pos)[0])
+                    pos += 4
+                elif key == 0x4e:       # NONE
+                    append(None)
+                elif key == 0x88:       # NEWTRUE
+                    append(True)
+                elif key == 0x89:       # NEWFALSE
+                    append(False)
+                elif key == 0x2e:       # STOP
+                    return stack.pop()
+                elif key == 0x29:       # EMPTY_TUPLE
+                    append(())
+                elif key == 0x85:       # TUPLE1
+                    stack[-1] = (stack[-1],)
+                elif key == 0x86:       # TUPLE2
+                    stack[-2:] = [(stack[-2], stack[-1])]
+                elif key == 0x87:       # TUPLE3
+                    stack[-3:] = [(stack[-3], stack[-2], stack[-1])]
+                elif key == 0x43:       # SHORT_BINBYTES
+                    start = pos + 1
+                    stop = start + data[pos]
+                    if stop > limit:
+                        pos -= 1
+                        break
+                    append(bytes(data[start:stop]))
+                    pos = stop
+                elif key == 0x71:       # BINPUT
+                    memo[data[pos]] = stack[-1]
+                    pos += 1
+                elif key == 0x95:       # FRAME
+                    self._pos = pos
+                    self._load_frame_cursor()
+                    pos = self._pos
+                    limit = self._frame_end
+                    last = limit - 9
+                elif key == 0xff:       # _COMPRESSED_MAGIC
+                    self._pos = pos
+                    self._load_compressed_cursor()
+                else:
+                    self._pos = pos
+                    dispatch[key](self)
+                    pos = self._pos
+                    stack = self.stack
+                    append = self.append
+                    # The reads may have left the frame.
+                    limit = self._frame_end
+                    if limit is None:
+                        limit = end
+                    last = limit - 9
+            # The opcode at pos may reach past limit.
+            self._pos = pos
+            self._step_cursor()
+            pos = self._pos
+            stack = self.stack
+            append = self.append
+            limit = self._frame_end
+            if limit is None:
+                limit = end
+
+    def _step_cursor(self):
+        # Run one opcode from the buffer the way load() would.
+        key = self.read(1)
+        if not key:
+            raise EOFError
+        key = key[0]
+        if key == FRAME[0]:
+            self._load_frame_cursor()
+        elif key == _COMPRESSED_MAGIC[0]:
+            self._load_compressed_cursor()
+        else:
+            self.dispatch[key](self)
+
+    def _load_frame_cursor(self):
+        # load_frame() and _Unframer.load_frame() for the buffer.
+        frame_size, = unpack('<Q', self.read(8))
+        if frame_size > sys.maxsize:
+            raise ValueError("frame size > sys.maxsize: %d" % frame_size)
+        pos = self._pos
+        if self._frame_end is not None and pos < self._frame_end:
+            raise UnpicklingError(
+                "beginning of a new frame before end of current frame")
+        self._frame_end = min(pos + frame_size, len(self._data))
+
+    def _load_compressed_cursor(self):
+        # Compressed blocks can only be read through an _Unframer, so
+        # the rest of the buffer goes on as a file, from where the
+        # compressed magic starts.
+        data = self._data
+        pos = self._pos
+        frame_end = self._frame_end
+        if frame_end is None:
+            frame_end = pos
+        file = io.BytesIO(bytes(data[frame_end:]))
+        self._unframer = _Unframer(file.read, file.readline)
+        if frame_end > pos:
+            self._unframer.current_frame = io.BytesIO(
+                bytes(data[pos:frame_end]))
+        self.read = self._unframer.read
+        self.readinto = self._unframer.readinto
+        self.readline = self._unframer.readline
+        self.dispatch[_COMPRESSED_MAGIC[0]](self)
+        raise _Stop(self._run_file())
+
+    def _cursor_frame_read(self, pos):
+        # A read at pos goes past the end of the frame: it leaves the
+        # frame if it starts at its end, and otherwise fails.
+        if pos < self._frame_end:
+            raise UnpicklingError("pickle exhausted before end of frame")
+        self._frame_end = None
+
+    def _read_cursor(self, n):
+        pos = self._pos
+        if self._frame_end is not None and pos + n > self._frame_end:
+            self._cursor_frame_read(pos)
+        data = self._data[pos:pos + n]
+        self._pos = pos + len(data)
+        return data
+
+    def _read_view(self, n):
+        pos = self._pos
+        if self._frame_end is not None and pos + n > self._frame_end:
+            self._cursor_frame_read(pos)
+        data = bytes(self._data[pos:pos + n])
+        self._pos = pos + len(data)
+        return data
+
+    def _readinto_cursor(self, buf):
+        pos = self._pos
+        n = len(buf)
+        if self._frame_end is not None and pos + n > self._frame_end:
+            self._cursor_frame_read(pos)
+        data = self._data[pos:pos + n]
+        if len(data) < n:
+            raise UnpicklingError("pickle data was truncated")
+        buf[:] = data
+        self._pos = pos + n
+        return n
+
+    def _readline_stop(self):
+        # Where a line read at self._pos may end: the end of the frame,
+        # or of the data if it's outside a frame or at the frame's end.
+        frame_end = self._frame_end
+        if frame_end is not None:
+            if self._pos < frame_end:
+                return frame_end, True
+            self._frame_end = None
+        return len(self._data), False
+
+    def _readline_cursor(self):
+        data = self._data
+        pos = self._pos
+        stop, in_frame = self._readline_stop()
+        i = data.find(b'\n', pos, stop)
+        if i < 0:
+            if in_frame:
+                raise UnpicklingError("pickle exhausted before end of frame")
+            end = stop
+        else:
+            end = i + 1
+        self._pos = end
+        return data[pos:end]
+
+    def _readline_view(self):
+        # A memoryview has no find(), so look for the end of the line a
+        # piece at a time; lines in pickles are short.
+        view = self._data
+        pos = i = self._pos
+        stop, in_frame = self._readline_stop()
+        end = stop
+        while i < stop:
+            j = bytes(view[i:min(i + 64, stop)]).find(b'\n')
+            if j >= 0:
+                end = i + j + 1
+                break
+            i += 64
+        else:
+            if in_frame:
+                raise UnpicklingError("pickle exhausted before end of frame")
+        self._pos = end
+        return bytes(view[pos:end])
+
+
+# Sessions
+
+class PicklerSession:
+    """Pickle a stream of separate objects, each to its own bytes object.
+
+    session.dumps(obj) returns the same bytes as dumps(obj), but the
+    Pickler, its output and frame buffers and its choice of save path
+    are made once and kept, and only the memo and the output buffer
+    are cleared between objects.  This makes a difference for small
+    objects, for which setting up a Pickler costs more than pickling
+    them.
+
+    Resolutions of globals are kept from one object to the next, as
+    they are by a Pickler, unless *cache_globals* is false.  The other
+    keyword arguments are passed to the Pickler.  A session must not be
+    used by two threads at once.
+    """
+
+    def __init__(self, protocol=None, *, cache_globals=True, **kwargs):
+        self._buffer = io.BytesIO()
+        self._pickler = _Pickler(self._buffer, protocol, **kwargs)
+        self._pickler._select_save()
+        self._cache_globals = cache_globals
+
+    def dumps(self, obj):
+        """Return the pickled representation of obj as a bytes object."""
+        buffer = self._buffer
+        pickler = self._pickler
+        try:
+            pickler._begin_dump(select=False)
+            pickler._save_root(obj)
+            pickler._end_dump()
+            return buffer.getvalue()
+        finally:
+            # The bytes returned share the buffer's memory; empty it so
+            # that the session doesn't keep the pickle alive.
+            buffer.seek(0)
+            buffer.truncate(0)
+            # Don't keep the pickled objects alive until the next call.
+            memo = pickler.memo
+            if isinstance(memo, _PicklerMemo):
+                memo.clear(keep_size=True)
+            else:
+                memo.clear()
+            pickler._memo_epoch += 1
+            if pickler._values is not None:
+                pickler._values.clear()
+            pickler.framer.current_frame = None
+            if not self._cache_globals:
+                pickler._global_cache.clear()
+
+class UnpicklerSession:
+    """Unpickle a stream of separate bytes objects with one Unpickler.
+
+    session.loads(data) returns what loads(data) would, reusing the
+    Unpickler from one call to the next.  The keyword arguments are
+    passed to the Unpickler.  A session must not be used by two threads
+    at once.
+    """
+
+    def __init__(self, **kwargs):
+        self._unpickler = _Unpickler(io.BytesIO(), **kwargs)
+
+    def loads(self, data, /):
+        """Read and return an object from the pickle data."""
+        if isinstance(data, str):
+            raise TypeError("Can't load pickle from unicode string")
+        unpickler = self._unpickler
+        try:
+            return unpickler._load_buffer(data)
+        finally:
+            unpickler.memo.clear()
+            unpickler.stack = unpickler.metastack = None
+
+# Each thread keeps a few sessions for _dumps() and _loads().  A session
+# is taken out of the pool while in use, so a nested call (from a
+# __reduce__() method, say) makes a session of its own.
+_session_pool = threading.local()
+_SESSION_POOL_SIZE = 8
+
+def _take_session(key):
+    try:
+        sessions = _session_pool.sessions
+    except AttributeError:
+        sessions = _session_pool.sessions = {}
+    return sessions.pop(key, None)
+
+def _give_session(key, session):
+    sessions = _session_pool.sessions
+    if len(sessions) < _SESSION_POOL_SIZE:
+        sessions[key] = session
 
 # Shorthands
 
@@ -1794,10 +4096,20 @@ def _dump(obj, file, protocol=None, *, fix_imports=True, buffer_callback=None):
              buffer_callback=buffer_callback).dump(obj)
 
 def _dumps(obj, protocol=None, *, fix_imports=True, buffer_callback=None):
-    f = io.BytesIO()
-    _Pickler(f, protocol, fix_imports=fix_imports,
-             buffer_callback=buffer_callback).dump(obj)
-    res = f.getvalue()
+    if buffer_callback is not None:
+        f = io.BytesIO()
+        _Pickler(f, protocol, fix_imports=fix_imports,
+                 buffer_callback=buffer_callback).dump(obj)
+        res = f.getvalue()
+        assert isinstance(res, bytes_types)
+        return res
+    key = (PicklerSession, protocol, fix_imports)
+    session = _take_session(key)
+    if session is None:
+        session = PicklerSession(protocol, cache_globals=False,
+                                 fix_imports=fix_imports)
+    res = session.dumps(obj)
+    _give_session(key, session)
     assert isinstance(res, bytes_types)
     return res
 
@@ -1810,9 +4122,875 @@ def _loads(s, /, *, fix_imports=True, encoding="ASCII", errors="strict",
            buffers=None):
     if isinstance(s, str):
         raise TypeError("Can't load pickle from unicode string")
-    file = io.BytesIO(s)
-    return _Unpickler(file, fix_imports=fix_imports, buffers=buffers,
-                      encoding=encoding, errors=errors).load()
+    if buffers is not None:
+        unpickler = _Unpickler(io.BytesIO(), fix_imports=fix_imports,
+                               buffers=buffers, encoding=encoding,
+                               errors=errors)
+        return unpickler._load_buffer(s)
+    key = (UnpicklerSession, fix_imports, encoding, errors)
+    session = _take_session(key)
+    if session is None:
+        session = UnpicklerSession(fix_imports=fix_imports,
+                                   encoding=encoding, errors=errors)
+    res = session.loads(s)
+    _give_session(key, session)
+    return res
+
+# Record streams
+
+_RECORDS_MAGIC = "pickle1.records"
+
+# Memoized objects that stay in a RecordWriter's memo from one record to
+# the next: their value can't change between records, and they are what
+# records tend to repeat (attribute names, keys, classes and functions).
+_RECORD_SHARED_TYPES = frozenset([str, bytes, FunctionType, type(len)])
+
+def _shared_across_records(obj):
+    return type(obj) in _RECORD_SHARED_TYPES or isinstance(obj, type)
+
+class RecordWriter:
+    """Write a stream of pickled records to a file.
+
+    Each call to write() appends one complete pickle, but the pickler's
+    memo lives on from one record to the next, so strings, classes and
+    functions that have already been written are referenced by memo
+    index instead of being written again.  Every *checkpoint* records
+    the memo is cleared on both sides, which bounds the memory held by
+    the memo and gives a reader points where its memo is empty; a
+    *checkpoint* of None never clears it.
+
+    Only immutable objects are shared between records: a list written
+    in one record and again, maybe modified, in a later one is written
+    in full both times.
+    """
+
+    def __init__(self, file, protocol=None, *, checkpoint=1000,
+                 fix_imports=True):
+        if checkpoint is not None and checkpoint < 1:
+            raise ValueError("checkpoint must be a positive integer or None")
+        self._pickler = _Pickler(file, protocol, fix_imports=fix_imports,
+                                 compact_memo=True)
+        self.checkpoint = checkpoint
+        self._count = 0
+        self._pickler.dump((_RECORDS_MAGIC, checkpoint))
+        self._pickler.clear_memo()
+
+    def write(self, obj):
+        """Append a pickled representation of obj to the stream."""
+        pickler = self._pickler
+        if self._count == self.checkpoint:
+            pickler.clear_memo()
+            self._count = 0
+        pickler.dump(obj)
+        self._count += 1
+        pickler.memo.release(_shared_across_records)
+        pickler._memo_epoch += 1
+
+class RecordReader:
+    """Read back the records written by a RecordWriter.
+
+    Iterating over the reader loads the records one at a time, in the
+    order they were written.  The reader keeps every object loaded
+    since the last checkpoint in its memo.  A stream that ends in the
+    middle of a record raises UnpicklingError.
+    """
+
+    def __init__(self, file, *, fix_imports=True, encoding="ASCII",
+                 errors="strict"):
+        self._unpickler = _Unpickler(file, fix_imports=fix_imports,
+                                     encoding=encoding, errors=errors)
+        header = self._unpickler.load()
+        if (not isinstance(header, tuple) or len(header) != 2
+                or header[0] != _RECORDS_MAGIC):
+            raise UnpicklingError("not a record stream")
+        self.checkpoint = header[1]
+        self._count = 0
+        self._unpickler.memo.clear()
+        # Each load starts with a read of the record's first opcode,
+        # which goes to _read_first() to tell whether the stream ended
+        # before the record.
+        self._file_read = file.read
+        self._at_end = False
+        self._unpickler._file_read = self._read_first
+
+    def _read_first(self, n):
+        data = self._file_read(n)
+        self._unpickler._unframer.file_read = self._file_read
+        self._at_end = not data
+        return data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        unpickler = self._unpickler
+        if self._count == self.checkpoint:
+            unpickler.memo.clear()
+            self._count = 0
+        try:
+            obj = unpickler.load()
+        except EOFError:
+            if self._at_end:
+                raise StopIteration from None
+            raise UnpicklingError("record stream ends in the middle of "
+                                  "a record") from None
+        self._count += 1
+        return obj
+
+# Sharded containers
+
+_SHARDS_MAGIC = b"pickle1.shards\n\0"
+# Header of the sharded and buffer container files: magic, then the offset
+# of the table that follows the data.
+_container_header = Struct("<16sQ")
+
+# The container being cut into shards by dump_sharded(), for forked worker
+# processes to find without the shards being pickled to them.
+_shard_source = None
+_shard_lock = threading.Lock()
+
+def _shard_slice(obj, start, stop):
+    if isinstance(obj, list):
+        return obj[start:stop]
+    return dict(islice(obj.items(), start, stop))
+
+def _dump_shard(start, stop, part, protocol, fix_imports):
+    if part is None:
+        part = _shard_slice(_shard_source, start, stop)
+    return _dumps(part, protocol, fix_imports=fix_imports)
+
+def _dump_shards(obj, bounds, protocol, fix_imports, workers, mp_context):
+    # Yield (index, pickled shard) pairs for the slices of obj, in the
+    # order they are done.  If the workers are forked, they inherit obj
+    # and are only sent the bounds of their slices.
+    if workers == 1 or len(bounds) <= 1:
+        for i, (start, stop) in enumerate(bounds):
+            yield i, _dumps(_shard_slice(obj, start, stop), protocol,
+                            fix_imports=fix_imports)
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    global _shard_source
+    if mp_context is None:
+        mp_context = multiprocessing.get_context()
+    fork = mp_context.get_start_method() == "fork"
+    with ProcessPoolExecutor(workers, mp_context=mp_context) as pool:
+        futures = {}
+        # A forking pool starts its workers on the first submit.
+        with _shard_lock:
+            if fork:
+                _shard_source = obj
+            try:
+                for i, (start, stop) in enumerate(bounds):
+                    part = None if fork else _shard_slice(obj, start, stop)
+                    future = pool.submit(_dump_shard, start, stop, part,
+                                         protocol, fix_imports)
+                    futures[future] = i
+            finally:
+                _shard_source = None
+        for future in as_completed(futures):
+            yield futures.pop(future), future.result()
+
+def _check_workers(workers):
+    if workers is None:
+        return os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("workers must be a positive integer")
+    return workers
+
+def dump_sharded(obj, path, protocol=None, *, workers=None, shards=None,
+                 fix_imports=True, mp_context=None):
+    """Write the list or dict obj to path as independently pickled shards.
+
+    The container is cut into *shards* consecutive slices (by default
+    four per worker), which are pickled in a pool of *workers*
+    processes, each with its own memo and frames, and written as each
+    is done, followed by a table of their offsets.  *workers* defaults
+    to the number of CPUs; with 1 everything runs in this process.
+    *mp_context* is the multiprocessing context the pool starts its
+    workers with, by default the platform's.  Workers started by fork
+    inherit obj instead of being sent their slices.
+
+    Objects shared between shards are written once per shard and come
+    back as separate copies, so this is meant for containers of mostly
+    independent items.
+    """
+    if not isinstance(obj, (list, dict)):
+        raise TypeError("can only shard a list or a dict, not %s"
+                        % type(obj).__name__)
+    workers = _check_workers(workers)
+    if shards is None:
+        shards = 4 * workers
+    if shards < 1:
+        raise ValueError("shards must be a positive integer")
+    step = -(-len(obj) // shards) or 1
+    bounds = [(i, i + step) for i in range(0, len(obj), step)]
+    table = [None] * len(bounds)
+    offset = _container_header.size
+    with open(path, "wb") as f:
+        f.write(_container_header.pack(_SHARDS_MAGIC, 0))
+        for i, blob in _dump_shards(obj, bounds, protocol, fix_imports,
+                                    workers, mp_context):
+            f.write(blob)
+            table[i] = (offset, len(blob))
+            offset += len(blob)
+        _dump((isinstance(obj, dict), table), f, protocol,
+              fix_imports=fix_imports)
+        f.seek(0)
+        f.write(_container_header.pack(_SHARDS_MAGIC, offset))
+
+def load_sharded(path, *, fix_imports=True, encoding="ASCII",
+                 errors="strict"):
+    """Read a list or dict written by dump_sharded().
+
+    The shards are unpickled in this process, one after another, and
+    concatenated in order.  Unpickling them in worker processes would
+    not be faster, since their results would have to be pickled back.
+    """
+    with open(path, "rb") as f:
+        header = f.read(_container_header.size)
+        if len(header) != _container_header.size:
+            raise UnpicklingError("not a sharded pickle")
+        magic, offset = _container_header.unpack(header)
+        if magic != _SHARDS_MAGIC:
+            raise UnpicklingError("not a sharded pickle")
+        f.seek(offset)
+        is_dict, table = _load(f, fix_imports=fix_imports)
+        result = {} if is_dict else []
+        for offset, size in table:
+            f.seek(offset)
+            data = f.read(size)
+            if len(data) != size:
+                raise UnpicklingError("sharded pickle truncated")
+            part = _loads(data, fix_imports=fix_imports, encoding=encoding,
+                          errors=errors)
+            if is_dict:
+                result.update(part)
+            else:
+                result += part
+    return result
+
+# Out-of-band buffer sidecars
+
+_BUFFERS_MAGIC = b"pickle1.buffers\n"
+
+def dump_oob(obj, path, protocol=5, *, fix_imports=True):
+    """Pickle obj to path with its buffers out-of-band in a sidecar file.
+
+    Every PickleBuffer met while pickling is written to path + ".buffers"
+    at a page-aligned offset instead of into the pickle, followed by a
+    table of their offsets and sizes.  *protocol* must be at least 5.
+    """
+    with open(path + ".buffers", "wb") as sidecar:
+        sidecar.write(_container_header.pack(_BUFFERS_MAGIC, 0))
+        table = []
+
+        def store(buf):
+            with buf.raw() as m:
+                offset = -(-sidecar.tell() // mmap.PAGESIZE) * mmap.PAGESIZE
+                sidecar.seek(offset)
+                sidecar.write(m)
+                table.append((offset, m.nbytes))
+            return False
+
+        with open(path, "wb") as f:
+            _Pickler(f, protocol, fix_imports=fix_imports,
+                     buffer_callback=store).dump(obj)
+        offset = sidecar.seek(0, io.SEEK_END)
+        _dump(table, sidecar, fix_imports=fix_imports)
+        sidecar.seek(0)
+        sidecar.write(_container_header.pack(_BUFFERS_MAGIC, offset))
+
+def load_oob(path, *, fix_imports=True, encoding="ASCII", errors="strict"):
+    """Read an object written by dump_oob().
+
+    The sidecar file is memory-mapped and each out-of-band buffer is
+    handed to the unpickler as a memoryview slice of the mapping, so
+    buffer contents are read from disk only when they are used.  The
+    mapping is copy-on-write: buffers that were writable when pickled
+    can be modified without changing the file.
+    """
+    with open(path + ".buffers", "rb") as sidecar:
+        header = sidecar.read(_container_header.size)
+        if len(header) != _container_header.size:
+            raise UnpicklingError("not a pickle buffer sidecar")
+        magic, offset = _container_header.unpack(header)
+        if magic != _BUFFERS_MAGIC:
+            raise UnpicklingError("not a pickle buffer sidecar")
+        sidecar.seek(offset)
+        table = _load(sidecar, fix_imports=fix_imports)
+        mapping = mmap.mmap(sidecar.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mapping)
+    buffers = [view[offset:offset + size] for offset, size in table]
+    with open(path, "rb") as f:
+        return _load(f, fix_imports=fix_imports, encoding=encoding,
+                     errors=errors, buffers=buffers)
+
+# Sinks
+
+class TeeSink:
+    """File-like object that passes everything written to it on to
+    several sinks.
+
+    Each sink needs only a write() method.  The Pickler writes a frame
+    at a time, so a pickle can be hashed, counted, compressed and
+    stored in one pass without ever being held in memory whole.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        self._writes = [sink.write for sink in sinks]
+
+    def write(self, data):
+        for write in self._writes:
+            write(data)
+        return len(data)
+
+class HashSink:
+    """Sink that feeds what is written to it to a hashlib hash.
+
+    *algorithm* is any name hashlib.new() accepts, such as "sha256" or
+    "blake2b".
+    """
+
+    def __init__(self, algorithm="sha256"):
+        import hashlib
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+        return len(data)
+
+    def digest(self):
+        return self.hash.digest()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+class CountingSink:
+    """Sink that only counts the bytes written to it."""
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        n = len(data)
+        self.count += n
+        return n
+
+class CompressingSink:
+    """Sink that compresses what is written to it into another sink.
+
+    *compression* is "zlib" or "lzma"; the output is an ordinary zlib
+    or xz stream of the whole pickle.  close() must be called after the
+    last dump to write out the end of the stream.
+    """
+
+    def __init__(self, sink, compression="zlib"):
+        _, _, _, compressor = _compression_codec(compression)
+        self._compressor = compressor()
+        self.sink = sink
+
+    def write(self, data):
+        out = self._compressor.compress(data)
+        if out:
+            self.sink.write(out)
+        return len(data)
+
+    def close(self):
+        self.sink.write(self._compressor.flush())
+
+def pickle_digest(obj, protocol=None, *, algorithm="sha256", **kwargs):
+    """Return the hex digest of the pickle of obj.
+
+    The pickle is hashed as it is written, a frame at a time, instead of
+    being built first.  Other keyword arguments, such as canonical=True,
+    are passed to the Pickler.
+    """
+    sink = HashSink(algorithm)
+    _Pickler(sink, protocol, **kwargs).dump(obj)
+    return sink.hexdigest()
+
+# Size estimation
+
+class _FrameSize:
+    # Stands in for the io.BytesIO of a frame, keeping only its size.
+    __slots__ = ('size',)
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        n = len(data)
+        self.size += n
+        return n
+
+    def tell(self):
+        return self.size
+
+class _SizingFramer(_Framer):
+
+    def __init__(self, sink, frame_size):
+        super().__init__(sink.write, None, frame_size)
+        self.sink = sink
+
+    def start_framing(self):
+        self.current_frame = _FrameSize()
+
+    def commit_frame(self, force=False):
+        f = self.current_frame
+        if f:
+            size = f.size
+            if size >= self._FRAME_SIZE_TARGET or force:
+                if size >= self._FRAME_SIZE_MIN:
+                    size += len(FRAME) + 8
+                self.sink.count += size
+                f.size = 0
+
+    def write_sized(self, header, n):
+        # Count a write of header followed by n bytes of payload.
+        if self.current_frame:
+            self.current_frame.size += len(header) + n
+        else:
+            self.sink.count += len(header) + n
+
+    def write_large_sized(self, header, n):
+        # write_large_bytes() for a payload of n bytes.
+        if self.current_frame:
+            self.commit_frame(force=True)
+        self.sink.count += len(header) + n
+
+def _long_size(x):
+    # len(encode_long(x)), without encoding x.
+    if x == 0:
+        return 0
+    return ((x if x > 0 else ~x).bit_length() >> 3) + 1
+
+class _SizingPickler(_Pickler):
+    # A Pickler that only counts what it would write.  Payloads whose
+    # length is known without encoding them are counted, not built.
+
+    dispatch = _Pickler.dispatch.copy()
+
+    def __init__(self, protocol=None, **kwargs):
+        if kwargs.get("compression") is not None:
+            raise ValueError("can't estimate the size of a compressed pickle")
+        self.sink = CountingSink()
+        super().__init__(self.sink, protocol, **kwargs)
+        self.framer = _SizingFramer(self.sink, self.framer._FRAME_SIZE_TARGET)
+        self.write = self.framer.write
+        self._write_large_bytes = self.framer.write_large_bytes
+
+    def _discarding_framer(self):
+        return _SizingFramer(CountingSink(), self.framer._FRAME_SIZE_TARGET)
+
+    def _make_run_types(self):
+        # save_str() below writes what _Pickler.save_str() would, so str
+        # runs may still be encoded in bulk, unless the base class rules
+        # them out for memoizing only shared objects.
+        types = _Pickler._make_run_types(self)
+        if self.bin and self.proto >= 4 and not self._shared_only:
+            types |= {str}
+        return types
+
+    def save_long(self, obj):
+        if self.proto < 2 or (self.bin and -0x80000000 <= obj <= 0x7fffffff):
+            _Pickler.save_long(self, obj)
+            return
+        n = _long_size(obj)
+        if n < 256:
+            self.framer.write_sized(LONG1 + pack("<B", n), n)
+        else:
+            self.framer.write_sized(LONG4 + pack("<i", n), n)
+
+    def _save_bytes_no_memo(self, obj):
+        n = len(obj)
+        if n <= 0xff:
+            self.framer.write_sized(SHORT_BINBYTES + pack("<B", n), n)
+        elif n > 0xffffffff and self.proto >= 4:
+            self.framer.write_large_sized(BINBYTES8 + pack("<Q", n), n)
+        elif n >= self.framer._FRAME_SIZE_TARGET:
+            self.framer.write_large_sized(BINBYTES + pack("<I", n), n)
+        else:
+            self.framer.write_sized(BINBYTES + pack("<I", n), n)
+
+    def _save_bytearray_no_memo(self, obj):
+        n = len(obj)
+        if n >= self.framer._FRAME_SIZE_TARGET:
+            self.framer.write_large_sized(BYTEARRAY8 + pack("<Q", n), n)
+        else:
+            self.framer.write_sized(BYTEARRAY8 + pack("<Q", n), n)
+
+    def save_str(self, obj):
+        # Only an ASCII str has as many UTF-8 bytes as characters.
+        if not self.bin or self._values is not None or not obj.isascii():
+            _Pickler.save_str(self, obj)
+            return
+        n = len(obj)
+        if n <= 0xff and self.proto >= 4:
+            self.framer.write_sized(SHORT_BINUNICODE + pack("<B", n), n)
+        elif n > 0xffffffff and self.proto >= 4:
+            self.framer.write_large_sized(BINUNICODE8 + pack("<Q", n), n)
+        elif n >= self.framer._FRAME_SIZE_TARGET:
+            self.framer.write_large_sized(BINUNICODE + pack("<I", n), n)
+        else:
+            self.framer.write_sized(BINUNICODE + pack("<I", n), n)
+        self.memoize(obj)
+    dispatch[str] = save_str
+
+def estimate_size(obj, protocol=None, **kwargs):
+    """Return the size in bytes of the pickle of obj.
+
+    The result is exactly len(dumps(obj, protocol)), but the pickle is
+    not built: its opcodes are counted as they are produced, and the
+    payloads of bytes, bytearray, ASCII str and large int objects are
+    counted without being encoded.  Other keyword arguments are passed
+    to the Pickler.
+    """
+    pickler = _SizingPickler(protocol, **kwargs)
+    pickler.dump(obj)
+    return pickler.sink.count
+
+class _AttributingPickler(_SizingPickler):
+    # A _SizingPickler that charges the bytes each save() writes, less
+    # those written by the saves inside it, to the object's type and to
+    # its path: the types of the objects it is nested in, from the root.
+
+    def __init__(self, protocol, max_paths, **kwargs):
+        super().__init__(protocol, **kwargs)
+        self.max_paths = max_paths
+        self.paths = {}     # path tuple -> bytes
+        self.types = {}     # type name -> bytes
+        self._names = {}    # type -> name
+        self._path = ()
+        # Bytes written by the saves inside the one under way
+        self._inner = [0]
+
+    def _tell(self):
+        frame = self.framer.current_frame
+        return self.sink.count + (frame.size if frame else 0)
+
+    def save(self, obj, save_persistent_id=True):
+        t = type(obj)
+        name = self._names.get(t)
+        if name is None:
+            name = self._names[t] = "%s.%s" % (t.__module__, t.__qualname__)
+        outer_path = self._path
+        outer = self._inner
+        self._path = path = outer_path + (name,)
+        self._inner = inner = [0]
+        start = self._tell()
+        super().save(obj, save_persistent_id)
+        size = self._tell() - start
+        self._path = outer_path
+        self._inner = outer
+        outer[0] += size
+        size -= inner[0]
+        self.types[name] = self.types.get(name, 0) + size
+        paths = self.paths
+        paths[path] = paths.get(path, 0) + size
+        if len(paths) > 2 * self.max_paths:
+            self._fold()
+
+    def _fold(self):
+        # Keep the max_paths paths with the most bytes and charge the
+        # bytes of the others to their containers' paths, until at most
+        # max_paths are left or only root paths would be folded.
+        paths = self.paths
+        n = self.max_paths
+        while len(paths) > n:
+            kept = {path: paths[path] for path
+                    in sorted(paths, key=paths.get, reverse=True)[:n]}
+            folded = {}
+            shortened = False
+            for path, size in paths.items():
+                if path not in kept:
+                    if len(path) > 1:
+                        path = path[:-1]
+                        shortened = True
+                    folded[path] = folded.get(path, 0) + size
+            for path, size in folded.items():
+                kept[path] = kept.get(path, 0) + size
+            paths = kept
+            if not shortened:
+                break
+        self.paths = paths
+
+class SizeReport:
+    """Where the bytes of a pickle come from, as found by size_report().
+
+    total is the size of the pickle.  paths maps each path of types, from
+    the type of the object pickled down to the type of an object inside
+    it, joined by ";", to the bytes written for the objects at the end of
+    that path, less the bytes of the objects inside them.  types maps
+    each type name to the same counts.  Both add up to total less the few
+    bytes written outside any object, such as PROTO and STOP.
+    """
+
+    def __init__(self, total, paths, types):
+        self.total = total
+        self.paths = paths
+        self.types = types
+
+    def write_collapsed(self, file):
+        """Write paths to a text file in the collapsed stack format read
+        by flamegraph.pl, speedscope and similar tools."""
+        for path, size in sorted(self.paths.items(),
+                                 key=lambda item: item[1], reverse=True):
+            if size:
+                file.write("%s %d\n" % (path, size))
+
+def size_report(obj, protocol=None, *, max_paths=10000, **kwargs):
+    """Return a SizeReport of which parts of obj its pickle is made of.
+
+    obj is pickled as estimate_size() does, without building the pickle,
+    and the bytes are charged to the object that wrote them.  A path is
+    the chain of types from obj down to that object, such as
+    "builtins.dict;builtins.list;builtins.str", with no indices or keys,
+    so all the objects of a type at the same place add up to one path.
+    Only the *max_paths* paths with the most bytes, and the root path,
+    are kept, so memory use is bounded however large and varied obj is:
+    the bytes of the others go to the path of the object that contains
+    them.  Other keyword arguments are passed to the Pickler.
+    """
+    if max_paths < 1:
+        raise ValueError("max_paths must be a positive integer")
+    pickler = _AttributingPickler(protocol, max_paths, **kwargs)
+    pickler.dump(obj)
+    pickler._fold()
+    paths = {";".join(path): size for path, size in pickler.paths.items()}
+    return SizeReport(pickler.sink.count, paths, pickler.types)
+
+# Asyncio streams.  dump_async() drives an _IterativePickler a step at a
+# time, so that it can hand each committed frame to the StreamWriter and
+# let other tasks run in between.  load_async() reads the stream a frame
+# at a time (an opcode at a time outside frames) and runs the opcodes of
+# each as soon as it has arrived.
+
+# Steps of dump_async() between chances for other tasks to run
+_ASYNC_STEPS = 256
+
+class _ChunkSink:
+    # A file that keeps what is written to it until it is taken.
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+def _async_imports():
+    # dump_async() and load_async() import these on first use, so that
+    # importing this module doesn't import asyncio.
+    global asyncio, pickletools
+    import asyncio
+    import pickletools
+
+async def dump_async(obj, writer, protocol=None, **kwargs):
+    """Write the pickled representation of obj to an asyncio StreamWriter.
+
+    The bytes are those dump() would write.  Whenever a frame's worth of
+    output is ready it is written and the writer drained, and other tasks
+    get to run every few hundred containers or objects pickled, so a
+    large object doesn't hold up the event loop.  Other keyword
+    arguments are passed to the Pickler; compression and specialize are
+    not supported.
+    """
+    _async_imports()
+    if kwargs.get("compression") is not None:
+        raise ValueError("dump_async() doesn't support compression")
+    sink = _ChunkSink()
+    pickler = _IterativePickler(sink, protocol, **kwargs)
+    limit = pickler.framer._FRAME_SIZE_TARGET
+    pickler._begin_dump()
+    if pickler._shared_only:
+        pickler._shared = pickler._find_shared(obj)
+    # _IterativePickler.save(), with a pause after each full frame.
+    step = pickler._save_step
+    gen = step(obj)
+    stack = [] if gen is None else [gen]
+    push = stack.append
+    pop = stack.pop
+    steps = 0
+    while stack:
+        child = next(stack[-1], _NoValue)
+        if child is _NoValue:
+            pop()
+        else:
+            gen = step(child)
+            if gen is not None:
+                push(gen)
+        if sink.size >= limit:
+            writer.write(sink.take())
+            await writer.drain()
+        steps += 1
+        if steps >= _ASYNC_STEPS:
+            steps = 0
+            await asyncio.sleep(0)
+    pickler._end_dump()
+    writer.write(sink.take())
+    await writer.drain()
+
+async def _read_line_async(reader):
+    # reader.readuntil(b'\n'), however long the line is.
+    chunks = []
+    while True:
+        try:
+            chunks.append(await reader.readuntil(b'\n'))
+            return b''.join(chunks)
+        except asyncio.LimitOverrunError as e:
+            chunks.append(await reader.readexactly(e.consumed))
+
+async def _read_unit_async(reader):
+    # Read a frame, or an opcode outside a frame, with its argument.
+    key = await reader.readexactly(1)
+    if key == FRAME:
+        header = await reader.readexactly(8)
+        frame_size, = unpack('<Q', header)
+        return key + header + await reader.readexactly(frame_size)
+    if key == _COMPRESSED_MAGIC[:1]:
+        raise UnpicklingError("load_async() can't read compressed pickles")
+    op = pickletools.code2op.get(key.decode("latin-1"))
+    if op is None or op.arg is None:
+        # Unknown opcodes are left to the Unpickler to reject.
+        return key
+    n = op.arg.n
+    if n >= 0:
+        return key + await reader.readexactly(n)
+    if n == pickletools.UP_TO_NEWLINE:
+        line = await _read_line_async(reader)
+        if op.arg.name == "stringnl_noescape_pair":
+            line += await _read_line_async(reader)
+        return key + line
+    fmt = {pickletools.TAKEN_FROM_ARGUMENT1: '<B',
+           pickletools.TAKEN_FROM_ARGUMENT4: '<i',
+           pickletools.TAKEN_FROM_ARGUMENT4U: '<I',
+           pickletools.TAKEN_FROM_ARGUMENT8U: '<Q'}[n]
+    header = await reader.readexactly(calcsize(fmt))
+    size, = unpack(fmt, header)
+    # A negative size is left to the Unpickler to reject.
+    return key + header + await reader.readexactly(max(size, 0))
+
+async def load_async(reader, **kwargs):
+    """Read and return an object from an asyncio StreamReader.
+
+    Only the bytes of the pickle are read from the stream.  Each frame
+    of the pickle is loaded as soon as it has arrived, and other tasks
+    get to run between frames, so neither the whole pickle nor the time
+    to load it is needed at once.  Pickles of protocols below 4, which
+    have no frames, are read an opcode at a time.  The keyword arguments
+    are passed to the Unpickler.
+    """
+    _async_imports()
+    unpickler = _Unpickler(io.BytesIO(), **kwargs)
+    unpickler._begin_load()
+    unframer = unpickler._unframer
+    read = unpickler.read
+    dispatch = unpickler.dispatch
+    try:
+        while True:
+            key = read(1)
+            if not key:
+                data = await _read_unit_async(reader)
+                unit = io.BytesIO(data)
+                unframer.file_read = unit.read
+                unframer.file_readline = unit.readline
+                if data[0] == FRAME[0]:
+                    await asyncio.sleep(0)
+                continue
+            dispatch[key[0]](unpickler)
+    except _Stop as stopinst:
+        return stopinst.value
+
+# Profiling
+
+class PickleProfile:
+    """Counters kept by a Pickler or Unpickler made with profile=True.
+
+    Every dump() or load() adds to them.  For a Pickler, types maps the
+    qualified name of each type saved to a dict of its calls, the bytes
+    written while saving it, own_bytes (those less the bytes of what it
+    contains), and the time and own_time spent on it in seconds.  Saves
+    that are written as a memo reference are counted too, and so are
+    saves nested in a save of the same type, in both.  For an
+    Unpickler, opcodes maps the name of each opcode run to its count and
+    time, and memo_peak, stack_peak and mark_peak are the most memo
+    entries, stack items and unclosed marks seen.
+
+    as_dict() returns all of this as plain data, and to_json() as JSON.
+    """
+
+    def __init__(self):
+        # type -> [calls, bytes, own bytes, time, own time]
+        self._types = {}
+        # opcode -> [count, time], kept by the Unpickler's dispatch
+        self._opcodes = {}
+        # Bytes written so far, and the [bytes, time] of the saves made
+        # inside the one under way.
+        self._written = 0
+        self._children = [0, 0.0]
+        self.memo_peak = 0
+        self.stack_peak = 0
+        self.mark_peak = 0
+
+    def _add_save(self, t, outer, children, start, t0):
+        elapsed = perf_counter() - t0
+        size = self._written - start
+        self._children = outer
+        outer[0] += size
+        outer[1] += elapsed
+        counters = self._types.get(t)
+        if counters is None:
+            counters = self._types[t] = [0, 0, 0, 0.0, 0.0]
+        counters[0] += 1
+        counters[1] += size
+        counters[2] += size - children[0]
+        counters[3] += elapsed
+        counters[4] += elapsed - children[1]
+
+    @property
+    def types(self):
+        types = {}
+        for t, counters in self._types.items():
+            name = "%s.%s" % (t.__module__, t.__qualname__)
+            # Different types may share a name; add them up.
+            old = types.get(name)
+            if old is not None:
+                counters = [a + b for a, b in zip(counters, old.values())]
+            types[name] = dict(zip(("calls", "bytes", "own_bytes",
+                                    "time", "own_time"), counters))
+        return types
+
+    @property
+    def opcodes(self):
+        from pickletools import code2op
+        opcodes = {}
+        for code, (count, elapsed) in self._opcodes.items():
+            if count:
+                op = code2op.get(chr(code))
+                name = op.name if op is not None else "0x%02x" % code
+                opcodes[name] = {"count": count, "time": elapsed}
+        return opcodes
+
+    def as_dict(self):
+        return {"types": self.types, "opcodes": self.opcodes,
+                "memo_peak": self.memo_peak, "stack_peak": self.stack_peak,
+                "mark_peak": self.mark_peak}
+
+    def to_json(self, **kwargs):
+        """Return as_dict() as a JSON string; kwargs go to json.dumps()."""
+        import json
+        return json.dumps(self.as_dict(), **kwargs)
+
 
 # Use the faster _pickle if possible
 try: